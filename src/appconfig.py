@@ -34,6 +34,10 @@ configfile = "config.ini"
 
 parser = argparse.ArgumentParser(description='Process habitat modelling for watershed.')
 parser.add_argument('-c', type=str, help='the configuration file', required=False)
+parser.add_argument('--workers', type=int, help='the maximum number of processing steps to run at the same time', required=False)
+parser.add_argument('--from-step', type=str, help='rerun processing from this step, skipping the steps before it', required=False)
+parser.add_argument('--to-step', type=str, help='stop processing after this step', required=False)
+parser.add_argument('--max-watersheds', type=int, help='the maximum number of watersheds to process at the same time', required=False)
 parser.add_argument('args', type=str, nargs='*')
 args = parser.parse_args()
 if (args.c):
@@ -44,6 +48,11 @@ iniSection = args.args[0]
 config = configparser.ConfigParser()
 config.read(configfile)
 
+# Number of processing steps that can run at the same time
+workers = args.workers
+if (workers is None):
+    workers = config['PROCESSING'].getint('max_workers', fallback = 1)
+
 # Environment variables
 ogr = config['OGR']['ogr']
 proj = config['OGR']['proj']; 
@@ -54,8 +63,14 @@ gdalsrsinfo = config['OGR']['gdalsrsinfo']
 dbHost = config['DATABASE']['host']
 dbPort = config['DATABASE']['port']
 dbName = config['DATABASE']['name']
-dbUser = input(f"""Enter username to access {dbName}:\n""")
-dbPassword = getpass.getpass(f"""Enter password to access {dbName}:\n""")
+# credentials can be provided with the standard PGUSER and PGPASSWORD environment
+# variables (used when running several watersheds, see process_watersheds.py)
+dbUser = os.environ.get('PGUSER')
+if (not dbUser):
+    dbUser = input(f"""Enter username to access {dbName}:\n""")
+dbPassword = os.environ.get('PGPASSWORD')
+if (not dbPassword):
+    dbPassword = getpass.getpass(f"""Enter password to access {dbName}:\n""")
 
 # Files to load raw data and info for wcrp set up
 dataSchema = config['DATABASE']['data_schema']
@@ -104,12 +119,21 @@ if (proj != ""):
 
 psycopg2.extras.register_uuid()
 
+# cursor class used for all connections, set by runstats.py to
+# measure the database work done by each processing step
+cursorFactory = None
+
+# function called with the cpu seconds used by worker processes for the
+# step running on the current thread, set by runstats.py
+workerCpu = None
+
 def connectdb():
     return pg2.connect(database=dbName,
                    user=dbUser,
                    host=dbHost,
                    password=dbPassword,
-                   port=dbPort)
+                   port=dbPort,
+                   cursor_factory=cursorFactory)
 
 def getSpecies():
     """
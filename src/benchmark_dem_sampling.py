@@ -0,0 +1,94 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script compares the speed of the vertex by vertex (processCoordinate)
+# and vectorized (processFeatures) elevation sampling in assign_raw_z on a
+# dem file, using random stream-like lines inside the file, and checks both
+# give the same geometries.
+#
+# Usage: benchmark_dem_sampling.py -c config.ini [watershedid] [demfile] [vertices]
+#
+# This script does not connect to the database.
+#
+
+import appconfig
+import sys
+import time
+import numpy
+import shapely
+import tifffile as tif
+
+from processing_scripts import assign_raw_z
+
+demFile = appconfig.args.args[1]
+vertexCount = int(appconfig.args.args[2]) if len(appconfig.args.args) > 2 else 1000000
+
+# vertices per feature
+featureSize = 50
+
+
+def makeFeatures(demfile):
+    """
+    Creates random lines with featureSize vertices inside the dem file
+    """
+    random = numpy.random.default_rng(0)
+    features = []
+    for i in range(max(1, vertexCount // featureSize)):
+        start = random.uniform([demfile.xmin, demfile.ymin], [demfile.xmax, demfile.ymax])
+        steps = random.normal(0, 5 * abs(demfile.xcellsize), (featureSize, 2))
+        points = numpy.clip(start + numpy.cumsum(steps, axis = 0), [demfile.xmin, demfile.ymin], [demfile.xmax, demfile.ymax])
+        coords = numpy.column_stack([points, numpy.full(featureSize, appconfig.NODATA)])
+        features.append((i, shapely.to_wkb(shapely.linestrings(coords), hex = True)))
+    return features
+
+
+def scalarSampling(features, demfile, demdata):
+    newvalues = []
+    for fid, wkb in features:
+        geom = shapely.from_wkb(wkb)
+        newpnts = [assign_raw_z.processCoordinate(c[0], c[1], c[2], demfile, demdata) for c in geom.coords]
+        newvalues.append((shapely.to_wkb(shapely.LineString(newpnts)), fid))
+    return newvalues
+
+
+def main():
+    demfile = assign_raw_z.getFileDetails(demFile)
+    demdata = numpy.array(tif.imread(demfile.filename))
+    features = makeFeatures(demfile)
+    vertices = len(features) * featureSize
+
+    print(f"""Sampling {vertices} vertices in {len(features)} features""")
+
+    start = time.perf_counter()
+    scalar = scalarSampling(features, demfile, demdata)
+    scalarTime = time.perf_counter() - start
+    print(f"""  vertex by vertex: {scalarTime:.2f} s, {vertices / scalarTime:.0f} vertices/second""")
+
+    start = time.perf_counter()
+    vectorized = assign_raw_z.processFeatures(features, demfile, demdata, assign_raw_z.DemIndex([demfile]))
+    vectorizedTime = time.perf_counter() - start
+    print(f"""  vectorized: {vectorizedTime:.2f} s, {vertices / vectorizedTime:.0f} vertices/second""")
+
+    if (scalar != vectorized):
+        sys.exit("The vectorized sampling results are different")
+    print("Results are the same")
+
+
+if __name__ == "__main__":
+    main()
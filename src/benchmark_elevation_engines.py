@@ -0,0 +1,101 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script compares the speed and results of the python and postgis
+# elevation engines (see assign_raw_z.py and dem_raster.py) on a watershed.
+#
+# Usage: benchmark_elevation_engines.py -c config.ini [watershedid]
+#
+# The elevation cache is not used and the dem files are loaded into the
+# raster table before timing. The engine set in elevation_engine is run last
+# so the raw z geometries are left as the processing would leave them.
+#
+
+import appconfig
+import time
+
+from processing_scripts import assign_raw_z
+from processing_scripts import dem_raster
+from processing_scripts import dem_reader
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+dbTargetTable = appconfig.config['PROCESSING']['stream_table']
+dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
+
+
+def saveResults(conn, engine, watershed_id):
+    query = f"""
+        DROP TABLE IF EXISTS elevations_{engine};
+        CREATE TEMPORARY TABLE elevations_{engine} AS
+        SELECT t.{appconfig.dbIdField} as id, (dp).path[1] as vertex, st_z((dp).geom) as z
+        FROM (
+            SELECT {appconfig.dbIdField}, st_dumppoints({dbTargetGeom}) as dp
+            FROM {dbTargetSchema}.{dbTargetTable}
+            WHERE {appconfig.dbWatershedIdField} IN {watershed_id}
+        ) t;
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+    conn.commit()
+
+
+def compareResults(conn, engine1, engine2):
+    query = f"""
+        SELECT count(*),
+            count(*) FILTER (WHERE (a.z = {appconfig.NODATA}) != (b.z = {appconfig.NODATA})),
+            count(*) FILTER (WHERE a.z != b.z),
+            coalesce(max(abs(a.z - b.z)) FILTER (WHERE a.z != {appconfig.NODATA} AND b.z != {appconfig.NODATA}), 0)
+        FROM elevations_{engine1} a JOIN elevations_{engine2} b ON a.id = b.id AND a.vertex = b.vertex
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        return cursor.fetchone()
+
+
+def main():
+    engines = [e for e in assign_raw_z.ENGINES if e != assign_raw_z.demEngine] + [assign_raw_z.demEngine]
+
+    with appconfig.connectdb() as conn:
+        watershed_id = assign_raw_z.getWatershedIds(conn)
+
+        demIndex, version = assign_raw_z.loadDem()
+        dem_raster.loadRasters(conn, demIndex.demfiles, version)
+
+        times = {}
+        for engine in engines:
+            print("Engine: " + engine)
+            assign_raw_z.prepareOutput(conn)
+            start = time.perf_counter()
+            assign_raw_z.computeElevations(conn, watershed_id, engine, useCache = False)
+            times[engine] = time.perf_counter() - start
+            saveResults(conn, engine, watershed_id)
+
+        vertices, nodata, different, maxdiff = compareResults(conn, engines[0], engines[1])
+
+    dem_reader.closeReaders()
+
+    for engine in engines:
+        print(f"""  {engine}: {times[engine]:.2f} s, {vertices / times[engine]:.0f} vertices/second""")
+    print(f"""  {vertices} vertices, {different} with different elevations, {nodata} with no data in only one engine""")
+    print(f"""  largest difference: {maxdiff}""")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script compares the smoothing methods in smooth_z (envelope and
+# isotonic) on a watershed: the time each takes, how far the smoothed
+# elevations are from the raw elevations and the differences in the vertex
+# gradients.
+#
+# Usage: benchmark_smoothing.py -c config.ini [watershedid]
+#
+# The raw elevations (assign_raw_z) must have been computed. The smoothed
+# elevations are not written to the database.
+#
+
+import appconfig
+import time
+import numpy
+
+from processing_scripts import smooth_z
+
+
+def gradients(z):
+    """
+    Computes the gradient (drop / length) of each segment between two
+    vertices with data
+    :returns: the gradients and a mask of the segments that have one
+    """
+    coords = smooth_z.coords
+    offsets = smooth_z.offsets
+
+    # segments start at every vertex but the last of each edge
+    starts = numpy.ones(len(coords), dtype = bool)
+    starts[offsets[1:] - 1] = False
+    starts = starts.nonzero()[0]
+
+    length = numpy.hypot(coords[starts + 1, 0] - coords[starts, 0], coords[starts + 1, 1] - coords[starts, 1])
+    valid = (z[starts] != appconfig.NODATA) & (z[starts + 1] != appconfig.NODATA) & (length > 0)
+    gradient = numpy.zeros(len(starts))
+    gradient[valid] = (z[starts][valid] - z[starts + 1][valid]) / length[valid]
+    return gradient, valid
+
+
+def main():
+    results = {}
+
+    with appconfig.connectdb() as conn:
+        for method in smooth_z.METHODS:
+            print("Method: " + method)
+            smooth_z.createNetwork(conn)
+            start = time.perf_counter()
+            smooth_z.smoothNetwork(method, incremental = False)
+            results[method] = (time.perf_counter() - start, smooth_z.newz.copy())
+
+    raw = smooth_z.coords[:, 2]
+    vertices = len(raw)
+    for method in smooth_z.METHODS:
+        seconds, z = results[method]
+        valid = (raw != appconfig.NODATA) & (z != appconfig.NODATA)
+        rmse = numpy.sqrt(numpy.mean((z[valid] - raw[valid]) ** 2)) if valid.any() else 0
+        print(f"""  {method}: {seconds:.2f} s, {vertices / seconds:.0f} vertices/second, {rmse:.3f} root mean square difference from the raw elevations""")
+
+    gradient1, valid1 = gradients(results[smooth_z.METHODS[0]][1])
+    gradient2, valid2 = gradients(results[smooth_z.METHODS[1]][1])
+    valid = valid1 & valid2
+    difference = numpy.abs(gradient1[valid] - gradient2[valid])
+    if (len(difference) > 0):
+        print(f"""  gradient differences over {len(difference)} segments: mean {difference.mean():.5f}, largest {difference.max():.5f}""")
+        print(f"""  largest gradient: {smooth_z.METHODS[0]} {gradient1[valid].max():.5f}, {smooth_z.METHODS[1]} {gradient2[valid].max():.5f}""")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script keeps a run manifest for a watershed so a rerun of
+# process_watershed.py can skip the steps that completed in the previous
+# run and whose inputs have not changed.
+#
+# For each step the manifest records its status and a fingerprint of its
+# external inputs (tables not written by any step, files, the DEM directory
+# and the config sections it uses). After each step completes the tables it
+# wrote are fingerprinted (row count + content hash) so a rerun can check the
+# working tables have not been changed outside of the pipeline. Only the
+# columns a step declares it writes are hashed; when a step updates some of
+# the columns of a table the fingerprint of the whole table is dropped from
+# the manifest rather than rehashing every row.
+#
+# The external tables are large shared tables the pipeline only reads, so
+# they are fingerprinted cheaply (row count + newest row version) once per run
+# before any step is started.
+#
+# A step is rerun if it did not complete, its external inputs changed, a table
+# it uses no longer matches the manifest, or it depends on a step that is
+# rerun. Steps update the working tables in place, so if a step that is rerun
+# reads data that a later, completed step already changed, processing restarts
+# from the step that first creates that data.
+#
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import appconfig
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+
+runDirectory = appconfig.config['PROCESSING'].get('run_directory', fallback = 'runs')
+
+# sections always included in a step fingerprint
+defaultSections = [iniSection, 'DATABASE']
+
+# the columns of the pseudo columns steps declare they write for a group of
+# columns (see pipeline.py), as LIKE patterns
+COLUMN_GROUPS = {
+    "topology": ["from_node", "to_node", "network_pre", "network_post"],
+    "barrier_counts": ["barrier_up%", "barrier_down%", "barriers_up%", "barriers_down%",
+        "barrier_cnt%", "gradient_barrier%"],
+    "upstream_habitat": ["total_upstr%", "func_upstr%", "w_total_upstr%", "w_func_upstr%"],
+    "accessibility": ["%_accessibility"],
+    "habitat": ["habitat_%"],
+    "dci": ["dci_%"],
+    "ais": ["ais_upstr", "ais_downstr"],
+}
+
+COMPLETE = "complete"
+FAILED = "failed"
+RUNNING = "running"
+
+
+def section(name):
+    """
+    Resource for the values of a config file section
+    """
+    return "config:" + name
+
+def inputFile(path):
+    """
+    Resource for a file read by a step
+    """
+    return "file:" + path
+
+def inputDirectory(path):
+    """
+    Resource for the tif files in a directory read by a step
+    """
+    return "dir:" + path
+
+def isTable(resource):
+    return not resource.startswith(("config:", "file:", "dir:"))
+
+def tableName(resource):
+    """
+    Schema qualified table name of a table resource
+    """
+    table = resource.partition(':')[0]
+    if '.' not in table:
+        table = dbTargetSchema + "." + table
+    return table
+
+
+def resourceKey(resource):
+    """
+    Schema qualified table name, and column if any, of a table resource
+    """
+    table, sep, column = resource.partition(':')
+    return tableName(table) + sep + column
+
+def hashValues(values):
+    return hashlib.sha1(json.dumps(values, sort_keys = True).encode('utf-8')).hexdigest()
+
+def fingerprintTable(conn, table, column = ''):
+    """
+    Fingerprints a table (or a column or group of columns of it, see
+    COLUMN_GROUPS) as the row count and an order independent sum of the row
+    hashes. Returns None if the table or column does not exist.
+    """
+    schema, name = table.split('.', 1)
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", (table,))
+        if cursor.fetchone()[0] is None:
+            return None
+
+        value = "t::text"
+        if column != '':
+            cursor.execute("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = %s
+                AND (column_name = %s OR column_name LIKE ANY(%s::varchar[]))
+                ORDER BY column_name
+            """, (schema, name, column, COLUMN_GROUPS.get(column, [])))
+            columns = [row[0] for row in cursor.fetchall()]
+            if not columns:
+                return None
+            if columns == [column]:
+                value = f"coalesce(t.{column}::text, '')"
+            else:
+                value = "ROW(" + ", ".join(f't."{c}"' for c in columns) + ")::text"
+
+        cursor.execute(f"""
+            SELECT count(*), coalesce(sum(('x' || substr(md5({value}), 1, 16))::bit(64)::bigint), 0)
+            FROM {table} t
+        """)
+        count, total = cursor.fetchone()
+    return str(count) + ":" + str(total)
+
+def fingerprintSharedTable(conn, table):
+    """
+    Fingerprints a table no step writes as the row count and the newest
+    transaction that inserted or updated a row, which is much cheaper than
+    hashing the rows. Views and other relations without row versions are
+    hashed in full. Returns None if the table does not exist.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        if row[0] not in ('r', 'p', 'm'):
+            return fingerprintTable(conn, table)
+
+        cursor.execute(f"""
+            SELECT count(*), coalesce(max(xmin::text::bigint), 0)
+            FROM {table}
+        """)
+        count, version = cursor.fetchone()
+    return str(count) + ":" + str(version)
+
+def fingerprintFile(path):
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return str(stat.st_size) + ":" + str(stat.st_mtime)
+
+def fingerprintDirectory(path):
+    if not os.path.isdir(path):
+        return None
+    files = []
+    for file in sorted(os.listdir(path)):
+        if file.endswith(".tif"):
+            files.append([file, fingerprintFile(os.path.join(path, file))])
+    return hashValues(files)
+
+def fingerprintSection(name):
+    if not appconfig.config.has_section(name):
+        return None
+    return hashValues(dict(appconfig.config[name]))
+
+def fingerprint(conn, resource):
+    kind, sep, value = resource.partition(':')
+    if kind == "config":
+        return fingerprintSection(value)
+    if kind == "file":
+        return fingerprintFile(value)
+    if kind == "dir":
+        return fingerprintDirectory(value)
+    return fingerprintSharedTable(conn, tableName(resource))
+
+
+class ExternalInputs:
+    """
+    The fingerprints of the external inputs for a run. The tables are only
+    fingerprinted once as no step changes them; files and config sections
+    are quick to check and are fingerprinted each time as steps may write
+    files others read (such as the dem corridor).
+    """
+
+    def __init__(self):
+        self.tables = {}
+
+    def fingerprint(self, conn, resource):
+        if not isTable(resource):
+            return fingerprint(conn, resource)
+        if resource not in self.tables:
+            if conn is None:
+                with appconfig.connectdb() as conn:
+                    self.tables[resource] = fingerprint(conn, resource)
+            else:
+                self.tables[resource] = fingerprint(conn, resource)
+        return self.tables[resource]
+
+
+class Manifest:
+    """
+    The run manifest for a watershed, stored as json in the run directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = {}
+        self.tables = {}
+
+        if os.path.isfile(path):
+            with open(path) as file:
+                data = json.load(file)
+            self.steps = data.get("steps", {})
+            self.tables = data.get("tables", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        with open(self.path + ".tmp", "w") as file:
+            json.dump({"steps": self.steps, "tables": self.tables}, file, indent = 2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def status(self, step):
+        return self.steps.get(step.name, {}).get("status")
+
+    def inputs(self, step):
+        return self.steps.get(step.name, {}).get("inputs")
+
+    def stepStarted(self, step, inputs):
+        self.steps[step.name] = {
+            "status": RUNNING,
+            "inputs": inputs,
+            "started": datetime.now().isoformat()
+        }
+        self.save()
+
+    def stepCompleted(self, step, tables):
+        self.steps[step.name]["status"] = COMPLETE
+        self.steps[step.name]["completed"] = datetime.now().isoformat()
+
+        # a step that rewrites a table replaces all its fingerprints, one that
+        # updates some columns leaves the whole table fingerprint out of date
+        for key in tables:
+            table, sep, column = key.partition(':')
+            for old in list(self.tables):
+                oldTable, sep, oldColumn = old.partition(':')
+                if oldTable == table and (column == '' or oldColumn == ''):
+                    del self.tables[old]
+        self.tables.update(tables)
+        self.save()
+
+    def tableKeys(self, table):
+        """
+        The fingerprints recorded for a table and its columns
+        """
+        return [key for key in self.tables if key.partition(':')[0] == table]
+
+    def stepFailed(self, step, error):
+        self.steps[step.name]["status"] = FAILED
+        self.steps[step.name]["error"] = str(error)
+        self.save()
+
+
+def getManifest():
+    return Manifest(os.path.join(runDirectory, iniSection, "manifest.json"))
+
+
+class Checkpointer:
+    """
+    Records step progress in the manifest while the pipeline runs
+    """
+
+    def __init__(self, manifest, steps, external = None):
+        self.manifest = manifest
+        self.internal = internalTables(steps)
+        self.external = external if external is not None else ExternalInputs()
+
+    def externalInputs(self, conn, step):
+        inputs = {}
+        for resource in externalReads(step, self.internal):
+            inputs[resource] = self.external.fingerprint(conn, resource)
+        return inputs
+
+    def prepare(self, steps):
+        """
+        Fingerprints the external tables read by the steps before any are
+        started so starting a step doesn't hash them on the scheduler thread
+        """
+        with appconfig.connectdb() as conn:
+            for step in steps:
+                self.externalInputs(conn, step)
+
+    def started(self, step):
+        self.manifest.stepStarted(step, self.externalInputs(None, step))
+
+    def fingerprints(self, step):
+        """
+        Fingerprints the tables, or the columns of a table, written by the
+        step. This is run on the worker thread that ran the step so it
+        doesn't hold up starting other steps.
+        """
+        written = set(resourceKey(r) for r in step.writes if isTable(r))
+        tables = {}
+        with appconfig.connectdb() as conn:
+            for key in sorted(written):
+                table, sep, column = key.partition(':')
+                if column != '' and table in written:
+                    continue
+                value = fingerprintTable(conn, table, column)
+                # pseudo columns such as :rows are not data
+                if value is None and column != '':
+                    continue
+                tables[key] = value
+        return tables
+
+    def completed(self, step, tables):
+        self.manifest.stepCompleted(step, tables)
+
+    def failed(self, step, error):
+        self.manifest.stepFailed(step, error)
+
+
+def internalTables(steps):
+    """
+    The tables written by any of the steps
+    """
+    tables = set()
+    for step in steps:
+        for resource in step.writes:
+            if isTable(resource):
+                tables.add(tableName(resource))
+    return tables
+
+def externalReads(step, internal):
+    reads = [section(name) for name in defaultSections]
+    for resource in step.reads:
+        if not isTable(resource) or tableName(resource) not in internal:
+            reads.append(resource)
+    return reads
+
+def firstWriter(steps, resource, overlaps):
+    for step in steps:
+        if any(overlaps(write, resource) for write in step.writes):
+            return step
+    return None
+
+
+def planSteps(steps, manifest, overlaps, fromStep = None, toStep = None, external = None):
+    """
+    Works out which steps need to be run and returns them in order.
+
+    :param steps: all the pipeline steps in order with their dependency graph built
+    :param manifest: the manifest from the previous run
+    :param overlaps: function that tests if two resources overlap
+    :param fromStep: if set, steps before this are skipped and this step and
+        everything after it is run
+    :param toStep: if set, steps after this are not run
+    :param external: if provided, the external input fingerprints are kept
+        here to be reused when the steps are run (see Checkpointer)
+    """
+    names = [step.name for step in steps]
+    for name in (fromStep, toStep):
+        if name is not None and name not in names:
+            raise Exception("Unknown step: " + name + ". Steps are: " + ", ".join(names))
+
+    if external is None:
+        external = ExternalInputs()
+
+    rerun = set()
+    reasons = {}
+
+    def addStep(step, reason):
+        if step.name not in rerun:
+            rerun.add(step.name)
+            reasons[step.name] = reason
+
+    if fromStep is not None:
+        for step in steps[names.index(fromStep):]:
+            addStep(step, "--from-step " + fromStep)
+    else:
+        internal = internalTables(steps)
+        tableState = {}
+
+        with appconfig.connectdb() as conn:
+
+            def currentState(key):
+                if key not in tableState:
+                    table, sep, column = key.partition(':')
+                    tableState[key] = fingerprintTable(conn, table, column)
+                return tableState[key]
+
+            for step in steps:
+                status = manifest.status(step)
+                if status != COMPLETE:
+                    addStep(step, "not complete" if status is None else status)
+                    continue
+                inputs = manifest.inputs(step)
+                for resource in externalReads(step, internal):
+                    if resource not in inputs or external.fingerprint(conn, resource) != inputs[resource]:
+                        addStep(step, "input changed: " + resource)
+                        break
+
+            # steps that did not complete may have partly updated the columns
+            # they write, they reset these when rerun
+            partial = set()
+            for step in steps:
+                if manifest.status(step) != COMPLETE:
+                    for resource in step.writes:
+                        if isTable(resource) and resource.partition(':')[2] != '':
+                            partial.add(tableName(resource))
+
+            changed = True
+            while changed:
+                changed = False
+
+                # the dependents of steps that are rerun must also be rerun
+                for step in steps:
+                    if step.name not in rerun and any(name in rerun for name in step.upstream):
+                        addStep(step, "depends on " + ", ".join(sorted(step.upstream & rerun)))
+                        changed = True
+
+                for i, step in enumerate(steps):
+                    if step.name not in rerun:
+                        continue
+
+                    # the tables the step uses must match the manifest
+                    for resource in step.reads + step.writes:
+                        if not isTable(resource):
+                            continue
+                        table = tableName(resource)
+                        if table not in internal or table in partial:
+                            continue
+                        for key in manifest.tableKeys(table):
+                            if currentState(key) != manifest.tables[key]:
+                                writer = firstWriter(steps, table, lambda r1, r2: tableName(r1) == r2)
+                                if writer.name not in rerun:
+                                    addStep(writer, "table changed: " + key)
+                                    changed = True
+                                break
+
+                    # data the step reads must not have been changed by a later
+                    # step that completed in the previous run
+                    for later in steps[i + 1:]:
+                        if manifest.status(later) != COMPLETE:
+                            continue
+                        for read in step.reads:
+                            if any(overlaps(write, read) for write in later.writes):
+                                writer = firstWriter(steps[:i + 1], read, overlaps)
+                                if writer is not None and writer.name not in rerun:
+                                    addStep(writer, read + " changed by " + later.name)
+                                    changed = True
+
+    if toStep is not None:
+        last = names.index(toStep)
+        rerun = set(name for name in rerun if names.index(name) <= last)
+
+    for step in steps:
+        if step.name in rerun:
+            print("Running step: " + step.name + " (" + reasons[step.name] + ")")
+        else:
+            print("Skipping step: " + step.name)
+
+    return [step for step in steps if step.name in rerun]
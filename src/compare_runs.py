@@ -0,0 +1,139 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script compares the latest run report for a watershed (see runstats.py)
+# with the previous runs and flags the steps that got slower.
+#
+# Usage: compare_runs.py -c config.ini [watershedid] [--runs N] [--threshold T] [--min-seconds S]
+#
+# A step is flagged when its wall time is more than threshold (a fraction,
+# 0.2 = 20%) and min-seconds above the median of the previous N completed runs
+# of the step. The sql statement and row counts are shown next to the times;
+# if these did not change the slowdown most likely comes from the database
+# (for example a query plan change) rather than from more data.
+#
+# This script does not connect to the database.
+#
+
+import argparse
+import configparser
+import glob
+import json
+import os
+import statistics
+import sys
+
+parser = argparse.ArgumentParser(description='Compare the latest watershed run report with previous runs.')
+parser.add_argument('-c', type=str, help='the configuration file', required=False)
+parser.add_argument('--runs', type=int, default=5, help='the number of previous runs to compare with')
+parser.add_argument('--threshold', type=float, default=0.2, help='fraction a step must be slower than the previous runs to be flagged')
+parser.add_argument('--min-seconds', type=float, default=5, help='minimum slowdown in seconds to be flagged')
+parser.add_argument('args', type=str, nargs=1)
+args = parser.parse_args()
+
+configfile = "config.ini"
+if (args.c):
+    configfile = args.c
+
+config = configparser.ConfigParser()
+config.read(configfile)
+
+iniSection = args.args[0]
+runDirectory = config['PROCESSING'].get('run_directory', fallback = 'runs')
+
+METRICS = ["wall_seconds", "cpu_seconds", "sql_statements", "rows_read", "rows_written", "bytes_received"]
+
+
+def loadReports():
+    """
+    Loads the run reports for the watershed, oldest first
+    """
+    reports = []
+    for file in sorted(glob.glob(os.path.join(runDirectory, iniSection, "reports", "*.json"))):
+        with open(file) as f:
+            report = json.load(f)
+        report["file"] = file
+        reports.append(report)
+    return reports
+
+def completedSteps(report):
+    return {step["step"]: step for step in report["steps"] if step["status"] == "complete"}
+
+def compare(latest, previous):
+    """
+    Compares the steps of the latest report with the previous reports and
+    returns the rows of the comparison and the names of the flagged steps
+    """
+    history = {}
+    for report in previous:
+        for name, step in completedSteps(report).items():
+            history.setdefault(name, []).append(step)
+
+    rows = []
+    flagged = []
+    for name, step in completedSteps(latest).items():
+        before = history.get(name, [])
+        if not before:
+            rows.append((name, step, None, ""))
+            continue
+
+        baseline = {metric: statistics.median(s[metric] for s in before) for metric in METRICS}
+
+        flag = ""
+        slower = step["wall_seconds"] - baseline["wall_seconds"]
+        if slower > args.min_seconds and step["wall_seconds"] > baseline["wall_seconds"] * (1 + args.threshold):
+            sameWork = all(step[m] == baseline[m] for m in ["sql_statements", "rows_read", "rows_written"])
+            flag = "SLOWER (same sql work)" if sameWork else "SLOWER"
+            flagged.append(name)
+
+        rows.append((name, step, baseline, flag))
+    return rows, flagged
+
+
+def main():
+    reports = loadReports()
+    if len(reports) < 2:
+        sys.exit("At least two run reports are required for watershed " + iniSection + " in " + runDirectory)
+
+    latest = reports[-1]
+    previous = reports[-(args.runs + 1):-1]
+
+    print("Comparing " + latest["file"] + " with the median of " + str(len(previous)) + " previous run(s)")
+    print()
+
+    rows, flagged = compare(latest, previous)
+
+    print(f"""{"step":<36}{"wall (s)":>18}{"cpu (s)":>18}{"statements":>20}{"rows read":>24}{"rows written":>24}  flag""")
+    for name, step, baseline, flag in rows:
+        def cell(metric, width):
+            value = f"""{step[metric]:g}"""
+            if baseline is not None:
+                value += f""" ({baseline[metric]:g})"""
+            return f"""{value:>{width}}"""
+        print(f"""{name:<36}{cell("wall_seconds", 18)}{cell("cpu_seconds", 18)}{cell("sql_statements", 20)}{cell("rows_read", 24)}{cell("rows_written", 24)}  {flag}""")
+
+    print()
+    if flagged:
+        print("Steps slower than previous runs: " + ", ".join(flagged))
+        sys.exit(1)
+    print("No steps slower than previous runs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script defines the watershed processing steps along with the tables
+# each step reads and writes, and runs them as a dependency graph so steps
+# that do not touch the same data run at the same time.
+#
+# Resources are table names (in the watershed output schema unless schema
+# qualified) optionally followed by :column when a step only uses some of the
+# columns of the table. A step depends on an earlier step when one of them
+# writes a resource the other reads or writes.
+#
+# Config file sections, files and the DEM directory a step uses are also
+# listed in its reads (see checkpoint.py) so reruns can tell when they change.
+#
+# Steps that update a table row by row (execute_batch) also declare the :rows
+# pseudo column of the table as written. Two of these running at the same time
+# on the same table can deadlock on row locks so they are never run together.
+#
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+import functools
+
+import appconfig
+from checkpoint import section, inputFile, inputDirectory
+
+from processing_scripts import load_parameters
+from processing_scripts import preprocess_watershed
+from processing_scripts import load_and_snap_barriers_cabd
+from processing_scripts import load_habitat_access_updates
+from processing_scripts import process_habitat_access_updates
+from processing_scripts import compute_modelled_crossings
+from processing_scripts import load_barrier_updates
+from processing_scripts import compute_mainstems
+from processing_scripts import build_dem_corridor
+from processing_scripts import assign_raw_z
+from processing_scripts import smooth_z
+from processing_scripts import compute_vertex_gradient
+from processing_scripts import compute_segment_gradient
+from processing_scripts import break_streams_at_barriers
+from processing_scripts import compute_updown_barriers_fish
+from processing_scripts import compute_accessibility
+from processing_scripts import assign_habitat
+from processing_scripts import compute_barriers_upstream_values
+from processing_scripts import compute_barrier_dci
+from processing_scripts import remove_isolated_flowpaths
+from processing_scripts import load_ais
+from processing_scripts import barrier_passability_view
+from processing_scripts import rank_barriers
+from processing_scripts import stream_network
+from processing_scripts import dem_corridor
+from processing_scripts import vertex_profiles
+
+dataSchema = appconfig.dataSchema
+
+streams = appconfig.config['PROCESSING']['stream_table']
+streamRows = streams + ":rows"
+# the from_node, to_node, network_pre and network_post columns and the node
+# table (see stream_network.py)
+streamTopology = streams + ":topology"
+streamNodes = stream_network.nodeTable
+barriers = appconfig.dbBarrierTable
+passability = appconfig.dbPassabilityTable
+breakPoints = appconfig.config['BARRIER_PROCESSING']['gradient_barrier_table']
+barrierUpdates = appconfig.config['BARRIER_PROCESSING']['barrier_updates_table']
+waterfalls = appconfig.config['BARRIER_PROCESSING']['waterfalls_table']
+modelledCrossings = appconfig.config['CROSSINGS']['modelled_crossings_table']
+vertexGradient = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
+# the vertex gradients as a row per mainstem (see vertex_profiles.py)
+vertexProfile = vertex_profiles.profileTable
+segmentGradient = appconfig.config['GRADIENT_PROCESSING']['segment_gradient_field']
+rawGeometry = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
+smoothedGeometry = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
+mainstem = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
+demDirectory = appconfig.config['ELEVATION_PROCESSING']['dem_directory']
+demCorridor = inputFile(dem_corridor.corridorFile)
+fishSpecies = "fish_species"
+habAccessUpdates = "habitat_access_updates"
+ais = "aquatic_invasive_species"
+
+speciesParameters = dataSchema + "." + appconfig.fishSpeciesTable
+rawStreams = dataSchema + "." + appconfig.streamTable
+rawWatersheds = dataSchema + "." + appconfig.watershedTable
+rawSecondaryWatersheds = dataSchema + "." + appconfig.config['CREATE_LOAD_SCRIPT']['secondary_watershed_table']
+rawRoads = dataSchema + "." + appconfig.config['CREATE_LOAD_SCRIPT']['road_table']
+rawTidalZones = dataSchema + "." + appconfig.tidalZones
+rawRails = dataSchema + "." + appconfig.config['CREATE_LOAD_SCRIPT']['rail_table']
+rawTrails = dataSchema + "." + appconfig.config['CREATE_LOAD_SCRIPT']['trail_table']
+aoiTable = "public.chyf_aoi"
+shorelineTable = "public.chyf_shoreline"
+
+
+class Step:
+    def __init__(self, name, module, reads, writes):
+        self.name = name
+        self.module = module
+        self.reads = reads
+        self.writes = writes
+        self.upstream = set()
+
+    def sharedTables(self):
+        """
+        Tables written by the step that are outside of the watershed schema
+        and so are shared with the other watersheds
+        """
+        return sorted(set(splitResource(r)[0] for r in self.writes if '.' in splitResource(r)[0]))
+
+    def sharedReads(self):
+        """
+        Tables read but not written by the step that are shared with the
+        other watersheds
+        """
+        written = self.sharedTables()
+        return sorted(set(splitResource(r)[0] for r in self.reads
+            if '.' in splitResource(r)[0] and splitResource(r)[0] not in written))
+
+    def run(self):
+        shared = self.sharedTables()
+        read = self.sharedReads()
+        if not shared and not read:
+            self.module.main()
+            return
+
+        # hold an advisory lock on each shared table so watersheds processed
+        # at the same time (see process_watersheds.py) take turns updating
+        # them; steps that only read a shared table hold a shared lock so they
+        # never see it part way through being rebuilt (load_parameters commits
+        # an empty fish species table before filling it). Locks are taken in
+        # table order so two steps can't each wait on a lock the other holds.
+        conn = appconfig.connectdb()
+        try:
+            with conn.cursor() as cursor:
+                for table in sorted(shared + read):
+                    if table in shared:
+                        cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (table,))
+                    else:
+                        cursor.execute("SELECT pg_advisory_lock_shared(hashtext(%s))", (table,))
+            conn.commit()
+            self.module.main()
+        finally:
+            conn.close()
+
+
+def getSteps():
+    """
+    Returns the watershed processing steps in the order they were
+    originally run. Steps are re-created on each call as they keep
+    track of their dependencies.
+    """
+    return [
+        Step("load_parameters", load_parameters,
+            reads=[inputFile(appconfig.fish_parameters)],
+            writes=[speciesParameters]),
+        Step("preprocess_watershed", preprocess_watershed,
+            reads=[rawStreams, rawWatersheds, rawSecondaryWatersheds, aoiTable, section('CREATE_LOAD_SCRIPT')],
+            writes=[streams, streamNodes]),
+        Step("remove_isolated_flowpaths", remove_isolated_flowpaths,
+            reads=[streams, shorelineTable],
+            writes=[streams]),
+        Step("load_and_snap_barriers_cabd", load_and_snap_barriers_cabd,
+            reads=[streams + ":geometry", speciesParameters, rawSecondaryWatersheds,
+                section('CABD_DATABASE'), section('BARRIER_PROCESSING'), section('CREATE_LOAD_SCRIPT')],
+            writes=[fishSpecies, barriers, waterfalls, passability, "barrier_passability_view", "natural_barriers_vw"]),
+        Step("compute_modelled_crossings", compute_modelled_crossings,
+            reads=[streams + ":geometry", streams + ":stream_name", streams + ":strahler_order", speciesParameters, fishSpecies,
+                rawSecondaryWatersheds, rawRails, rawTrails,
+                section('CROSSINGS'), section('CABD_DATABASE'), section('BARRIER_PROCESSING'), section('CREATE_LOAD_SCRIPT')],
+            writes=[modelledCrossings, barriers, passability, rawRoads]),
+        Step("load_barrier_updates", load_barrier_updates,
+            reads=[streams + ":geometry", modelledCrossings, speciesParameters, fishSpecies, rawSecondaryWatersheds,
+                inputFile(appconfig.config[appconfig.iniSection].get('barrier_updates', fallback = '')),
+                section('CROSSINGS'), section('CABD_DATABASE'), section('BARRIER_PROCESSING'), section('CREATE_LOAD_SCRIPT')],
+            writes=[barrierUpdates, barriers, passability]),
+        Step("compute_mainstems", compute_mainstems,
+            reads=[streams + ":geometry", streams + ":stream_name", streamTopology, streamNodes, section('MAINSTEM_PROCESSING')],
+            writes=[streams + ":" + mainstem, streamRows]),
+        Step("build_dem_corridor", build_dem_corridor,
+            reads=[streams + ":geometry", aoiTable, section('ELEVATION_PROCESSING'), inputDirectory(demDirectory)],
+            writes=[demCorridor]),
+        Step("assign_raw_z", assign_raw_z,
+            reads=[streams + ":geometry", aoiTable, section('ELEVATION_PROCESSING'), inputDirectory(demDirectory), demCorridor],
+            writes=[streams + ":" + rawGeometry, streamRows]),
+        Step("smooth_z", smooth_z,
+            reads=[streams + ":" + rawGeometry, streamTopology, streamNodes, section('ELEVATION_PROCESSING')],
+            writes=[streams + ":" + smoothedGeometry, streamRows]),
+        Step("compute_vertex_gradient", compute_vertex_gradient,
+            reads=[streams + ":" + smoothedGeometry, streams + ":" + mainstem,
+                section('GRADIENT_PROCESSING'), section('MAINSTEM_PROCESSING')],
+            writes=[vertexGradient, vertexProfile]),
+        Step("load_habitat_access_updates", load_habitat_access_updates,
+            reads=[streams + ":geometry", section('CABD_DATABASE'),
+                inputFile(appconfig.config[appconfig.iniSection].get('habitat_access_updates', fallback = ''))],
+            writes=[habAccessUpdates]),
+        Step("break_streams_at_barriers", break_streams_at_barriers,
+            reads=[vertexGradient, vertexProfile, streamTopology, speciesParameters, fishSpecies,
+                section('BARRIER_PROCESSING'), section('CABD_DATABASE'), section('CROSSINGS'), section('GRADIENT_PROCESSING')],
+            writes=[breakPoints, barriers, passability, streams, streamNodes]),
+        # re-assign elevations to broken streams
+        Step("reassign_raw_z", assign_raw_z,
+            reads=[streams + ":geometry", aoiTable, section('ELEVATION_PROCESSING'), inputDirectory(demDirectory), demCorridor],
+            writes=[streams + ":" + rawGeometry, streamRows]),
+        Step("recompute_smooth_z", smooth_z,
+            reads=[streams + ":" + rawGeometry, streamTopology, streamNodes, section('ELEVATION_PROCESSING')],
+            writes=[streams + ":" + smoothedGeometry, streamRows]),
+        Step("compute_segment_gradient", compute_segment_gradient,
+            reads=[streams + ":" + smoothedGeometry, section('GRADIENT_PROCESSING')],
+            writes=[streams + ":" + segmentGradient]),
+        Step("compute_updown_barriers_fish", compute_updown_barriers_fish,
+            reads=[streams + ":geometry", streamTopology, streamNodes, barriers, breakPoints, passability, fishSpecies,
+                section('BARRIER_PROCESSING'), section('CABD_DATABASE')],
+            writes=[streams + ":barrier_counts", streamRows]),
+        Step("compute_accessibility", compute_accessibility,
+            reads=[streams + ":barrier_counts", speciesParameters],
+            writes=[streams + ":accessibility"]),
+        Step("assign_habitat", assign_habitat,
+            reads=[streams, speciesParameters, rawTidalZones, section('GRADIENT_PROCESSING')],
+            writes=[streams + ":habitat"]),
+        Step("process_habitat_access_updates", process_habitat_access_updates,
+            reads=[streams, speciesParameters],
+            writes=[habAccessUpdates, streams + ":accessibility", streams + ":habitat", "public.upstream", "public.downstream"]),
+        Step("compute_barriers_upstream_values", compute_barriers_upstream_values,
+            reads=[streams, streamNodes, passability, fishSpecies, speciesParameters, section('BARRIER_PROCESSING')],
+            writes=[barriers + ":barrier_counts", barriers + ":upstream_habitat", streams + ":dci", "temp"]),
+        Step("load_ais", load_ais,
+            reads=[streams + ":geometry", streamTopology, barriers + ":barrier_counts"],
+            writes=[ais, barriers + ":ais"]),
+        Step("compute_barrier_dci", compute_barrier_dci,
+            reads=[streams, barriers + ":id", passability, fishSpecies, speciesParameters, section('BARRIER_PROCESSING')],
+            writes=[barriers + ":dci", "temp"]),
+        Step("rank_barriers", rank_barriers,
+            reads=[barriers, passability, fishSpecies, streams + ":" + mainstem],
+            writes=["ranked_barriers"]),
+        # join_tracking_table_crossings_vw builds on the ranked barrier tables
+        # which rank_barriers drops with cascade so this has to follow it
+        Step("barrier_passability_view", barrier_passability_view,
+            reads=[barriers + ":attributes", passability, fishSpecies, breakPoints, "ranked_barriers"],
+            writes=["barrier_passability_view", "natural_barriers_vw"]),
+    ]
+
+
+def splitResource(resource):
+    table, sep, column = resource.partition(':')
+    return table, column
+
+
+def overlaps(resource1, resource2):
+    """
+    Two resources overlap if they are on the same table and either
+    refers to the whole table or both refer to the same column
+    """
+    table1, column1 = splitResource(resource1)
+    table2, column2 = splitResource(resource2)
+    return table1 == table2 and (column1 == '' or column2 == '' or column1 == column2)
+
+
+def dependsOn(step, earlier):
+    """
+    Returns true if step must wait for the earlier step to complete
+    """
+    for write in step.writes:
+        if any(overlaps(write, other) for other in earlier.writes + earlier.reads):
+            return True
+    for read in step.reads:
+        if any(overlaps(read, other) for other in earlier.writes):
+            return True
+    return False
+
+
+def buildGraph(steps):
+    """
+    Computes the upstream steps (by name) for each step. Dependencies
+    only ever point to earlier steps in the list so the graph has no cycles.
+    """
+    for i, step in enumerate(steps):
+        step.upstream = set()
+        for earlier in steps[:i]:
+            if dependsOn(step, earlier):
+                step.upstream.add(earlier.name)
+
+
+def runStep(run, step, checkpointer):
+    """
+    Runs a step on a worker thread. The tables it wrote are fingerprinted
+    here too so the scheduler can go on starting steps while they are hashed.
+    """
+    run()
+    if checkpointer is None:
+        return None
+    return checkpointer.fingerprints(step)
+
+
+def runSteps(steps, workers = 1, checkpointer = None, report = None):
+    """
+    Runs the steps on a pool of worker threads. A step is started as soon as
+    all of its upstream steps are complete and a worker is free; when more than
+    one step is ready they are started in list order. If a step fails no new
+    steps are started and the error is raised once running steps complete.
+
+    :param steps: the steps to run, see getSteps()
+    :param workers: the maximum number of steps to run at the same time
+    :param checkpointer: if provided, records the progress of each step in the run manifest
+    :param report: if provided, measures each step for the run report (see runstats.py)
+    """
+    buildGraph(steps)
+
+    if checkpointer is not None:
+        checkpointer.prepare(steps)
+
+    remaining = list(steps)
+    completed = set()
+    running = {}
+    failed = None
+
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+        while remaining or running:
+            if failed is None:
+                for step in list(remaining):
+                    if len(running) >= workers:
+                        break
+                    if step.upstream.issubset(completed):
+                        remaining.remove(step)
+                        print("Starting step: " + step.name)
+                        if checkpointer is not None:
+                            checkpointer.started(step)
+                        run = step.run if report is None else functools.partial(report.runStep, step)
+                        running[pool.submit(runStep, run, step, checkpointer)] = (step, datetime.now())
+
+            if not running:
+                break
+
+            finished, notfinished = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                step, startTime = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    print("Step failed: " + step.name + ": " + str(error))
+                    if checkpointer is not None:
+                        checkpointer.failed(step, error)
+                    if failed is None:
+                        failed = error
+                else:
+                    completed.add(step.name)
+                    print("Completed step: " + step.name + " (" + str(datetime.now() - startTime) + ")")
+                    if checkpointer is not None:
+                        checkpointer.completed(step, future.result())
+
+    if failed is not None:
+        raise failed
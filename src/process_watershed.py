@@ -18,6 +18,15 @@
 
 #
 # This script runs all the steps to process and calculate connectivity for a watershed.
+# The steps and the data they depend on are defined in pipeline.py; steps that
+# do not depend on each other are run at the same time (see max_workers).
+#
+# Progress is recorded in a run manifest (see checkpoint.py); steps that
+# completed in a previous run and whose inputs have not changed are skipped.
+# Use --from-step and --to-step to choose the steps to run.
+#
+# The time and database work of each step is written to a run report (see
+# runstats.py); use compare_runs.py to compare it with previous runs.
 #
  
 import appconfig
@@ -25,64 +34,36 @@ from datetime import datetime
 
 startTime = datetime.now()
 
-from processing_scripts import load_parameters
-from processing_scripts import preprocess_watershed
-from processing_scripts import load_and_snap_barriers_cabd
-from processing_scripts import load_and_snap_fishobservation
-from processing_scripts import load_habitat_access_updates
-from processing_scripts import process_habitat_access_updates
-from processing_scripts import compute_modelled_crossings
-from processing_scripts import load_barrier_updates
-from processing_scripts import compute_mainstems
-from processing_scripts import assign_raw_z
-from processing_scripts import smooth_z
-from processing_scripts import compute_vertex_gradient
-from processing_scripts import compute_segment_gradient
-from processing_scripts import break_streams_at_barriers
-from processing_scripts import compute_updown_barriers_fish
-from processing_scripts import compute_accessibility
-from processing_scripts import assign_habitat
-from processing_scripts import compute_barriers_upstream_values
-from processing_scripts import compute_barrier_dci
-from processing_scripts import remove_isolated_flowpaths
-from processing_scripts import load_ais
-from processing_scripts import barrier_passability_view
-from processing_scripts import rank_barriers
+import pipeline
+import checkpoint
+import runstats
 
 
 iniSection = appconfig.args.args[0]
 
 workingWatershedId = appconfig.config[iniSection]['watershed_id']
 
-print ("Processing: " + workingWatershedId)
 
-load_parameters.main()
-preprocess_watershed.main()
-remove_isolated_flowpaths.main()
-load_and_snap_barriers_cabd.main()
-# load_and_snap_fishobservation.main()
-compute_modelled_crossings.main()
-load_barrier_updates.main()
-compute_mainstems.main()
-assign_raw_z.main()
-smooth_z.main()
-compute_vertex_gradient.main()
-load_habitat_access_updates.main()
-break_streams_at_barriers.main()
-print ("Recalculating elevations on broken streams: " + workingWatershedId)
-#re-assign elevations to broken streams
-assign_raw_z.main()
-smooth_z.main()
-compute_segment_gradient.main()
-compute_updown_barriers_fish.main()
-compute_accessibility.main()
-assign_habitat.main()
-process_habitat_access_updates.main()
-compute_barriers_upstream_values.main()
-load_ais.main()
-compute_barrier_dci.main()
-rank_barriers.main()
-barrier_passability_view.main()
+def main():
+    print ("Processing: " + workingWatershedId)
+
+    steps = pipeline.getSteps()
+    pipeline.buildGraph(steps)
+
+    manifest = checkpoint.getManifest()
+    external = checkpoint.ExternalInputs()
+    torun = checkpoint.planSteps(steps, manifest, pipeline.overlaps, appconfig.args.from_step, appconfig.args.to_step, external)
+
+    report = runstats.RunReport()
+    try:
+        pipeline.runSteps(torun, appconfig.workers, checkpoint.Checkpointer(manifest, steps, external), report)
+    finally:
+        print("Run report: " + report.write())
+
+    print ("Processing Complete: " + workingWatershedId)
+    print("Runtime: " + str((datetime.now() - startTime)))
+
 
-print ("Processing Complete: " + workingWatershedId)
-print("Runtime: " + str((datetime.now() - startTime)))
\ No newline at end of file
+# the elevation steps can start worker processes which import this script
+if __name__ == "__main__":
+    main()
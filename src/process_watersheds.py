@@ -0,0 +1,97 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script processes several watersheds at the same time. Each watershed
+# (config file section) is processed by process_watershed.py in its own
+# process with its own database connections; the output of each is written
+# to a log file in the run directory.
+#
+# Usage: process_watersheds.py -c config.ini [watershedid] [watershedid] ...
+#
+# Credentials are asked for once and passed to each process.
+#
+
+import appconfig
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+startTime = datetime.now()
+
+sections = appconfig.args.args
+
+runDirectory = appconfig.config['PROCESSING'].get('run_directory', fallback = 'runs')
+
+maxWatersheds = appconfig.args.max_watersheds
+if (maxWatersheds is None):
+    maxWatersheds = appconfig.config['PROCESSING'].getint('max_watersheds', fallback = 1)
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "process_watershed.py")
+
+
+def processWatershed(section):
+    """
+    Runs process_watershed.py for a single watershed and returns its exit code
+    """
+    command = [sys.executable, script, section]
+    if (appconfig.args.c):
+        command += ['-c', appconfig.args.c]
+    if (appconfig.args.workers is not None):
+        command += ['--workers', str(appconfig.args.workers)]
+    if (appconfig.args.from_step):
+        command += ['--from-step', appconfig.args.from_step]
+    if (appconfig.args.to_step):
+        command += ['--to-step', appconfig.args.to_step]
+
+    env = dict(os.environ)
+    env['PGUSER'] = appconfig.dbUser
+    env['PGPASSWORD'] = appconfig.dbPassword
+
+    logDirectory = os.path.join(runDirectory, section)
+    os.makedirs(logDirectory, exist_ok = True)
+    logFile = os.path.join(logDirectory, "process_watershed.log")
+
+    print("Starting watershed: " + section + " (log: " + logFile + ")")
+    start = datetime.now()
+    with open(logFile, "w") as log:
+        result = subprocess.run(command, env = env, stdout = log, stderr = subprocess.STDOUT)
+    print("Finished watershed: " + section + " exit code: " + str(result.returncode) + " (" + str(datetime.now() - start) + ")")
+
+    return result.returncode
+
+
+for section in sections:
+    if (not appconfig.config.has_section(section)):
+        sys.exit("No configuration section for watershed: " + section)
+
+print("Processing watersheds: " + ", ".join(sections) + " (" + str(maxWatersheds) + " at a time)")
+
+with ThreadPoolExecutor(max_workers = max(1, maxWatersheds)) as pool:
+    results = list(pool.map(processWatershed, sections))
+
+failed = [section for section, code in zip(sections, results) if code != 0]
+
+print("Runtime: " + str((datetime.now() - startTime)))
+
+if (failed):
+    sys.exit("Processing failed for watersheds: " + ", ".join(failed))
+
+print("Processing Complete: " + ", ".join(sections))
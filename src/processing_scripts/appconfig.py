@@ -93,6 +93,10 @@ if (proj != ""):
 
 psycopg2.extras.register_uuid()
 
+# function called with the cpu seconds used by worker processes for the
+# step running on the current thread, set by runstats.py
+workerCpu = None
+
 def connectdb():
     return pg2.connect(database=dbName,
                    user=dbUser,
@@ -24,14 +24,27 @@ import subprocess
 import appconfig
 import os
 import numpy
-import tifffile as tif
-import shapely.wkb
-import shapely.geometry
+import shapely
 from math import floor
 import json
 import psycopg2.extras
 from psycopg2.extras import RealDictCursor
 import ast
+import multiprocessing
+import time
+import tifffile as tif
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from processing_scripts import dem_reader
+    from processing_scripts import elevation_cache
+    from processing_scripts import dem_corridor
+    from processing_scripts import dem_raster
+except ImportError:
+    import dem_reader
+    import elevation_cache
+    import dem_corridor
+    import dem_raster
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -47,7 +60,25 @@ else:
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 demDir = appconfig.config['ELEVATION_PROCESSING']['dem_directory']
 
-demfiles = []
+# dem file details are saved here and only read again for files that changed
+runDirectory = appconfig.config['PROCESSING'].get('run_directory', fallback = 'runs')
+demIndexFile = appconfig.config['ELEVATION_PROCESSING'].get('dem_index_file', fallback = os.path.join(runDirectory, 'dem_index.json'))
+
+# geotiff key values
+RASTER_PIXEL_IS_POINT = 2
+USER_DEFINED = 32767
+GDAL_NODATA_TAG = 42113
+
+# number of processes sampling dem files at the same time
+demWorkers = appconfig.config['ELEVATION_PROCESSING'].getint('dem_workers', fallback = 1)
+
+# python samples the dem files, postgis computes the elevations in the
+# database (see dem_raster.py)
+ENGINES = ['python', 'postgis']
+demEngine = appconfig.config['ELEVATION_PROCESSING'].get('elevation_engine', fallback = 'python')
+
+demIndex = None
+elevationCache = None
 
 class DEMFile:
     def __init__(self, filename, xmin, ymin, xmax, ymax, xcellsize, ycellsize, xcnt, ycnt, srid, nodata):
@@ -63,6 +94,96 @@ class DEMFile:
         self.srid = srid
         self.nodata = nodata
 
+    def contains(self, x, y):
+        """
+        Works with single coordinates or numpy arrays
+        """
+        return (self.xmin <= x) & (self.xmax >= x) & (self.ymin <= y) & (self.ymax >= y)
+
+
+class DemIndex:
+    """
+    The dem files as a single surface (mosaic). A cell value is read from
+    the first file (in index order) containing the cell center and a vertex
+    is sampled with the first file containing it, using cells from the
+    neighbouring files if it is near the edge of the file.
+
+    The files are put in the cells of a grid (the size of the largest file)
+    so only the files near a point are checked.
+
+    If corridor is set the cells are read from the dem corridor extract
+    (see dem_corridor.py) instead of the dem files.
+    """
+
+    def __init__(self, demfiles, corridor = None):
+        self.demfiles = demfiles
+        self.corridor = corridor
+        self.order = {demfile.filename: i for i, demfile in enumerate(demfiles)}
+        self.cellsize = max([max(f.xmax - f.xmin, f.ymax - f.ymin) for f in demfiles], default = 1)
+        self.cells = dict()
+        for i, demfile in enumerate(demfiles):
+            for cell in self.gridCells(demfile.xmin, demfile.ymin, demfile.xmax, demfile.ymax):
+                self.cells.setdefault(cell, []).append(i)
+
+    def reader(self, filename):
+        """
+        Returns the reader for the cells of the dem file
+        """
+        if self.corridor is not None:
+            return self.corridor.reader(filename)
+        return dem_reader.getReader(filename)
+
+    def gridCells(self, xmin, ymin, xmax, ymax):
+        for cx in range(floor(xmin / self.cellsize), floor(xmax / self.cellsize) + 1):
+            for cy in range(floor(ymin / self.cellsize), floor(ymax / self.cellsize) + 1):
+                yield (cx, cy)
+
+    def overlapping(self, xmin, ymin, xmax, ymax):
+        """
+        Returns the files overlapping the box, in index order
+        """
+        found = set()
+        for cell in self.gridCells(xmin, ymin, xmax, ymax):
+            found.update(self.cells.get(cell, []))
+        files = [self.demfiles[i] for i in sorted(found)]
+        return [f for f in files if f.xmin <= xmax and f.xmax >= xmin and f.ymin <= ymax and f.ymax >= ymin]
+
+    def home(self, x, y, demfile):
+        """
+        Returns a mask of the vertices sampled with the dem file: the
+        vertices in the file that are not in a file before it
+        """
+        mask = demfile.contains(x, y)
+        for other in self.overlapping(demfile.xmin, demfile.ymin, demfile.xmax, demfile.ymax):
+            if (self.order[other.filename] >= self.order[demfile.filename]):
+                break
+            mask &= ~other.contains(x, y)
+        return mask
+
+    def values(self, x, y):
+        """
+        Returns the values of the cells with centers x, y from the first
+        file containing each center; NODATA where no file contains the
+        center or the cell has no data
+        """
+        values = numpy.full(len(x), appconfig.NODATA, dtype = numpy.float64)
+        if (len(x) == 0):
+            return values
+
+        found = numpy.zeros(len(x), dtype = bool)
+        for demfile in self.overlapping(x.min(), y.min(), x.max(), y.max()):
+            xindex = numpy.floor((x - demfile.xmin) / demfile.xcellsize).astype(numpy.int64)
+            yindex = demfile.ycnt - numpy.floor((y - demfile.ymin) / abs(demfile.ycellsize)).astype(numpy.int64) - 1
+            #cells on the right or bottom edge of the file are not in it
+            mask = (~found & demfile.contains(x, y) &
+                    (xindex >= 0) & (xindex < demfile.xcnt) & (yindex >= 0) & (yindex < demfile.ycnt))
+            if not mask.any():
+                continue
+            cells = self.reader(demfile.filename)[yindex[mask], xindex[mask]]
+            values[mask] = numpy.where(cells == demfile.nodata, appconfig.NODATA, cells)
+            found |= mask
+        return values
+
 def getWatershedIds(conn):
     
     publicSchema = "public"
@@ -111,20 +232,121 @@ def prepareOutput(conn):
     conn.commit()
     
 
+def loadDemIndex():
+    if not os.path.exists(demIndexFile):
+        return dict()
+    try:
+        with open(demIndexFile) as file:
+            return json.load(file)
+    except ValueError:
+        print("    dem index " + demIndexFile + " could not be read, rebuilding")
+        return dict()
+
+def saveDemIndex(entries):
+    directory = os.path.dirname(demIndexFile)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    # several watersheds can be processed at the same time so
+    # write to a temporary file and replace the index in one step
+    tempFile = demIndexFile + "." + str(os.getpid())
+    with open(tempFile, "w") as file:
+        json.dump(entries, file, indent = 2)
+    os.replace(tempFile, demIndexFile)
+
 def indexDem():
     #read all files in dem
     #get bounds
     #build index of 
     print("indexing dem files")
+    cached = loadDemIndex()
+    entries = dict()
     demfiles = []
-    for demfile in os.listdir(demDir):
+    for demfile in sorted(os.listdir(demDir)):
         if (demfile.endswith('.tif') or demfile.endswith('.tiff')):
-            demfiles.append(getFileDetails(os.path.join(demDir,demfile)))
-    return demfiles
+            filename = os.path.join(demDir,demfile)
+            stat = os.stat(filename)
+            entry = cached.get(filename)
+            if (entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size):
+                entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'details': vars(getFileDetails(filename))}
+            entries[filename] = entry
+            demfiles.append(DEMFile(**entry['details']))
+
+    if (entries != cached):
+        saveDemIndex(entries)
+    return demfiles, elevation_cache.demVersion(list(entries.values()))
+
+def loadDem():
+    """
+    Loads the dem file details and the dem corridor extract (if it is used)
+    :returns: the dem index of the files and the dem version
+    """
+    corridor = dem_corridor.load()
+
+    if not os.path.isdir(demDir):
+        if corridor is None:
+            raise Exception("dem directory " + demDir + " not found")
+        print("dem directory " + demDir + " not found, using the dem corridor extract")
+        return DemIndex([DEMFile(**details) for details in corridor.demfiles()], corridor), corridor.version
+
+    demfiles, version = indexDem()
+    if corridor is not None and corridor.version != version:
+        print("    dem files changed since the dem corridor extract was built, reading the dem files")
+        corridor = None
+    return DemIndex(demfiles, corridor), version
   
 def getFileDetails(demfile):
     print("    reading: " + demfile)
     
+    details = getGeoTiffDetails(demfile)
+    if details is not None:
+        return details
+    return getGdalDetails(demfile)
+
+def getGeoTiffDetails(demfile):
+    """
+    Reads the file details from the geotiff tags
+    :returns: the details or None if the tags are not supported (the
+    details are then read with gdalinfo)
+    """
+    with tif.TiffFile(demfile) as tiff:
+        page = tiff.pages[0]
+        geotags = page.geotiff_tags
+        nodatatag = page.tags.get(GDAL_NODATA_TAG)
+        if (not geotags or nodatatag is None or 'ModelTransformation' in geotags or
+            'ModelPixelScale' not in geotags or 'ModelTiepoint' not in geotags):
+            return None
+
+        srid = geotags.get('ProjectedCSTypeGeoKey', geotags.get('GeographicTypeGeoKey'))
+        try:
+            srid = int(srid)
+        except (TypeError, ValueError):
+            return None
+        if (srid == USER_DEFINED):
+            return None
+
+        scale = geotags['ModelPixelScale']
+        tiepoint = geotags['ModelTiepoint']
+        xcnt = page.imagewidth
+        ycnt = page.imagelength
+
+        #upper left corner of the upper left cell (same as gdal)
+        xmin = float(tiepoint[3] - tiepoint[0] * scale[0])
+        ymax = float(tiepoint[4] + tiepoint[1] * scale[1])
+        if (int(geotags.get('GTRasterTypeGeoKey', 1)) == RASTER_PIXEL_IS_POINT):
+            xmin -= 0.5 * scale[0]
+            ymax += 0.5 * scale[1]
+        xmax = xmin + xcnt * scale[0]
+        ymin = ymax - ycnt * scale[1]
+
+        nodata = float(str(nodatatag.value).strip('\x00 '))
+
+    xsize = (xmax - xmin) / xcnt
+    ysize = (ymax - ymin) / ycnt
+
+    return DEMFile(demfile, xmin, ymin, xmax, ymax, xsize, ysize, xcnt, ycnt, str(srid), nodata)
+
+def getGdalDetails(demfile):
+    
     out = subprocess.run("\"" + appconfig.gdalsrsinfo + "\" -e -o epsg " + "\"" + demfile + "\"", capture_output=True)
     srid = out.stdout.decode('utf-8').split(':')[1].strip()
     
@@ -152,10 +374,7 @@ def getFileDetails(demfile):
 
     return DEMFile(demfile, xmin, ymin, xmax,ymax, xsize, ysize, xcnt, ycnt, srid, nodata)
 
-def processArea(demfile, connection, watershed_id, onlymissing = False):
-    print("    processing: " + (demfile.filename))
-    
-    #get edges
+def getStreamSrid(connection):
     query = f"""
         SELECT srid 
         FROM public.geometry_columns
@@ -164,74 +383,44 @@ def processArea(demfile, connection, watershed_id, onlymissing = False):
         f_table_name = '{dbTargetTable}' and 
         f_geometry_column = '{appconfig.dbGeomField}'
     """
-    srid = -9999
-    
     with connection.cursor() as cursor:
         cursor.execute(query)
-        srid = cursor.fetchone()[0]
+        return cursor.fetchone()[0]
+
+def processArea(demfile, connection, watershed_id):
+    print("    processing: " + (demfile.filename))
     
-    if onlymissing: 
-        #only load features with at least one missing elevation values  
-        query = f"""
-            WITH ids AS (
-                SELECT distinct id FROM (
-                    SELECT {appconfig.dbIdField}, st_z ((ST_DumpPoints({dbTargetGeom})).geom ) AS z 
-                    FROM {dbTargetSchema}.{dbTargetTable}
-                ) foo WHERE foo.z = {appconfig.NODATA}
-            ),
-            env AS (
-                SELECT st_transform(
-                  st_setsrid(
-                    st_makebox2d(st_point({demfile.xmin}, {demfile.ymin}), st_point({demfile.xmax}, {demfile.ymax})), 
-                      {demfile.srid}
-                  ),{srid}
-                ) as bbox
-            )
-            SELECT t.{appconfig.dbIdField} as id, st_transform(t.{dbTargetGeom}, {demfile.srid}) as geometry
-            FROM {dbTargetSchema}.{dbTargetTable} t, env
-            WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} IN {watershed_id}
-            AND t.{appconfig.dbIdField} in (select id from ids);
-        """
-    else:
-        #load all features
-        query = f"""
-            WITH
-            env AS (
-                SELECT st_transform(
-                  st_setsrid(
-                    st_makebox2d(st_point({demfile.xmin}, {demfile.ymin}), st_point({demfile.xmax}, {demfile.ymax})), 
-                      {demfile.srid}
-                  ),{srid}
-                ) as bbox
-            )
-            SELECT t.{appconfig.dbIdField} as id, st_transform(t.{dbTargetGeom}, {demfile.srid}) as geometry
-            FROM {dbTargetSchema}.{dbTargetTable} t, env
-            WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} IN {watershed_id}
-        """
+    #get edges
+    srid = getStreamSrid(connection)
+    
+    #load all features
+    query = f"""
+        WITH
+        env AS (
+            SELECT st_transform(
+              st_setsrid(
+                st_makebox2d(st_point({demfile.xmin}, {demfile.ymin}), st_point({demfile.xmax}, {demfile.ymax})), 
+                  {demfile.srid}
+              ),{srid}
+            ) as bbox
+        )
+        SELECT t.{appconfig.dbIdField} as id, st_transform(t.{dbTargetGeom}, {demfile.srid}) as geometry
+        FROM {dbTargetSchema}.{dbTargetTable} t, env
+        WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} IN {watershed_id}
+    """
     # print(query)
 
-    newvalues = [] 
-    
     with connection.cursor() as cursor:
-        
-            cursor.execute(query)
-            features = cursor.fetchall()
-            if (len(features) == 0):
-                return
-            print("      reading dem")
-            imarray = numpy.array(tif.imread(demfile.filename))
-            
-            print("      processing")
-            for feature in features:
-                geom = shapely.wkb.loads(feature[1] , hex=True)
-                fid = feature[0]
-                #print("processing: " + str(fid))
-                ls = processGeometry(geom, demfile, imarray, onlymissing)
-                newvalues.append(  (shapely.wkb.dumps(ls), fid) )
-                
-            imarray = None
-            connection.commit()
-    
+        cursor.execute(query)
+        features = cursor.fetchall()
+    connection.commit()
+
+    if (len(features) == 0):
+        return
+
+    print("      processing")
+    newvalues = processFeatures(features, demfile, demIndex.reader(demfile.filename), demIndex, elevationCache)
+
     print("      saving results")
     updatequery = f"""
         UPDATE {dbTargetSchema}.{dbTargetTable} 
@@ -246,21 +435,271 @@ def processArea(demfile, connection, watershed_id, onlymissing = False):
     
     
     
-def processGeometry(geom, demfile, demdata, onlymissing):
-    
-    newpnts = []
-    for c in geom.coords:
-        x = c[0]
-        y = c[1]
-        z = c[2]
-        newpnts.append(processCoordinate(x, y, z, demfile, demdata, onlymissing))
-            
-    #make a geometry from newpnts
-    ls = shapely.geometry.LineString(newpnts)
-    return ls   
+def processAreas(demfiles, connection, watershed_id):
+    """
+    Computes the elevations for all the dem files using demWorkers
+    processes. Features are assigned to the dem files up front; each
+    process samples the vertices of one file at a time and the results
+    are applied in dem file order (so the values are the same as calling
+    processArea for each file) and written with this connection as soon
+    as all the files a feature overlaps are done.
+    """
+    srid = getStreamSrid(connection)
+    demsrid = demfiles[0].srid
+
+    print("    assigning features to dem files")
+    boxes = ",".join([f"""({i}, st_transform(st_setsrid(st_makebox2d(st_point({demfile.xmin}, {demfile.ymin}), st_point({demfile.xmax}, {demfile.ymax})), {demfile.srid}), {srid}))"""
+        for i, demfile in enumerate(demfiles)])
+    query = f"""
+        WITH env (tile, bbox) AS (
+            VALUES {boxes}
+        ),
+        tiles AS (
+            SELECT t.{appconfig.dbIdField} as id, array_agg(env.tile ORDER BY env.tile) as tiles
+            FROM {dbTargetSchema}.{dbTargetTable} t, env
+            WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} IN {watershed_id}
+            GROUP BY t.{appconfig.dbIdField}
+        )
+        SELECT t.{appconfig.dbIdField}, st_transform(t.{dbTargetGeom}, {demsrid}), tiles.tiles
+        FROM {dbTargetSchema}.{dbTargetTable} t JOIN tiles ON tiles.id = t.{appconfig.dbIdField}
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+    connection.commit()
 
+    if (len(features) == 0):
+        return
 
-def processCoordinate(x, y, z, demfile, demdata, onlymissing):
+    fids = [feature[0] for feature in features]
+    geoms = shapely.from_wkb([feature[1] for feature in features])
+    coords = shapely.get_coordinates(geoms, include_z = True)
+    counts = shapely.get_num_coordinates(geoms)
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+
+    # vertices already in the elevation cache are not sampled again
+    found, cached = elevationCache.lookup(demsrid, coords[:, 0], coords[:, 1])
+    hit = found & ~numpy.isnan(cached)
+    coords[hit, 2] = cached[hit]
+
+    # features and vertex positions (that are not in the cache) for each dem file
+    tileFeatures = [[] for demfile in demfiles]
+    for feature, tiles in enumerate([feature[2] for feature in features]):
+        for tile in tiles:
+            tileFeatures[tile].append(feature)
+    tiles = []
+    positions = []
+    for tile in range(len(demfiles)):
+        if not tileFeatures[tile]:
+            continue
+        tilepositions = numpy.concatenate([numpy.arange(offsets[f], offsets[f + 1]) for f in tileFeatures[tile]])
+        tilepositions = tilepositions[~found[tilepositions]]
+        if (len(tilepositions) > 0):
+            tiles.append(tile)
+            positions.append(tilepositions)
+
+    remaining = numpy.zeros(len(features), dtype = numpy.int64)
+    for tile in tiles:
+        remaining[tileFeatures[tile]] += 1
+
+    updatequery = f"""
+        UPDATE {dbTargetSchema}.{dbTargetTable} 
+        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{srid})
+        WHERE {appconfig.dbIdField} = %s
+    """
+
+    def writeFeatures(done):
+        donepositions = numpy.concatenate([numpy.arange(offsets[f], offsets[f + 1]) for f in done])
+        lines = shapely.linestrings(coords[donepositions], indices = numpy.repeat(numpy.arange(len(done)), counts[done]))
+        newvalues = list(zip(shapely.to_wkb(lines), [fids[f] for f in done]))
+        with connection.cursor() as cursor:
+            psycopg2.extras.execute_batch(cursor, updatequery, newvalues)
+        connection.commit()
+
+    # features with all their vertices in the cache
+    done = numpy.flatnonzero(remaining == 0)
+    if (len(done) > 0):
+        writeFeatures(done)
+    if not tiles:
+        return
+
+    # the worker processes connect with the same credentials if they
+    # have to load appconfig
+    os.environ['PGUSER'] = appconfig.dbUser
+    os.environ['PGPASSWORD'] = appconfig.dbPassword
+
+    print(f"""    sampling {len(tiles)} dem files with {demWorkers} processes""")
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers = demWorkers, mp_context = context) as pool:
+        results = pool.map(sampleTile, [demfiles[tile] for tile in tiles], [demIndex for tile in tiles],
+            [coords[p, 0] for p in positions], [coords[p, 1] for p in positions])
+
+        for tile, tilepositions, (home, idx, values, stats, cpu) in zip(tiles, positions, results):
+            print("    processed: " + demfiles[tile].filename)
+            coords[tilepositions[idx], 2] = values
+            dem_reader.cache.add(stats)
+            # the sampling cpu time is counted in the step's run report
+            if appconfig.workerCpu is not None:
+                appconfig.workerCpu(cpu)
+            addToCache(elevationCache, demsrid, coords[:, 0], coords[:, 1], tilepositions, home, idx, values)
+
+            remaining[tileFeatures[tile]] -= 1
+            done = [f for f in tileFeatures[tile] if remaining[f] == 0]
+            if done:
+                writeFeatures(done)
+
+
+def sampleTile(demfile, mosaic, x, y):
+    """
+    Samples the vertices in one dem file (run in the worker processes)
+    :returns: the positions of the vertices sampled with the file, the
+    positions of the vertices with new values, the values, the dem
+    block cache statistics and the cpu seconds used
+    """
+    cpuStart = time.process_time()
+    before = dem_reader.cache.counters()
+    home, idx, values = sampleCells(x, y, demfile, mosaic.reader(demfile.filename), mosaic)
+    after = dem_reader.cache.counters()
+    return home.nonzero()[0], idx, values, [a - b for a, b in zip(after, before)], time.process_time() - cpuStart
+
+
+def addToCache(cache, srid, x, y, positions, home, idx, values):
+    """
+    Adds the vertices sampled with a dem file to the elevation cache
+    (vertices without a new value are added as nan)
+    :param positions: positions in x and y of the vertices given to sampleCells
+    :param home: mask or positions (in positions) of the vertices sampled with the file
+    :param idx: positions (in positions) of the vertices with new values
+    """
+    cached = numpy.full(len(positions), numpy.nan)
+    cached[idx] = values
+    cache.add(srid, x[positions[home]], y[positions[home]], cached[home])
+
+
+def processFeatures(features, demfile, demdata, mosaic, cache = None):
+    """
+    Computes the elevations of all the vertices of the features at once
+    :param features: list of (id, geometry hex wkb) rows
+    :param cache: the elevation cache (optional)
+    :returns: list of (geometry wkb, id) tuples
+    """
+    fids = [feature[0] for feature in features]
+    geoms = shapely.from_wkb([feature[1] for feature in features])
+
+    coords = shapely.get_coordinates(geoms, include_z = True)
+    coords[:, 2] = sampleCoordinates(coords[:, 0], coords[:, 1], coords[:, 2], demfile, demdata, mosaic, cache)
+
+    featureIndex = numpy.repeat(numpy.arange(len(geoms)), shapely.get_num_coordinates(geoms))
+    lines = shapely.linestrings(coords, indices = featureIndex)
+
+    return list(zip(shapely.to_wkb(lines), fids))
+
+
+def sampleCoordinates(x, y, z, demfile, demdata, mosaic, cache = None):
+    """
+    Vectorized version of processCoordinate for arrays of vertices
+    :param mosaic: the DemIndex of all the dem files
+    :param cache: the elevation cache (optional); vertices in the cache
+    are not sampled and the sampled vertices are added to it
+    :returns: array of the new z values
+    """
+    newz = numpy.array(z, dtype = numpy.float64)
+    positions = numpy.arange(len(newz))
+    if cache is not None:
+        found, cached = cache.lookup(demfile.srid, x, y)
+        hit = found & ~numpy.isnan(cached)
+        newz[hit] = cached[hit]
+        positions = positions[~found]
+
+    home, idx, values = sampleCells(x[positions], y[positions], demfile, demdata, mosaic)
+    newz[positions[idx]] = values
+
+    if cache is not None:
+        addToCache(cache, demfile.srid, x, y, positions, home, idx, values)
+    return newz
+
+
+def sampleCells(x, y, demfile, demdata, mosaic):
+    """
+    Computes the bilinear interpolated elevations of the vertices sampled
+    with this dem file (see DemIndex.home). Cells that are not in the file
+    are read from the other files in the mosaic, so vertices near the edge
+    of the file get a value without a second pass.
+    :returns: mask of the vertices sampled with the file, the positions of
+    the vertices that get a new value and the values
+    """
+    #type python computes (python float * dem value) in, so the
+    #interpolated values are the same as processCoordinate's
+    calcType = (demdata.dtype.type(0) * 1.0).dtype
+
+    xindex = numpy.floor((x - demfile.xmin) / demfile.xcellsize).astype(numpy.int64)
+    yindex = demfile.ycnt - numpy.floor((y - demfile.ymin) / abs(demfile.ycellsize)).astype(numpy.int64) - 1
+
+    centerx = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
+    centery = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
+
+    xindex2 = numpy.where(x < centerx, xindex - 1, xindex + 1)
+    yindex2 = numpy.where(y < centery, yindex + 1, yindex - 1)
+
+    home = mosaic.home(x, y, demfile)
+
+    idx = home.nonzero()[0]
+    x = x[idx]
+    y = y[idx]
+    xindex = xindex[idx]
+    yindex = yindex[idx]
+    xindex2 = xindex2[idx]
+    yindex2 = yindex2[idx]
+
+    x1 = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
+    x2 = xindex2 * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
+    y1 = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
+    y2 = (demfile.ycnt - yindex2 -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
+
+    zx1y1 = cellValues(yindex, xindex, x1, y1, demfile, demdata, mosaic, calcType)
+    zx2y1 = cellValues(yindex, xindex2, x2, y1, demfile, demdata, mosaic, calcType)
+    zx2y2 = cellValues(yindex2, xindex2, x2, y2, demfile, demdata, mosaic, calcType)
+    zx1y2 = cellValues(yindex2, xindex, x1, y2, demfile, demdata, mosaic, calcType)
+
+    #same checks as processCoordinate; vertices with cells outside of
+    #all the files are left as is
+    nodata = (zx1y1 == appconfig.NODATA) | (zx2y1 == appconfig.NODATA) | (zx2y2 == appconfig.NODATA) | (zx1y2 == appconfig.NODATA)
+    demnodata = (zx1y1 == demfile.nodata) | (zx2y1 == demfile.nodata) | (zx2y2 == demfile.nodata) | (zx1y2 == demfile.nodata)
+
+    #bilinear interpolation of elevation
+    wx2 = ((x2 - x) / (x2 - x1)).astype(calcType)
+    wx1 = ((x - x1) / (x2 - x1)).astype(calcType)
+    wy2 = ((y2 - y) / (y2 - y1)).astype(calcType)
+    wy1 = ((y - y1) / (y2 - y1)).astype(calcType)
+    fxy1 = wx2 * zx1y1 + wx1 * zx2y1
+    fxy2 = wx2 * zx1y2 + wx1 * zx2y2
+    fxy = wy2 * fxy1 + wy1 * fxy2
+
+    fxy = numpy.where(demnodata, appconfig.NODATA, fxy.astype(numpy.float64))
+    return home, idx[~nodata], fxy[~nodata]
+
+
+def cellValues(rows, cols, centerx, centery, demfile, demdata, mosaic, calcType):
+    """
+    Returns the values of the cells, reading the cells outside of the
+    dem file from the mosaic (by their center coordinates)
+    """
+    infile = (rows >= 0) & (rows < demfile.ycnt) & (cols >= 0) & (cols < demfile.xcnt)
+    values = numpy.empty(len(rows), dtype = calcType)
+    values[infile] = demdata[rows[infile], cols[infile]]
+    outside = ~infile
+    if outside.any():
+        values[outside] = mosaic.values(centerx[outside], centery[outside])
+    return values
+
+
+def processCoordinate(x, y, z, demfile, demdata):
+    """
+    Computes the elevation of a single vertex in the dem file (vertices
+    that need cells outside of the file are left as is). sampleCells does
+    the same for arrays of vertices and is used for processing; this is
+    kept as the reference for benchmark_dem_sampling.py.
+    """
 
     #find the dem cell and use that for now
     xindex = floor((x - demfile.xmin) / demfile.xcellsize)
@@ -279,48 +718,26 @@ def processCoordinate(x, y, z, demfile, demdata, onlymissing):
     else:
         yindex2 = yindex - 1
      
-    
-    if (onlymissing == False):
-        #if out of range return no data for now - we will go back and deal with 
-        #points that require multiple files later
-        #often dem files will overlap a bit so this edge will
-        #be processed by another area
-        if (xindex < 0 or xindex >= demfile.xcnt or yindex < 0 or yindex >= demfile.ycnt  or
-            xindex2 < 0 or xindex2 >= demfile.xcnt or yindex2 < 0 or yindex2 >= demfile.ycnt ): 
-            return [x, y, z]
-   
+    if (xindex < 0 or xindex >= demfile.xcnt or yindex < 0 or yindex >= demfile.ycnt  or
+        xindex2 < 0 or xindex2 >= demfile.xcnt or yindex2 < 0 or yindex2 >= demfile.ycnt ): 
+        return [x, y, z]
     
     x1 = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
     x2 = xindex2 * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
     y1 = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
     y2 =  (demfile.ycnt - yindex2 -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
     
-    if (xindex >= 0 and yindex >= 0 and xindex < demfile.xcnt and yindex < demfile.ycnt):
-        zx1y1 = demdata[yindex][xindex]
-    else:
-        zx1y1 = findElevation(x1, y1)
-        
-    if (xindex2 >= 0 and yindex >= 0 and xindex2 < demfile.xcnt and yindex < demfile.ycnt):
-        zx2y1 = demdata[yindex][xindex2]
-    else:
-        zx2y1 = findElevation(x2, y1)
-        
-    if (xindex2 >= 0 and yindex2 >= 0 and xindex2 < demfile.xcnt and yindex2 < demfile.ycnt):
-        zx2y2 = demdata[yindex2][xindex2]
-    else:
-        zx2y2 = findElevation(x2, y2)
-        
-    if (xindex >= 0 and yindex2 >= 0 and xindex < demfile.xcnt and yindex2 < demfile.ycnt):    
-        zx1y2 = demdata[yindex2][xindex]
-    else:
-        zx1y2 = findElevation(x1, y2)
+    zx1y1 = demdata[yindex, xindex]
+    zx2y1 = demdata[yindex, xindex2]
+    zx2y2 = demdata[yindex2, xindex2]
+    zx1y2 = demdata[yindex2, xindex]
                 
-    if (zx1y1 == appconfig.NODATA or zx1y2 == appconfig.NODATA or zx2y2 == appconfig.NODATA or zx1y2 == appconfig.NODATA):
+    if (zx1y1 == appconfig.NODATA or zx2y1 == appconfig.NODATA or zx2y2 == appconfig.NODATA or zx1y2 == appconfig.NODATA):
         #no data for this points
         return [x,y,z]
                
     if (zx1y1 == demfile.nodata or zx2y1 == demfile.nodata or
-        zx2y1 == demfile.nodata or zx2y2 == demfile.nodata ):
+        zx1y2 == demfile.nodata or zx2y2 == demfile.nodata ):
         #not enough data to determine
         return [x, y, appconfig.NODATA]
         
@@ -332,22 +749,44 @@ def processCoordinate(x, y, z, demfile, demdata, onlymissing):
     return [x,y,fxy]
 
 
-def findElevation(x, y):
-    #search through all dem files for elevation at that point
-    #determine by dropping coordinate into dem; should be centered if all dem's are the same
-    #but if not won't worry about it for these purposes
-    for demfile in demfiles:
-        if (demfile.xmin <= x and demfile.xmax >= x and demfile.ymin <= y and demfile.ymax >= y ):
-            #read file
-            xindex = floor((x - demfile.xmin) / demfile.xcellsize)
-            yindex = demfile.ycnt - floor((y - demfile.ymin) / abs(demfile.ycellsize)) - 1
-            
-            memmap_image = tif.memmap(demfile.filename)
-            z = memmap_image[yindex][xindex]
-            del memmap_image
-            return z
-    
-    return appconfig.NODATA    
+def computeElevations(conn, watershed_id, engine, useCache = True):
+    """
+    Computes the elevations of the stream vertices with the engine
+    :param engine: python or postgis (see ENGINES)
+    :param useCache: if False the elevation cache is not used (python engine)
+    """
+    global demIndex
+    global elevationCache
+
+    if engine not in ENGINES:
+        raise Exception("Unknown elevation_engine " + engine + ". Engines are: " + ", ".join(ENGINES))
+
+    demIndex, demversion = loadDem()
+    demfiles = demIndex.demfiles
+    elevationCache = elevation_cache.ElevationCache(demversion if useCache else None)
+    if useCache:
+        elevationCache.load()
+
+    print("Computing Elevations")
+    if (engine == 'postgis'):
+        if (len(set(demfile.srid for demfile in demfiles)) != 1):
+            raise Exception("The postgis elevation engine requires all the dem files to have the same projection")
+        dem_raster.loadRasters(conn, demfiles, demversion)
+        dem_raster.assignElevations(conn, demfiles, watershed_id)
+        return
+
+    #process each dem file
+    if (demWorkers > 1 and len(demfiles) > 1 and len(set(demfile.srid for demfile in demfiles)) == 1):
+        processAreas(demfiles, conn, watershed_id)
+    else:
+        for demfile in demfiles:
+            processArea(demfile, conn, watershed_id)
+
+    if useCache:
+        elevationCache.save()
+    print("  " + dem_reader.cache.report())
+    print("  " + elevationCache.report())
+
 
 #--- main program ---
 def main():
@@ -358,20 +797,10 @@ def main():
         
         watershed_id = getWatershedIds(conn)
     
-        demfiles = indexDem()
-        
-        #process each dem file
-        print("Computing Elevations")
-        for demfile in demfiles:
-            processArea(demfile, conn, watershed_id)
-    
-        #search for any missing coordinates that may require 
-        #multiple dem files to compute
-        #if we have one giant dem file then ignore this
-        if (len(demfiles) > 1):
-            print ("  computing overlap areas")
-            for demfile in demfiles:
-                processArea(demfile, conn, watershed_id, True)
+        computeElevations(conn, watershed_id, demEngine)
+
+    dem_reader.closeReaders()
+    dem_corridor.closeReaders()
 
     print("done")
 
@@ -21,10 +21,16 @@
 # ASSUMPTION - data is in equal area projection where distance functions return values in metres
 #
 import appconfig
-from imagecodecs.imagecodecs import NONE
 
 import sys
 
+try:
+    from processing_scripts import stream_network
+    from processing_scripts import vertex_profiles
+except ImportError:
+    import stream_network
+    import vertex_profiles
+
 iniSection = appconfig.args.args[0]
 dataSchema = appconfig.config['DATABASE']['data_schema']
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -56,28 +62,6 @@ w2 = 0.75
 #         cursor.execute(query)
 #         specCodes = cursor.fetchall()
 
-def insertPassability(conn, passability_data):
-    """
-    Insert data into the barrier_passability table
-    """
-    if len(passability_data) == 0:
-        return
-
-    insertquery = f"""
-        INSERT INTO {dbTargetSchema}.barrier_passability (
-            barrier_id
-            ,species_id
-            ,species_code
-            ,passability_status
-        )
-        VALUES(%s, %s, %s, %s);
-    """
-
-    with conn.cursor() as cursor:
-        for feature in passability_data:
-            cursor.execute(insertquery, feature)
-    conn.commit()
-
 def breakstreams (conn):
         
     # find all break points
@@ -126,8 +110,8 @@ def breakstreams (conn):
 
     query = f"""
         SELECT accessibility_gradient as minvalue, code
-        FROM {appconfig.dataSchema}.{appconfig.fishSpeciesTable}
-        WHERE accessibility_gradient = (SELECT min(accessibility_gradient) FROM {appconfig.dataSchema}.{appconfig.fishSpeciesTable});
+        FROM {dataSchema}.{appconfig.fishSpeciesTable}
+        WHERE accessibility_gradient = (SELECT min(accessibility_gradient) FROM {dataSchema}.{appconfig.fishSpeciesTable});
     """
     
     mingradient = -1
@@ -138,138 +122,64 @@ def breakstreams (conn):
         features = cursor.fetchall()
         mingradient = features[0][0]
         code = features[0][1]
-        
-    query = f"""    
-        SELECT mainstem_id, st_Force2d(vertex_pnt), gradient
-        FROM {dbTargetSchema}.{dbVertexTable}
-        ORDER BY mainstem_id, downstream_route_measure
-    """
-        
-    with conn.cursor() as cursor:
-        cursor.execute(query)
-        
-        features = cursor.fetchall()
-        
-        lastmainstem = NONE
-        lastgradient = -1
-        
-        for feature in features:
-            mainstem = feature[0]
-            point = feature[1]
-            gradient = feature[2]
-            
-            insert = False
-            if (lastmainstem != mainstem and gradient > mingradient):
-                #we need to find what the gradient is at the downstream point here
-                # and only add this as a break point
-                # if downstream vertex is < 0.15
-                query = f"""
-                
-                    with pnt as (
-                        SELECT st_endpoint(a.geometry) as endpnt
-                        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-                        WHERE st_intersects( a.geometry, '{point}')
-                    )
-                    SELECT gradient
-                    FROM {dbTargetSchema}.{dbVertexTable} a, pnt
-                    WHERE a.vertex_pnt && pnt.endpnt
-                    AND gradient <= {mingradient}
-                """ 
-                #print(query)
-                with conn.cursor() as cursor3:
-                    cursor3.execute(query)
-                    features3 = cursor3.fetchall()
-                    if (len(features3) > 0):
-                        insert = True
-    
-                
 
-            elif (gradient > mingradient) and \
-                not((lastgradient > mingradient and gradient > mingradient and lastmainstem == mainstem)):
-                
-                insert = True
-            
-            if insert:
-                # this is a point that is not the first point on a new mainstem 
-                # has a gradient larger than required values
-                # and has a downstream gradient that is less than required values  
-                query = f"""INSERT INTO {dbTargetSchema}.{dbGradientBarrierTable} (point, id, type, passability_status_{code}) values ('{point}', gen_random_uuid(), 'gradient_barrier', 0);""" 
-                with conn.cursor() as cursor2:
-                    cursor2.execute(query)
-
-                # set gradient barriers to be passable for all other species
-                for species in specCodes:
-                    if species[0] != code:
-                        foo = species[0]
-                        col = "passability_status_" + foo
-                        query = f"""
-                            UPDATE {dbTargetSchema}.{dbGradientBarrierTable} SET {col} = 1;
-                        """
-                        with conn.cursor() as cursor2:
-                            cursor2.execute(query)
-                    else:
-                        continue
-
-            lastmainstem = mainstem
-            lastgradient = gradient
-
-        # add gradient barriers to passability table
-        query = f"""
+    # a gradient barrier is added at the start of each run of vertices along
+    # a mainstem with a gradient above the minimum species gradient, at the
+    # first vertex of a mainstem only if the vertex of the mainstem it flows
+    # into is not above there (see vertex_profiles.downstreamGradientsQuery).
+    # The barriers are impassable for the species with the minimum gradient
+    # and passable for all others.
+    passabilityValues = ", ".join(["0" if species[0] == code else "1" for species in specCodes])
+    query = f"""
+        WITH vertices AS (
+            {vertex_profiles.vertexRowsQuery()}
+        ),
+        runs AS (
+            SELECT mainstem, vertex_index, gradient,
+                lag(gradient) OVER (PARTITION BY mainstem ORDER BY downstream_route_measure, vertex_index) as lastgradient
+            FROM vertices
+        ),
+        candidates AS (
+            SELECT mainstem, vertex_index, lastgradient
+            FROM runs
+            WHERE gradient > {mingradient}
+            AND (lastgradient IS NULL OR lastgradient <= {mingradient})
+        ),
+        points AS (
+            {vertex_profiles.vertexPointsQuery("candidates")}
+        ),
+        breaks AS (
+            SELECT c.point
+            FROM points c
+            WHERE c.lastgradient IS NOT NULL
+            OR EXISTS (
+                SELECT 1
+                FROM ({vertex_profiles.downstreamGradientsQuery("c.mainstem", "c.point")}) d
+                WHERE d.gradient <= {mingradient}
+            )
+        ),
+        inserted AS (
+            INSERT INTO {dbTargetSchema}.{dbGradientBarrierTable} (point, id, type, {colStringSimple})
+            SELECT point, gen_random_uuid(), 'gradient_barrier', {passabilityValues}
+            FROM breaks
+            RETURNING id
+        )
+        INSERT INTO {dbTargetSchema}.barrier_passability (barrier_id, species_id, species_code, passability_status)
+        SELECT b.id, f.id, f.code, CASE WHEN f.code = '{code}' THEN '0' ELSE '1' END
+        FROM (
+            SELECT id FROM inserted
+            UNION
             SELECT id
             FROM {dbTargetSchema}.{dbGradientBarrierTable}
             WHERE id NOT IN (SELECT barrier_id FROM {dbTargetSchema}.barrier_passability)
-        """
-
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            feature_data = cursor.fetchall()
-        conn.commit()
-
-        query = f"""
-            SELECT id, code
-            FROM {dbTargetSchema}.fish_species
-            WHERE code = '{code}'
-        """ 
-        # print(query)
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            species = cursor.fetchall()
-        conn.commit()
-
-        query = f"""
-            SELECT id, code
-            FROM {dbTargetSchema}.fish_species
-            WHERE code != '{code}'
-        """
-        # print(query)
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            other_species = cursor.fetchall()
-        conn.commit()
-
-        passability_data = []
-        other_passability_data = [] # barriers passable for all other species
-
-        for feature in feature_data:
-            passability_feature = []
-            other_passability_feature = []
-            for s in species:
-                passability_feature.append(feature[0])
-                passability_feature.append(s[0])
-                passability_feature.append(s[1])
-                passability_feature.append(0)
-            for s in other_species:
-                other_passability_feature.append(feature[0])
-                other_passability_feature.append(s[0])
-                other_passability_feature.append(s[1])
-                other_passability_feature.append(1)
-            if len(passability_feature) != 0:
-                passability_data.append(passability_feature)
-            if len(other_passability_feature) != 0:
-                other_passability_data.append(other_passability_feature)
-        
-        insertPassability(conn, passability_data)
-        insertPassability(conn, other_passability_data)
+        ) b
+        CROSS JOIN {dbTargetSchema}.fish_species f
+    """
+    
+    # print(query)
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+    conn.commit()
    
             
     #break streams at snapped points
@@ -411,6 +321,16 @@ def updateBarrier(connection):
             SET stream_id_down = a.stream_id
             FROM ids a
             WHERE a.barrier_id = {dbTargetSchema}.{dbBarrierTable}.id;
+
+        -- stream node at each break point
+        ALTER TABLE {dbTargetSchema}.{dbGradientBarrierTable} ADD COLUMN IF NOT EXISTS node_id integer;
+
+        UPDATE {dbTargetSchema}.{dbGradientBarrierTable} SET node_id = null;
+
+        UPDATE {dbTargetSchema}.{dbGradientBarrierTable}
+            SET node_id = n.id
+            FROM {dbTargetSchema}.{stream_network.nodeTable} n
+            WHERE st_dwithin(n.geometry, {dbTargetSchema}.{dbGradientBarrierTable}.point, 0.01);
     """
 
     # print(query)
@@ -444,11 +364,17 @@ def main():
         print("    breaking streams at barrier points")
         breakstreams(connection)
         
+        print("    updating stream nodes")
+        stream_network.updateNodes(connection)
+        stream_network.updateNestedSets(connection)
+        
         print("    recomputing mainstem measures")
         recomputeMainstreamMeasure(connection)
     
         print("    updating barrier stream references")
         updateBarrier(connection)
+
+    stream_network.invalidate()
     
     print("Breaking stream complete.")
     
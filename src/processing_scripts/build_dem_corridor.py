@@ -0,0 +1,148 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script extracts the dem cells near the watershed streams into the dem
+# corridor extract (see dem_corridor.py) so assign_raw_z reads the cells from
+# the extract instead of the dem files. Only runs if use_dem_corridor is set
+# in the [ELEVATION_PROCESSING] section.
+#
+# The streams are split into pieces no longer than the dem cell size and the
+# cells within two cells of each piece's end points are extracted. This
+# includes all the cells used to interpolate the elevation of any point on
+# the streams (so the vertices added when the streams are broken at barriers
+# are covered).
+#
+# If the dem directory is not available the existing extract is kept.
+#
+import appconfig
+import os
+import numpy
+import shapely
+
+try:
+    from processing_scripts import assign_raw_z
+    from processing_scripts import dem_corridor
+    from processing_scripts import dem_reader
+except ImportError:
+    import assign_raw_z
+    import dem_corridor
+    import dem_reader
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+dbTargetTable = appconfig.config['PROCESSING']['stream_table']
+
+# cells on each side of a point that are extracted
+WINDOW = 2
+
+# points extracted at a time
+BATCH_SIZE = 1000000
+
+
+def getStreams(connection, watershed_id, srid):
+    query = f"""
+        SELECT st_transform({appconfig.dbGeomField}, {srid})
+        FROM {dbTargetSchema}.{dbTargetTable}
+        WHERE {appconfig.dbWatershedIdField} IN {watershed_id}
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+    connection.commit()
+    return shapely.from_wkb([row[0] for row in rows])
+
+
+def extractCells(demfile, points):
+    """
+    Returns the sorted positions (row * columns + column) of the cells of
+    the dem file within WINDOW cells of the points
+    """
+    xindex = numpy.floor((points[:, 0] - demfile.xmin) / demfile.xcellsize).astype(numpy.int64)
+    yindex = demfile.ycnt - numpy.floor((points[:, 1] - demfile.ymin) / abs(demfile.ycellsize)).astype(numpy.int64) - 1
+
+    cells = []
+    for dy in range(-WINDOW, WINDOW + 1):
+        for dx in range(-WINDOW, WINDOW + 1):
+            rows = yindex + dy
+            cols = xindex + dx
+            infile = (rows >= 0) & (rows < demfile.ycnt) & (cols >= 0) & (cols < demfile.xcnt)
+            cells.append(rows[infile] * demfile.xcnt + cols[infile])
+    return numpy.unique(numpy.concatenate(cells))
+
+
+def buildCorridor(connection, demfiles, version, watershed_id):
+    extracts = []
+    streams = dict()
+    cellsize = min([min(abs(f.xcellsize), abs(f.ycellsize)) for f in demfiles])
+
+    for demfile in demfiles:
+        print("    extracting: " + demfile.filename)
+        if demfile.srid not in streams:
+            streams[demfile.srid] = shapely.segmentize(getStreams(connection, watershed_id, demfile.srid), cellsize)
+        geoms = streams[demfile.srid]
+
+        margin = (WINDOW + 1) * cellsize
+        bounds = shapely.box(demfile.xmin - margin, demfile.ymin - margin, demfile.xmax + margin, demfile.ymax + margin)
+        points = shapely.get_coordinates(geoms[shapely.intersects(geoms, bounds)])
+        points = points[(points[:, 0] >= demfile.xmin - margin) & (points[:, 0] <= demfile.xmax + margin) &
+            (points[:, 1] >= demfile.ymin - margin) & (points[:, 1] <= demfile.ymax + margin)]
+
+        cells = [numpy.empty(0, dtype = numpy.int64)]
+        for start in range(0, len(points), BATCH_SIZE):
+            cells.append(extractCells(demfile, points[start:start + BATCH_SIZE]))
+        cells = numpy.unique(numpy.concatenate(cells))
+
+        values = dem_reader.getReader(demfile.filename).values(cells // demfile.xcnt, cells % demfile.xcnt)
+        extracts.append((demfile, cells, values))
+        print(f"""      {len(cells)} of {demfile.xcnt * demfile.ycnt} cells""")
+
+    dem_corridor.save(version, extracts)
+
+
+#--- main program ---
+def main():
+
+    if not dem_corridor.useCorridor:
+        print("use_dem_corridor is not set, dem corridor extract not built")
+        return
+
+    if not os.path.isdir(assign_raw_z.demDir):
+        if not os.path.exists(dem_corridor.corridorFile):
+            raise Exception("dem directory " + assign_raw_z.demDir + " not found and there is no dem corridor extract for the watershed")
+        print("dem directory " + assign_raw_z.demDir + " not found, keeping the existing dem corridor extract")
+        return
+
+    with appconfig.connectdb() as conn:
+
+        watershed_id = assign_raw_z.getWatershedIds(conn)
+        demfiles, version = assign_raw_z.indexDem()
+
+        # the existing extract is for other streams or dem files
+        dem_corridor.remove()
+
+        print("Extracting dem corridor")
+        buildCorridor(conn, demfiles, version, watershed_id)
+
+    print("  " + dem_reader.cache.report())
+    dem_reader.closeReaders()
+
+    print("done")
+
+if __name__ == "__main__":
+    main()
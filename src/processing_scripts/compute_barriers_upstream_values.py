@@ -22,12 +22,14 @@
 #
 
 import appconfig
-import shapely.wkb
-from collections import deque
 import psycopg2.extras
 import numpy as np
 
-import sys
+try:
+    from processing_scripts import stream_network
+except ImportError:
+    import stream_network
+
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -38,110 +40,70 @@ dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 dbPassabilityTable = appconfig.config['BARRIER_PROCESSING']['passability_table']
 species_codes = appconfig.config[iniSection]['species']
 
-edges = []
-nodes = dict()
 species = []
+network = None
+
+# per edge attributes
+length = None
+w_length = None
+
+# (species x edges) attributes
+upbarriercnt = None
+downpassability = None
+speca = None # species accessibility
+spawn_habitat = None
+rear_habitat = None
+habitat = None
+
+# (species x edges) upstream values
+specaup = None # species accessibility upstream
+spawn_habitatup = None
+rear_habitatup = None
+habitatup = None
+spawn_funchabitatup = None
+rear_funchabitatup = None
+funchabitatup = None
+dci = None
+# weighted habitat for rankings
+w_habitatup = None
+w_funchabitatup = None
+
+# per edge upstream values for all species
+spawn_habitatup_all = None
+rear_habitatup_all = None
+habitatup_all = None
+spawn_funchabitatup_all = None
+rear_funchabitatup_all = None
+funchabitatup_all = None
+
+
+def getPassability(connection):
+    """
+    Loads the passability status of all barriers for the species
+    :returns: dictionary of (barrier id, species code) to passability
+    """
+    query = f"""
+        SELECT p.barrier_id, s.code, p.passability_status 
+        FROM {dbTargetSchema}.{dbPassabilityTable} p
+        JOIN {dbTargetSchema}.fish_species s
+            ON p.species_id = s.id
+        WHERE s.code IN {specCodes}
+    """
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.barrierids = set()
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, length, strahler_order, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.length = length
-        self.fid = fid
-        self.visited = False
-        self.speca = {} # species accessibility
-        self.specaup = {} # species accessibility upstream
-        self.spawn_habitat = {}
-        self.spawn_habitatup = {}
-        self.rear_habitat = {}
-        self.rear_habitatup = {}
-        self.habitat = {}
-        self.habitatup = {}
-        self.spawn_funchabitatup = {}
-        self.rear_funchabitatup = {}
-        self.funchabitatup = {}
-        self.spawn_habitat_all = None
-        self.spawn_habitatup_all = {}
-        self.rear_habitat_all = None
-        self.rear_habitatup_all = {}
-        self.habitat_all = None
-        self.habitatup_all = {}
-        self.spawn_funchabitat_all = {}
-        self.rear_funchabitat_all = {}
-        self.funchabitat_all = {}
-        self.spawn_funchabitatup_all = {}
-        self.rear_funchabitatup_all = {}
-        self.funchabitatup_all = {}
-
-        self.upbarriercnt = {}
-        self.downbarriers = {}
-        self.downpassability = {}
-        self.dci = {}
-
-        # weighted length for ranking calculation
-        if strahler_order == 1:
-            self.w_length = self.length * 0.25
-        elif strahler_order == 2:
-            self.w_length = self.length * 0.75
-        else:
-            self.w_length = self.length
-
-        # weighted habitat for rankings
-        self.w_habitatup = {}
-        self.w_funchabitatup = {}
-    
-    def print(self):
-        print("fid:", self.fid)
-        print("upbarriercnt:", self.upbarriercnt)
-        print("downbarriers:", self.downbarriers)
-        print("downpassability:", self.downpassability)
-        print("species accessibility:", self.speca)
-        print("spawn_habitat:", self.spawn_habitat)
-        print("rear_habitat:", self.rear_habitat)
-        print("habitat:", self.habitat)
-        print("spawn_habitatup:", self.spawn_habitatup)
-        print("rear_habitatup:", self.rear_habitatup)
-        print("habitatup:", self.habitatup)
-        print("spawn_habitat_all:", self.spawn_habitat_all)
-        print("rear_habitat_all:", self.rear_habitat_all)
-        print("habitat_all:", self.habitat_all)
-
-    def check_spawn_habitat_all(self):
-        result = any(val == True for val in self.spawn_habitat.values())
-        return result
-    
-    def check_rear_habitat_all(self):
-        result = any(val == True for val in self.rear_habitat.values())
-        return result
-
-    def check_habitat_all(self):
-        result = any(val == True for val in self.habitat.values())
-        return result
-
-    def __iter__(self):
-        return iter([self.fid, self.length, self.downbarriers, self.downpassability, self.habitat])
+    passability = dict()
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        for barrier, code, status in cursor.fetchall():
+            passability[(str(barrier), code)] = float(0 if status is None else status)
+    return passability
 
 def createNetwork(connection):
     # Takes longest to run, could look to improve in future
 
     global specCodes
     global species_codes
+    global network, length, w_length
+    global upbarriercnt, downpassability, speca, spawn_habitat, rear_habitat, habitat
 
     specCodes = [substring.strip() for substring in species_codes.split(',')]
 
@@ -169,323 +131,157 @@ def createNetwork(connection):
             species.append(feature[0])
             barrierupcntmodel = barrierupcntmodel + ', barrier_up_' + feature[0] + '_cnt'
             barrierdownmodel = barrierdownmodel + ', barriers_down_' + feature[0]
-            accessibilitymodel = accessibilitymodel + ', ' + feature[0] + '_accessibility'
+            accessibilitymodel = accessibilitymodel + ', ' + feature[0] + "_accessibility IN ('" + appconfig.Accessibility.ACCESSIBLE.value + "', '" + appconfig.Accessibility.POTENTIAL.value + "')"
             spawnhabitatmodel = spawnhabitatmodel + ', habitat_spawn_' + feature[0]
             rearhabitatmodel = rearhabitatmodel + ', habitat_rear_' + feature[0]
             habitatmodel = habitatmodel + ', habitat_' + feature[0]
 
     
+    network = stream_network.getNetwork(connection)
+    passability = getPassability(connection)
+
+    nspecies = len(species)
+    length = network.length
+    upbarriercnt = network.edgeArray(dtype = np.int64, species = nspecies)
+    downpassability = network.edgeArray(species = nspecies)
+    speca = network.edgeArray(dtype = bool, species = nspecies, fill = False)
+    spawn_habitat = network.edgeArray(dtype = bool, species = nspecies, fill = False)
+    rear_habitat = network.edgeArray(dtype = bool, species = nspecies, fill = False)
+    habitat = network.edgeArray(dtype = bool, species = nspecies, fill = False)
+    strahler_order = network.edgeArray(dtype = np.int64)
+
+    # the lengths come from the network and accessibility is computed
+    # by the database so only numbers, booleans and barrier ids are loaded
     query = f"""
-        SELECT a.{appconfig.dbIdField} as id, 
-            st_length(a.{appconfig.dbGeomField}), a.{appconfig.dbGeomField}
+        SELECT a.{appconfig.dbIdField} as id
             {barrierupcntmodel} {barrierdownmodel}
             {accessibilitymodel} {spawnhabitatmodel} {rearhabitatmodel} {habitatmodel}
             ,a.strahler_order
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-        LEFT JOIN {dbTargetSchema}.{dbBarrierTable} b
-        ON a.id = b.stream_id_up;
+        FROM {dbTargetSchema}.{dbTargetStreamTable} a;
     """
    
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            fid = feature[0]
-            length = feature[1]
-            geom = shapely.wkb.loads(feature[2] , hex=True)
-            strahler_order = feature[-1]
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-
-            edge = Edge(fromNode, toNode, fid, length, strahler_order, geom)
-            index = 3
-            for fish in species:
-                edge.upbarriercnt[fish] = feature[index]
-                edge.downbarriers[fish] = feature[index + len(species)]
-
-                passabilities = []
-
-                for barrier in edge.downbarriers[fish]:
-                    # query = f"""
-                    # SELECT passability_status_{fish} FROM {dbTargetSchema}.{dbBarrierTable} WHERE id = '{barrier}';
-                    # """
-                    query = f"""
-                    SELECT passability_status 
-                    FROM {dbTargetSchema}.{dbPassabilityTable} p
-                    JOIN {dbTargetSchema}.fish_species s
-                        ON p.species_id = s.id
-                    WHERE p.barrier_id = '{barrier}'
-                    AND s.code = '{fish}'
-                    """
-
-                    with connection.cursor() as cursor2:
-                        cursor2.execute(query)
-                        status = cursor2.fetchone()
-                        val = float(0 if status[0] is None else status[0])
-                        passabilities.append(val)
-                
-                edge.downpassability[fish] = np.prod(passabilities)
-
-                edge.speca[fish] = feature[index + len(species)*2]
-                edge.spawn_habitat[fish] = feature[index + (len(species)*3)]
-                edge.rear_habitat[fish] = feature[index + (len(species)*4)]
-                edge.habitat[fish] = feature[index + (len(species)*5)]
-                index = index + 1
-
-            edge.spawn_habitat_all = edge.check_spawn_habitat_all()
-            edge.rear_habitat_all = edge.check_rear_habitat_all()
-            edge.habitat_all = edge.check_habitat_all()
-
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)
+    #load attributes onto the network edges
+    for features in stream_network.fetchRows(connection, query):
+        edges = [network.edgeIndex[feature[0]] for feature in features]
+        strahler_order[edges] = [feature[-1] or 0 for feature in features]
+
+        index = 1
+        for i, fish in enumerate(species):
+            upbarriercnt[i, edges] = [feature[index] for feature in features]
+            downpassability[i, edges] = [np.prod([passability[(barrier, fish)] for barrier in feature[index + nspecies]]) for feature in features]
+            speca[i, edges] = [bool(feature[index + nspecies*2]) for feature in features]
+            spawn_habitat[i, edges] = [bool(feature[index + (nspecies*3)]) for feature in features]
+            rear_habitat[i, edges] = [bool(feature[index + (nspecies*4)]) for feature in features]
+            habitat[i, edges] = [bool(feature[index + (nspecies*5)]) for feature in features]
+            index = index + 1
+
+    # weighted length for ranking calculation
+    w_length = np.where(strahler_order == 1, length * 0.25, np.where(strahler_order == 2, length * 0.75, length))
+
+
+def computeDci():
+    """
+    Computes the dci of each edge from the length of the edge relative to the total
+    habitat length and the passability of the barriers downstream
+    """
+    global dci
+
+    total_length = (length * habitat).sum(axis = 1)
+    dci = network.edgeArray(species = len(species))
+    for i in range(len(species)):
+        if (habitat[i].any()):
+            dci[i] = np.where(habitat[i], ((length / total_length[i]) * downpassability[i]) * 100, 0)
 
 
 def processNodes(connection):
-    
-    
-    #walk down network        
-    toprocess = deque()
+    global specaup, spawn_habitatup, rear_habitatup, habitatup
+    global spawn_funchabitatup, rear_funchabitatup, funchabitatup, w_habitatup, w_funchabitatup
+    global spawn_habitatup_all, rear_habitatup_all, habitatup_all
+    global spawn_funchabitatup_all, rear_funchabitatup_all, funchabitatup_all
+
+    nspecies = len(species)
+    specaup = network.edgeArray(species = nspecies)
+    spawn_habitatup = network.edgeArray(species = nspecies)
+    rear_habitatup = network.edgeArray(species = nspecies)
+    habitatup = network.edgeArray(species = nspecies)
+    spawn_funchabitatup = network.edgeArray(species = nspecies)
+    rear_funchabitatup = network.edgeArray(species = nspecies)
+    funchabitatup = network.edgeArray(species = nspecies)
+    w_habitatup = network.edgeArray(species = nspecies)
+    w_funchabitatup = network.edgeArray(species = nspecies)
+
+    spawn_habitatup_all = network.edgeArray()
+    rear_habitatup_all = network.edgeArray()
+    habitatup_all = network.edgeArray()
+    spawn_funchabitatup_all = network.edgeArray()
+    rear_funchabitatup_all = network.edgeArray()
+    funchabitatup_all = network.edgeArray()
+
+    # length of each edge counted towards each upstream value
+    specalength = speca * length
+    spawnlength = spawn_habitat * length
+    rearlength = rear_habitat * length
+    habitatlength = habitat * length
+    w_habitatlength = habitat * w_length
+    spawnlength_all = spawn_habitat.any(axis = 0) * length
+    rearlength_all = rear_habitat.any(axis = 0) * length
+    habitatlength_all = habitat.any(axis = 0) * length
+
+    computeDci()
 
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        
-        uplength = {}
-        spawn_habitat = {}
-        rear_habitat = {}
-        habitat = {}
-        spawn_funchabitat = {}
-        rear_funchabitat = {}
-        funchabitat = {}
-        spawn_habitat_all = 0
-        rear_habitat_all = 0
-        habitat_all = 0
-        spawn_funchabitat_all = 0
-        rear_funchabitat_all = 0
-        funchabitat_all = 0
-        outbarriercnt = {}
-        dci = {}
-        total_length = {}
-
-        # weighted
-        w_habitat = {}
-        w_funchabitat = {}
+    #walk down network        
+    for node in network.downstreamSweep():
         
-        for fish in species:
-            uplength[fish] = 0
-            spawn_habitat[fish] = 0
-            rear_habitat[fish] = 0
-            habitat[fish] = 0
-            spawn_funchabitat[fish] = 0
-            rear_funchabitat[fish] = 0
-            funchabitat[fish] = 0
-            outbarriercnt[fish] = 0
-            dci[fish] = 0
-            total_length[fish] = sum(edge.length for edge in edges if edge.habitat[fish])
-            # weighted
-            w_habitat[fish] = 0
-            w_funchabitat[fish] = 0
-
-        for inedge in node.inedges:
-
-            for fish in species:
-                outbarriercnt[fish] += inedge.upbarriercnt[fish]
-
-                if inedge.habitat[fish]:
-                    inedge.dci[fish] = ((inedge.length / total_length[fish]) * inedge.downpassability[fish]) * 100
-                else:
-                    inedge.dci[fish] = 0
-                
-            if not inedge.visited:
-                allvisited = False
-                break
+        inedges = network.inEdges(node)
+        outbarriercnt = upbarriercnt[:, inedges].sum(axis = 1)
+
+        uplength = specaup[:, inedges].sum(axis = 1)
+        spawn = spawn_habitatup[:, inedges].sum(axis = 1)
+        rear = rear_habitatup[:, inedges].sum(axis = 1)
+        hab = habitatup[:, inedges].sum(axis = 1)
+        spawn_func = spawn_funchabitatup[:, inedges].sum(axis = 1)
+        rear_func = rear_funchabitatup[:, inedges].sum(axis = 1)
+        func = funchabitatup[:, inedges].sum(axis = 1)
+        # weighted habitat gain
+        w_hab = w_habitatup[:, inedges].sum(axis = 1)
+        w_func = w_funchabitatup[:, inedges].sum(axis = 1)
+
+        spawn_all = spawn_habitatup_all[inedges].sum()
+        rear_all = rear_habitatup_all[inedges].sum()
+        hab_all = habitatup_all[inedges].sum()
+        spawn_func_all = spawn_funchabitatup_all[inedges].sum()
+        rear_func_all = rear_funchabitatup_all[inedges].sum()
+        func_all = funchabitatup_all[inedges].sum()
+
+        for outedge in network.outEdges(node):
+
+            # functional habitat stops at barriers at this node
+            connected = upbarriercnt[:, outedge] == outbarriercnt
+
+            specaup[:, outedge] = uplength + specalength[:, outedge]
+            spawn_habitatup[:, outedge] = spawn + spawnlength[:, outedge]
+            rear_habitatup[:, outedge] = rear + rearlength[:, outedge]
+            habitatup[:, outedge] = hab + habitatlength[:, outedge]
+            spawn_funchabitatup[:, outedge] = np.where(connected, spawn_func, 0) + spawnlength[:, outedge]
+            rear_funchabitatup[:, outedge] = np.where(connected, rear_func, 0) + rearlength[:, outedge]
+            funchabitatup[:, outedge] = np.where(connected, func, 0) + habitatlength[:, outedge]
+
+            # weighted habitat for ranking
+            w_habitatup[:, outedge] = w_hab + w_habitatlength[:, outedge]
+            w_funchabitatup[:, outedge] = np.where(connected, w_func, 0) + w_habitatlength[:, outedge]
+
+            spawn_habitatup_all[outedge] = spawn_all + spawnlength_all[outedge]
+            rear_habitatup_all[outedge] = rear_all + rearlength_all[outedge]
+            habitatup_all[outedge] = hab_all + habitatlength_all[outedge]
+
+            if connected.all():
+                spawn_funchabitatup_all[outedge] = spawn_func_all + spawnlength_all[outedge]
+                rear_funchabitatup_all[outedge] = rear_func_all + rearlength_all[outedge]
+                funchabitatup_all[outedge] = func_all + habitatlength_all[outedge]
             else:
-                for fish in species:
-                    uplength[fish] = uplength[fish] + inedge.specaup[fish]
-                    spawn_habitat[fish] = spawn_habitat[fish] + inedge.spawn_habitatup[fish]
-                    rear_habitat[fish] = rear_habitat[fish] + inedge.rear_habitatup[fish]
-                    habitat[fish] = habitat[fish] + inedge.habitatup[fish]
-                    spawn_funchabitat[fish] = spawn_funchabitat[fish] + inedge.spawn_funchabitatup[fish]
-                    rear_funchabitat[fish] = rear_funchabitat[fish] + inedge.rear_funchabitatup[fish]
-                    funchabitat[fish] = funchabitat[fish] + inedge.funchabitatup[fish]
-                    # weighted habitat gain
-                    w_habitat[fish] = w_habitat[fish] + inedge.w_habitatup[fish]
-                    w_funchabitat[fish] = w_funchabitat[fish] + inedge.w_funchabitatup[fish] 
-                
-                spawn_habitat_all = spawn_habitat_all + inedge.spawn_habitatup_all
-                rear_habitat_all = rear_habitat_all + inedge.rear_habitatup_all
-                habitat_all = habitat_all + inedge.habitatup_all
-
-                spawn_funchabitat_all = spawn_funchabitat_all + inedge.spawn_funchabitatup_all
-                rear_funchabitat_all = rear_funchabitat_all + inedge.rear_funchabitatup_all
-                funchabitat_all = funchabitat_all + inedge.funchabitatup_all
-                
-        if not allvisited:
-            toprocess.append(node)
-        else:
-        
-            for outedge in node.outedges:
-
-                for fish in species:
-
-                    if outedge.habitat[fish]:
-                        outedge.dci[fish] = ((outedge.length / total_length[fish]) * outedge.downpassability[fish]) * 100
-                    else:
-                        outedge.dci[fish] = 0
-
-
-                    if (outedge.speca[fish] == appconfig.Accessibility.ACCESSIBLE.value or outedge.speca[fish] == appconfig.Accessibility.POTENTIAL.value):
-                        outedge.specaup[fish] = uplength[fish] + outedge.length
-                    else:
-                        outedge.specaup[fish] = uplength[fish]
-                        
-                    if outedge.spawn_habitat[fish]:
-                        outedge.spawn_habitatup[fish] = spawn_habitat[fish] + outedge.length
-                    else:
-                        outedge.spawn_habitatup[fish] = spawn_habitat[fish]
-                    
-
-                    if outedge.rear_habitat[fish]:
-                        outedge.rear_habitatup[fish] = rear_habitat[fish] + outedge.length
-                    else:
-                        outedge.rear_habitatup[fish] = rear_habitat[fish]
-                    
-
-                    if outedge.habitat[fish]:
-                        outedge.habitatup[fish] = habitat[fish] + outedge.length
-                    else:
-                        outedge.habitatup[fish] = habitat[fish]
-
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.spawn_habitat[fish]:
-                            outedge.spawn_funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.spawn_funchabitatup[fish] = 0 
-                    elif outedge.spawn_habitat[fish]:
-                        outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish] + outedge.length
-                    else:
-                        outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish]
-
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.rear_habitat[fish]:
-                            outedge.rear_funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.rear_funchabitatup[fish] = 0 
-                    elif outedge.rear_habitat[fish]:
-                        outedge.rear_funchabitatup[fish] = rear_funchabitat[fish] + outedge.length
-                    else:
-                        outedge.rear_funchabitatup[fish] = rear_funchabitat[fish]
-
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.habitat[fish]:
-                            outedge.funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.funchabitatup[fish] = 0
-                    elif outedge.habitat[fish]:
-                        outedge.funchabitatup[fish] = funchabitat[fish] + outedge.length
-                    else: 
-                        outedge.funchabitatup[fish] = funchabitat[fish]
-
-                    # weighted habitat for ranking
-                    if outedge.habitat[fish]:
-                        outedge.w_habitatup[fish] = w_habitat[fish] + outedge.w_length
-                    else:
-                        outedge.w_habitatup[fish] = w_habitat[fish]
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.habitat[fish]:
-                            outedge.w_funchabitatup[fish] = outedge.w_length
-                        else:
-                            outedge.w_funchabitatup[fish] = 0
-                    elif outedge.habitat[fish]:
-                        outedge.w_funchabitatup[fish] = w_funchabitat[fish] + outedge.w_length
-                    else: 
-                        outedge.w_funchabitatup[fish] = w_funchabitat[fish]
-                
-                if outedge.spawn_habitat_all:
-                    outedge.spawn_habitatup_all = spawn_habitat_all + outedge.length
-                else:
-                    outedge.spawn_habitatup_all = spawn_habitat_all
-
-                if outedge.rear_habitat_all:
-                    outedge.rear_habitatup_all = rear_habitat_all + outedge.length
-                else:
-                    outedge.rear_habitatup_all = rear_habitat_all
-
-                if outedge.habitat_all:
-                    outedge.habitatup_all = habitat_all + outedge.length
-                else:
-                    outedge.habitatup_all = habitat_all
-                
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.spawn_habitat_all:
-                        outedge.spawn_funchabitatup_all = outedge.length
-                    else:
-                        outedge.spawn_funchabitatup_all = 0
-                elif outedge.spawn_habitat_all:
-                    outedge.spawn_funchabitatup_all = spawn_funchabitat_all + outedge.length
-                else: 
-                    outedge.spawn_funchabitatup_all = spawn_funchabitat_all
-
-
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.rear_habitat_all:
-                        outedge.rear_funchabitatup_all = outedge.length
-                    else:
-                        outedge.rear_funchabitatup_all = 0
-                elif outedge.rear_habitat_all:
-                    outedge.rear_funchabitatup_all = rear_funchabitat_all + outedge.length
-                else: 
-                    outedge.rear_funchabitatup_all = rear_funchabitat_all
-
-
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.habitat_all:
-                        outedge.funchabitatup_all = outedge.length
-                    else:
-                        outedge.funchabitatup_all = 0
-                elif outedge.habitat_all:
-                    outedge.funchabitatup_all = funchabitat_all + outedge.length
-                else: 
-                    outedge.funchabitatup_all = funchabitat_all
-
-
-                outedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(outedge.toNode)
+                spawn_funchabitatup_all[outedge] = spawnlength_all[outedge]
+                rear_funchabitatup_all[outedge] = rearlength_all[outedge]
+                funchabitatup_all[outedge] = habitatlength_all[outedge]
         
 def writeResults(connection):
       
@@ -532,28 +328,28 @@ def writeResults(connection):
 
     newdata = []
     
-    for edge in edges:
+    for edge in range(network.edgeCount):
         
         data = []
-        data.append(edge.fid)
-        for fish in species:
-            data.append (edge.specaup[fish])
-            data.append (edge.spawn_habitatup[fish])
-            data.append (edge.rear_habitatup[fish])
-            data.append (edge.habitatup[fish])
-            data.append (edge.spawn_funchabitatup[fish])
-            data.append (edge.rear_funchabitatup[fish])
-            data.append (edge.funchabitatup[fish])
-            data.append (edge.dci[fish])
-            data.append(edge.w_habitatup[fish]) # weighted habitat
-            data.append(edge.w_funchabitatup[fish]) # weighted habitat
+        data.append(network.fids[edge])
+        for i in range(len(species)):
+            data.append (float(specaup[i, edge]))
+            data.append (float(spawn_habitatup[i, edge]))
+            data.append (float(rear_habitatup[i, edge]))
+            data.append (float(habitatup[i, edge]))
+            data.append (float(spawn_funchabitatup[i, edge]))
+            data.append (float(rear_funchabitatup[i, edge]))
+            data.append (float(funchabitatup[i, edge]))
+            data.append (float(dci[i, edge]))
+            data.append(float(w_habitatup[i, edge])) # weighted habitat
+            data.append(float(w_funchabitatup[i, edge])) # weighted habitat
         
-        data.append(edge.spawn_habitatup_all)
-        data.append(edge.rear_habitatup_all)
-        data.append(edge.habitatup_all)
-        data.append(edge.spawn_funchabitatup_all)
-        data.append(edge.rear_funchabitatup_all)
-        data.append(edge.funchabitatup_all)
+        data.append(float(spawn_habitatup_all[edge]))
+        data.append(float(rear_habitatup_all[edge]))
+        data.append(float(habitatup_all[edge]))
+        data.append(float(spawn_funchabitatup_all[edge]))
+        data.append(float(rear_funchabitatup_all[edge]))
+        data.append(float(funchabitatup_all[edge]))
 
         newdata.append( data )
 
@@ -799,8 +595,6 @@ def assignBarrierCounts(connection):
 #--- main program ---
 def main():
 
-    edges.clear()
-    nodes.clear()
     species.clear()    
         
     with appconfig.connectdb() as conn:
@@ -29,11 +29,14 @@
 #  * elevation processing is completed
 #
 import appconfig
-import shapely.wkb
-from collections import deque
 import uuid
 import psycopg2.extras
 
+try:
+    from processing_scripts import stream_network
+except ImportError:
+    import stream_network
+
 iniSection = appconfig.args.args[0]
 
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -43,144 +46,72 @@ dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
 dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
 dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
-edges = []
-nodes = dict()
+network = None
+length = None
+sname = None
+mainstemid = None
+downstreammeasure = None
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.uplength = 0
-        self.upedge = None
-        self.mainstemid = None
-        self.downstreammeasure = 0
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, length, sname, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.length = length
-        self.sname = sname
-        self.mainstemid = None
-        self.uplength = 0
-        self.downstreammeasure = 0
-        
 def createNetwork(connection):
+    global network, length, sname
+
+    network = stream_network.getNetwork(connection)
+    length = network.length
+    sname = [None] * network.edgeCount
 
+    #only named streams are loaded, the lengths come from the network
     query = f"""
-        SELECT a.{appconfig.dbIdField} as id, st_length(a.{appconfig.dbGeomField}) as length, 
-          a.stream_name, a.{appconfig.dbGeomField}
+        SELECT a.{appconfig.dbIdField} as id, a.stream_name
         FROM {dbTargetSchema}.{dbTargetStreamTable} a
+        WHERE a.stream_name IS NOT NULL AND a.stream_name != 'UNNAMED'
     """
    
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
+    #load attributes onto the network edges
+    for features in stream_network.fetchRows(connection, query):
         for feature in features:
-            fid = feature[0]
-            length = feature[1]
-            sname = feature[2]
-            if (sname == "UNNAMED"):
-                sname = None
-                
-            geom = shapely.wkb.loads(feature[3], hex=True)
-
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, length, sname, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
+            sname[network.edgeIndex[feature[0]]] = feature[1]
 
 def processNodes():
+    global mainstemid, downstreammeasure
 
+    fromNode = network.fromNode
+    
+    network.checkSingleOutlets()
+    
     #walk down network   
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
+    nodeuplength = network.nodeArray()
             
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
+    for node in network.downstreamSweep():
         
         maxValue = 0 
-        for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False
-                break
-            else:
-                length = inedge.fromNode.uplength + inedge.length
-                if (length > maxValue):
-                    maxValue = length
+        for inedge in network.inEdges(node):
+            uplength = nodeuplength[fromNode[inedge]] + length[inedge]
+            if (uplength > maxValue):
+                maxValue = uplength
         
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            node.uplength = maxValue
-            
-        for outedge in node.outedges:
-            outedge.visited = True
-            if (not outedge.toNode in toprocess):
-                toprocess.append(outedge.toNode)
+        nodeuplength[node] = maxValue
     
     #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-            node.mainstemid = uuid.uuid4()
+    mainstemid = [None] * network.edgeCount
+    downstreammeasure = network.edgeArray()
+    nodemainstemid = [None] * network.nodeCount
+    nodedownstreammeasure = network.nodeArray()
     
-    while (toprocess):
-        node = toprocess.popleft()
+    for node in network.upstreamSweep():
+        
+        #outlets start a new mainstem
+        if (nodemainstemid[node] is None):
+            nodemainstemid[node] = uuid.uuid4()
         
-        if (len(node.inedges) == 0):
+        inedges = network.inEdges(node)
+        if (len(inedges) == 0):
             continue
         
         #visit this node
-        sname = None
-        if (len(node.outedges) > 0):
-            sname = node.outedges[0].sname
+        outedges = network.outEdges(node)
+        name = None
+        if (len(outedges) > 0):
+            name = sname[outedges[0]]
         
         longest = -9999
         longestNode = None
@@ -190,40 +121,40 @@ def processNodes():
         longestnamed = -9999
         longestnamedNode = None
         
-        for inedge in node.inedges:
-            if (inedge.fromNode.uplength + inedge.length > longest):
-                longest = inedge.fromNode.uplength + inedge.length
-                longestNode = inedge.fromNode
+        for inedge in inedges:
+            upnode = int(fromNode[inedge])
+            if (nodeuplength[upnode] + length[inedge] > longest):
+                longest = nodeuplength[upnode] + length[inedge]
+                longestNode = upnode
             
-            if (sname != None and inedge.sname == sname):
-                namedNode = inedge.fromNode
+            if (name != None and sname[inedge] == name):
+                namedNode = upnode
             
-            if (inedge.sname != None and (sname != None and inedge.sname != sname)):
-                if (inedge.fromNode.uplength > longestnamed):
-                    longestnamed = inedge.fromNode.uplength
-                    longestnamedNode = inedge.fromNode
+            if (sname[inedge] != None and (name != None and sname[inedge] != name)):
+                if (nodeuplength[upnode] > longestnamed):
+                    longestnamed = nodeuplength[upnode]
+                    longestnamedNode = upnode
                     
-        upnode = None
+        mainNode = None
         if (namedNode != None):
-            upnode = namedNode
+            mainNode = namedNode
         elif (longestnamedNode != None):
-            upnode = longestnamedNode
+            mainNode = longestnamedNode
         elif (longestNode != None):
-            upnode = longestNode 
-        
-        for inedge in node.inedges:
-            if (inedge.fromNode == upnode):
-                inedge.mainstemid = node.mainstemid
-                inedge.fromNode.downstreammeasure = node.downstreammeasure + inedge.length
-                inedge.downstreammeasure = node.downstreammeasure
+            mainNode = longestNode 
+        
+        for inedge in inedges:
+            upnode = int(fromNode[inedge])
+            if (upnode == mainNode):
+                mainstemid[inedge] = nodemainstemid[node]
+                nodedownstreammeasure[upnode] = nodedownstreammeasure[node] + length[inedge]
+                downstreammeasure[inedge] = nodedownstreammeasure[node]
             else:
-                inedge.mainstemid = uuid.uuid4()
-                inedge.downstreammeasure = 0
-                inedge.fromNode.downstreammeasure = inedge.length
+                mainstemid[inedge] = uuid.uuid4()
+                downstreammeasure[inedge] = 0
+                nodedownstreammeasure[upnode] = length[inedge]
 
-            inedge.fromNode.mainstemid = inedge.mainstemid
-            
-            toprocess.append(inedge.fromNode)
+            nodemainstemid[upnode] = mainstemid[inedge]
     
         
 def writeResults(connection):
@@ -236,10 +167,10 @@ def writeResults(connection):
     
     newdata = []
     
-    for edge in edges:
-        downmeasurekm = (edge.downstreammeasure)
-        upmeasurekm = (edge.downstreammeasure + edge.length)
-        newdata.append( (edge.mainstemid, downmeasurekm, upmeasurekm, edge.fid) )
+    for edge in range(network.edgeCount):
+        downmeasurekm = float(downstreammeasure[edge])
+        upmeasurekm = float(downstreammeasure[edge] + length[edge])
+        newdata.append( (mainstemid[edge], downmeasurekm, upmeasurekm, network.fids[edge]) )
     
     with connection.cursor() as cursor:    
         psycopg2.extras.execute_batch(cursor, updatequery, newdata)
@@ -249,9 +180,6 @@ def writeResults(connection):
 
 #--- main program ---  
 def main():  
-    edges.clear()
-    nodes.clear()
-    
     with appconfig.connectdb() as conn:
         
         conn.autocommit = False
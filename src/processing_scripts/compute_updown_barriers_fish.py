@@ -20,10 +20,13 @@
 # this script computes upstream/downstream barrier counts and ids
 #
 import appconfig
-import shapely.wkb
-from collections import deque
 import psycopg2.extras
 
+try:
+    from processing_scripts import stream_network
+except ImportError:
+    import stream_network
+
 
 iniSection = appconfig.args.args[0]
 
@@ -38,8 +41,13 @@ dbPassabiltyTable = appconfig.config['BARRIER_PROCESSING']['passability_table']
 snapDistance = appconfig.config['CABD_DATABASE']['snap_distance']
 species = appconfig.config[iniSection]['species']
 
-edges = []
-nodes = dict()
+network = None
+barrierids = None
+gradientbarrierids = None
+upbarriers = None
+downbarriers = None
+upgradient = None
+downgradient = None
 
 # with appconfig.connectdb() as conn:
 
@@ -52,79 +60,14 @@ nodes = dict()
 #         cursor.execute(query)
 #         specCodes = cursor.fetchall()
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.barrierids = set()
-        self.gradientbarrierids = set()
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-   
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.upbarriers = set()
-        self.downbarriers = set()
-        self.upgradient = set()
-        self.downgradient = set()
-        
 def createNetwork(connection, code): 
-    # Currenty the queries take very long to run could see if this can be improved in the future
+    global network, barrierids, gradientbarrierids
     
-    query = f"""
-        SELECT a.{appconfig.dbIdField} as id, a.{appconfig.dbGeomField}
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            fid = feature[0]
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)     
+    network = stream_network.getNetwork(connection)
+
+    #barrier ids at each node, only nodes with barriers are included
+    barrierids = dict()
+    gradientbarrierids = dict()
             
     #add barriers
     # query = f"""
@@ -141,174 +84,103 @@ def createNetwork(connection, code):
     #         and a.passability_status_{code} != 1
     # """
 
-    #add barriers
+    #add barriers at the start node of the stream downstream of the barrier
+    #and the end node of the stream upstream of it
     query = f"""
-        select 'up', a.id, b.id
+        select a.id, b.from_node
         from {dbTargetSchema}.{dbBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.snapped_point, 0.01)
-            and st_dwithin(st_startpoint(b.geometry), a.snapped_point, 0.01)
-            and f.code = '{code}'
+        join {dbTargetSchema}.fish_species f on p.species_id = f.id
+        join {dbTargetSchema}.{dbTargetStreamTable} b on b.id = a.stream_id_down
+        where f.code = '{code}'
             and p.passability_status != '1'
         union 
-        select 'down', a.id, b.id 
+        select a.id, b.to_node
         from {dbTargetSchema}.{dbBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.snapped_point, 0.01)
-            and st_dwithin(st_endpoint(b.geometry), a.snapped_point, 0.01)
-            and f.code = '{code}'
+        join {dbTargetSchema}.fish_species f on p.species_id = f.id
+        join {dbTargetSchema}.{dbTargetStreamTable} b on b.id = a.stream_id_up
+        where f.code = '{code}'
             and p.passability_status != '1'
     """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.barrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.barrierids.add(bid)
+    addBarriers(connection, query, barrierids)
                         
-    #add gradient barriers
+    #add gradient barriers at their stream node
     query = f"""
-        select 'up', a.id, b.id 
+        select a.id, a.node_id 
         from {dbTargetSchema}.{dbGradientBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.point, 0.01)
-            and st_dwithin(st_startpoint(b.geometry), a.point, 0.01)
-            and (a.type = 'gradient_barrier' or a.type = 'waterfall')
-            and f.code = '{code}'
-            and p.passability_status != '1'
-        union 
-        select 'down', a.id, b.id 
-        from {dbTargetSchema}.{dbGradientBarrierTable} a
-        join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.point, 0.01)
-            and st_dwithin(st_endpoint(b.geometry), a.point, 0.01)
+        join {dbTargetSchema}.fish_species f on p.species_id = f.id
+        where a.node_id is not null
             and (a.type = 'gradient_barrier' or a.type = 'waterfall')
             and f.code = '{code}'
             and p.passability_status != '1'
     """
-   
-    #load geometries and create a network
+    addBarriers(connection, query, gradientbarrierids)
+
+def addBarriers(connection, query, nodebarriers):
+    """
+    Adds the barrier ids returned by the query (barrier id, node table id)
+    to the nodebarriers dictionary of network node id to barrier ids
+    """
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
         
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.gradientbarrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.gradientbarrierids.add(bid)         
+    nodes = network.localNodes([feature[1] for feature in features])
+    for feature, node in zip(features, nodes.tolist()):
+        if (node < 0):
+            continue
+        nodebarriers.setdefault(node, set()).add(feature[0])
 
 def processNodes():
+    global upbarriers, downbarriers, upgradient, downgradient
+    
+    empty = set()
     
+    upbarriers = [set() for edge in range(network.edgeCount)]
+    downbarriers = [set() for edge in range(network.edgeCount)]
+    upgradient = [set() for edge in range(network.edgeCount)]
+    downgradient = [set() for edge in range(network.edgeCount)]
     
     #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
+    for node in network.downstreamSweep():
         
-        upbarriers = set()
-        upgradient = set()
+        nodeupbarriers = set()
+        nodeupgradient = set()
          
-        for inedge in node.inedges:
-               
-            if not inedge.visited:
-                allvisited = False
-                break
-            else:
-                upbarriers.update(inedge.upbarriers)
-                upgradient.update(inedge.upgradient)
-                
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            upbarriers.update(node.barrierids)
-            upgradient.update(node.gradientbarrierids)
-        
-            for outedge in node.outedges:
-                outedge.upbarriers.update(upbarriers)
-                outedge.upgradient.update(upgradient)
+        for inedge in network.inEdges(node):
+            nodeupbarriers.update(upbarriers[inedge])
+            nodeupgradient.update(upgradient[inedge])
                 
-                outedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(outedge.toNode)
+        nodeupbarriers.update(barrierids.get(node, empty))
+        nodeupgradient.update(gradientbarrierids.get(node, empty))
+    
+        for outedge in network.outEdges(node):
+            upbarriers[outedge].update(nodeupbarriers)
+            upgradient[outedge].update(nodeupgradient)
             
             
-    #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-    
-    while (toprocess):
-        node = toprocess.popleft()
+    #walk up network
+    for node in network.upstreamSweep():
         
-        if (len(node.inedges) == 0):
+        inedges = network.inEdges(node)
+        if (len(inedges) == 0):
             continue
         
-        downbarriers = set()
-        downbarriers.update(node.barrierids)
+        nodedownbarriers = set()
+        nodedownbarriers.update(barrierids.get(node, empty))
 
-        downgradient = set()
-        downgradient.update(node.gradientbarrierids)
-        
-        allvisited = True
+        nodedowngradient = set()
+        nodedowngradient.update(gradientbarrierids.get(node, empty))
         
-        for outedge in node.outedges:
-            if not outedge.visited:
-                allvisited = False
-                break
-            else:
-                downbarriers.update(outedge.downbarriers)
-                downgradient.update(outedge.downgradient)
+        for outedge in network.outEdges(node):
+            nodedownbarriers.update(downbarriers[outedge])
+            nodedowngradient.update(downgradient[outedge])
 
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            for inedge in node.inedges:
-                inedge.downbarriers.update(downbarriers)
-                inedge.downgradient.update(downgradient)             
-                inedge.visited = True
-                if (not inedge.toNode in toprocess):
-                    toprocess.append(inedge.fromNode)
+        for inedge in inedges:
+            downbarriers[inedge].update(nodedownbarriers)
+            downgradient[inedge].update(nodedowngradient)             
     
         
 def writeResults(connection, code):
@@ -327,11 +199,11 @@ def writeResults(connection, code):
     
     newdata = []
     
-    for edge in edges:
-        upbarriersstr = (list(edge.upbarriers),)  
-        downbarriersstr = (list(edge.downbarriers),)
+    for edge in range(network.edgeCount):
+        upbarriersstr = (list(upbarriers[edge]),)  
+        downbarriersstr = (list(downbarriers[edge]),)
         
-        newdata.append( (len(edge.upbarriers), len(edge.downbarriers), upbarriersstr, downbarriersstr, len(edge.upgradient), len(edge.downgradient), edge.fid))
+        newdata.append( (len(upbarriers[edge]), len(downbarriers[edge]), upbarriersstr, downbarriersstr, len(upgradient[edge]), len(downgradient[edge]), network.fids[edge]))
 
     
     with connection.cursor() as cursor:    
@@ -367,9 +239,6 @@ def main():
         
             
 
-            edges.clear()
-            nodes.clear()
-            
             print("Computing Upstream/Downstream Barriers")
             print("  processing barriers for", code)
             print("  creating output column")
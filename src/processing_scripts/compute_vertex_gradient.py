@@ -24,7 +24,18 @@
 # In addition to computing vertex and segment gradient it also computes the
 # maximum vertex gradient for the stream segment
 #
+# The gradient at each vertex is computed over the gradient_window (default
+# 100) in the [GRADIENT_PROCESSING] section, upstream along its mainstem.
+#
 import appconfig
+import io
+import numpy
+import shapely
+
+try:
+    from processing_scripts import vertex_profiles
+except ImportError:
+    import vertex_profiles
 
 iniSection = appconfig.args.args[0]
 
@@ -38,86 +49,187 @@ dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measu
 db3dGeomField = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
 
 dbVertexTable = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
-dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
-dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
 
-db4dGeomField = "geometryzm"
- 
-def setupGeometry(connection):
-    
-    # update geometry column    
+# distance upstream (in the data projection units) the gradient at a vertex
+# is computed over
+gradientWindow = appconfig.config['GRADIENT_PROCESSING'].getfloat('gradient_window', fallback = 100)
+
+# lower bounds of the grade classes 5, 7, 10, 12, 15, 20, 25 and 30
+GRADE_BREAKS = [.05, .07, .10, .12, .15, .20, .25, .30]
+GRADE_CLASSES = [0, 5, 7, 10, 12, 15, 20, 25, 30]
+
+
+def loadStreams(connection):
+    """
+    Loads the smoothed geometries of the streams on a mainstem
+    :returns: the mainstem ids, downstream and upstream measures and
+        geometries of the streams
+    """
     query = f"""
-        alter table {dbTargetSchema}.{dbTargetStreamTable} 
-        add column if not exists {db4dGeomField} geometry(LinestringZM, {appconfig.dataSrid});
-        
-        update {dbTargetSchema}.{dbTargetStreamTable} 
-        set {db4dGeomField} = st_addmeasure({db3dGeomField}, st_length({db3dGeomField}), 0) 
+        SELECT {dbMainstemField}, {dbDownMeasureField}, {dbUpMeasureField}, st_asbinary({db3dGeomField})
+        FROM {dbTargetSchema}.{dbTargetStreamTable}
+        WHERE {dbMainstemField} IS NOT NULL AND {db3dGeomField} IS NOT NULL
     """
-    
     with connection.cursor() as cursor:
-        cursor.execute(query)    
-            
-    connection.commit()
+        cursor.execute(query)
+        features = cursor.fetchall()
+
+    mainstems = numpy.array([feature[0] for feature in features], dtype = object)
+    down = numpy.array([feature[1] for feature in features], dtype = numpy.float64)
+    up = numpy.array([feature[2] for feature in features], dtype = numpy.float64)
+    geometries = shapely.from_wkb([feature[3] for feature in features])
+    return mainstems, down, up, geometries
 
-def computeVertexGradients(connection):
+
+def vertexGradients(mainstems, down, up, geometries, window = gradientWindow):
+    """
+    Computes the gradient at every vertex (but the downstream end) of the
+    streams: the difference between the elevation of the vertex and the
+    elevation window upstream along its mainstem, divided by window. The
+    measure of a vertex is the downstream measure of its stream plus the
+    distance to the end of the stream.
+
+    The streams of each mainstem are sorted by measure and the upstream
+    point of every vertex is found by searching the sorted streams and then
+    the sorted vertices of that stream (a pointer walked up the mainstem),
+    all vertices at once. Vertices with no stream on their mainstem at the
+    upstream measure or with NODATA elevations are left out.
+    :returns: dictionary of arrays: mainstem, measure, elevation_a,
+        elevation_b, gradient, grade_class, the vertex x, y, z, m and the
+        upstream point x, y, z, m
+    """
+    counts = shapely.get_num_coordinates(geometries)
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+    coords = shapely.get_coordinates(geometries, include_z = True)
+    streams = numpy.repeat(numpy.arange(len(geometries)), counts)
+
+    # distance along all the streams, restarting the steps at each stream
+    step = numpy.zeros(len(coords))
+    step[1:] = numpy.hypot(numpy.diff(coords[:, 0]), numpy.diff(coords[:, 1]))
+    step[offsets[:-1]] = 0
+    distance = numpy.cumsum(step)
+    start = distance[offsets[:-1]]
+    length = distance[offsets[1:] - 1] - start
+
+    # the vertices and their measures, the m value is the distance to the
+    # downstream end of the stream
+    vertices = numpy.ones(len(coords), dtype = bool)
+    vertices[offsets[1:] - 1] = False
+    vertices = vertices.nonzero()[0]
+    stream = streams[vertices]
+    m = length[stream] - (distance[vertices] - start[stream])
+    measure = down[stream] + m
+
+    # the stream on the mainstem containing the upstream measure
+    names, codes = numpy.unique(mainstems.astype(str), return_inverse = True)
+    keytype = [('mainstem', numpy.int64), ('measure', numpy.float64)]
+    order = numpy.lexsort((down, codes))
+    keys = numpy.empty(len(order), dtype = keytype)
+    keys['mainstem'] = codes[order]
+    keys['measure'] = down[order]
+
+    target = measure + window
+    targets = numpy.empty(len(vertices), dtype = keytype)
+    targets['mainstem'] = codes[stream]
+    targets['measure'] = target
+    found = numpy.searchsorted(keys, targets, side = 'right') - 1
+    upstream = order[numpy.maximum(found, 0)]
+    valid = (found >= 0) & (codes[upstream] == codes[stream]) & (target < up[upstream])
+
+    # the point with m value target - downstream measure on that stream
+    upm = target - down[upstream]
+    position = start[upstream] + length[upstream] - upm
+    valid &= upm <= length[upstream]
+    index = numpy.searchsorted(distance, position, side = 'right') - 1
+    index = numpy.clip(index, offsets[upstream], offsets[upstream + 1] - 2)
+    span = distance[index + 1] - distance[index]
+    fraction = numpy.divide(position - distance[index], span, out = numpy.zeros(len(span)), where = span > 0)
+    upcoords = coords[index] + fraction[:, None] * (coords[index + 1] - coords[index])
+
+    elevationA = coords[vertices, 2]
+    elevationB = upcoords[:, 2]
+    valid &= (elevationA != appconfig.NODATA) & (elevationB != appconfig.NODATA)
+
+    gradient = (elevationB - elevationA) / window
+    gradeClass = numpy.array(GRADE_CLASSES)[numpy.digitize(gradient, GRADE_BREAKS)]
+
+    return {
+        'mainstem': mainstems[stream][valid],
+        'measure': measure[valid],
+        'elevation_a': elevationA[valid],
+        'elevation_b': elevationB[valid],
+        'gradient': gradient[valid],
+        'grade_class': gradeClass[valid],
+        'vertex': numpy.column_stack([coords[vertices][valid], m[valid]]),
+        'upstream': numpy.column_stack([upcoords[valid], upm[valid]]),
+    }
+
+
+def computeVertexGradients(connection, window = gradientWindow):
+    """
+    Computes the vertex gradients of the streams and loads them into the
+    vertex gradient table (or the profile table, see vertex_profiles.py)
+    :param window: the distance upstream the gradients are computed over
+    """
+    mainstems, down, up, geometries = loadStreams(connection)
+    results = vertexGradients(mainstems, down, up, geometries, window)
+
+    vertex_profiles.dropVertexTables(connection)
+    if (vertex_profiles.storage == 'profile'):
+        vertex_profiles.saveProfiles(connection, results)
+        connection.commit()
+        print(f"""    {len(results['gradient'])} vertex gradients over {window} m""")
+        return
+
+    rows = io.StringIO()
+    for row in zip(results['mainstem'], results['measure'].tolist(), results['elevation_a'].tolist(),
+            results['elevation_b'].tolist(), results['gradient'].tolist(), results['grade_class'].tolist(),
+            results['vertex'].tolist(), results['upstream'].tolist()):
+        rows.write("\t".join([str(row[0])] + [repr(v) for v in row[1:5]] + [str(row[5])]
+            + [repr(v) for v in row[6] + row[7]]) + "\n")
+    rows.seek(0)
 
     query = f"""
-        DROP TABLE IF EXISTS {dbTargetSchema}.{dbVertexTable};
-         
-        CREATE TABLE {dbTargetSchema}.{dbVertexTable} AS 
-        SELECT
-            sv.{dbMainstemField},
-            sv.{dbDownMeasureField} as downstream_route_measure,
-            sv.elevation as elevation_a,
-            st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) as elevation_b,
-            (st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) - sv.elevation) / 100 as gradient,
-            sv.pnt as vertex_pnt,
-            ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ) as upstream_pnt    
-        FROM (
-           SELECT
-            s.{dbMainstemField},
-            (((1.0 - ST_LineLocatePoint(s.{db4dGeomField}, ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1)))) * st_length(s.{db4dGeomField})) + s.downstream_route_measure) as downstream_route_measure,
-            ST_Z(ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1))) AS elevation,
-            ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1)) as pnt
-            FROM {dbTargetSchema}.{dbTargetStreamTable} s
-            ORDER BY {dbMainstemField}, {dbDownMeasureField}
-        ) as sv
-        INNER JOIN {dbTargetSchema}.{dbTargetStreamTable} s2 ON sv.{dbMainstemField} = s2.{dbMainstemField} 
-          AND sv.{dbDownMeasureField} + 100 >= s2.{dbDownMeasureField} 
-          AND sv.{dbDownMeasureField} + 100 < s2.{dbUpMeasureField};
-          
-
-        DELETE FROM {dbTargetSchema}.{dbVertexTable} WHERE elevation_a = -999999 or elevation_b = -999999;
-        
-        ALTER TABLE {dbTargetSchema}.{dbVertexTable} ADD COLUMN grade_class smallint;
-        
-        UPDATE {dbTargetSchema}.{dbVertexTable} set grade_class = 
-          CASE
-              WHEN gradient >= .05 AND gradient < .07 THEN 5
-              WHEN gradient >= .07 AND gradient < .10 THEN 7
-              WHEN gradient >= .10 AND gradient < .12 THEN 10
-              WHEN gradient >= .12 AND gradient < .15 THEN 12
-              WHEN gradient >= .15 AND gradient < .20 THEN 15
-              WHEN gradient >= .20 AND gradient < .25 THEN 20
-              WHEN gradient >= .25 AND gradient < .30 THEN 25
-              WHEN gradient >= .30 THEN 30
-              ELSE 0
-        END;
+        DROP TABLE IF EXISTS vertex_gradient_load;
+
+        CREATE TEMPORARY TABLE vertex_gradient_load AS
+        SELECT {dbMainstemField},
+            0::double precision as downstream_route_measure,
+            0::double precision as elevation_a,
+            0::double precision as elevation_b,
+            0::double precision as gradient,
+            0::smallint as grade_class,
+            0::double precision as x, 0::double precision as y, 0::double precision as z, 0::double precision as m,
+            0::double precision as upx, 0::double precision as upy, 0::double precision as upz, 0::double precision as upm
+        FROM {dbTargetSchema}.{dbTargetStreamTable}
+        LIMIT 0;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        cursor.copy_expert("COPY vertex_gradient_load FROM STDIN", rows)
 
-        
-        alter table {dbTargetSchema}.{dbTargetStreamTable} 
-        drop column {db4dGeomField};
+    query = f"""
+        CREATE TABLE {dbTargetSchema}.{dbVertexTable} AS
+        SELECT
+            {dbMainstemField},
+            downstream_route_measure,
+            elevation_a,
+            elevation_b,
+            gradient,
+            st_setsrid(st_makepoint(x, y, z, m), {appconfig.dataSrid}) as vertex_pnt,
+            st_setsrid(st_multi(st_makepoint(upx, upy, upz, upm)), {appconfig.dataSrid}) as upstream_pnt,
+            grade_class
+        FROM vertex_gradient_load;
+
+        DROP TABLE vertex_gradient_load;
 
         ALTER TABLE  {dbTargetSchema}.{dbVertexTable} OWNER TO cwf_analyst;
     """
-    
-    # print(query)
     with connection.cursor() as cursor:
-        cursor.execute(query)    
-            
-    connection.commit()
-
+        cursor.execute(query)
 
+    connection.commit()
+    print(f"""    {len(results['gradient'])} vertex gradients over {window} m""")
 
 
 def main():
@@ -127,9 +239,6 @@ def main():
         conn.autocommit = False
         
         print("Computing Gradient")
-        print("  setting up tables")
-        setupGeometry(conn)
-        
         print("  computing vertex gradients")
         computeVertexGradients(conn)
         
@@ -0,0 +1,168 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script reads the dem corridor extract of a watershed: the dem cells
+# near the watershed streams (see build_dem_corridor.py), saved as numpy
+# files that are memory mapped when read.
+#
+# For each dem file the extract has the (row * columns + column) positions
+# of the cells, sorted, and their values in the type of the dem file.
+# corridor.json has the details of the dem files and the version of the dem
+# (see elevation_cache.demVersion) the cells were extracted from.
+#
+import appconfig
+import os
+import json
+import numpy
+import threading
+
+try:
+    from processing_scripts import dem_reader
+except ImportError:
+    import dem_reader
+
+iniSection = appconfig.args.args[0]
+
+runDirectory = appconfig.config['PROCESSING'].get('run_directory', fallback = 'runs')
+useCorridor = appconfig.config['ELEVATION_PROCESSING'].getboolean('use_dem_corridor', fallback = False)
+corridorDirectory = os.path.join(appconfig.config['ELEVATION_PROCESSING'].get('dem_corridor_directory', fallback = os.path.join(runDirectory, 'dem_corridor')), iniSection)
+corridorFile = os.path.join(corridorDirectory, 'corridor.json')
+
+readers = dict()
+lock = threading.Lock()
+
+
+class Corridor:
+    """
+    The dem corridor extract of the watershed
+    """
+
+    def __init__(self, directory, version, entries):
+        self.directory = directory
+        self.version = version
+        self.entries = entries
+
+    def demfiles(self):
+        """
+        :returns: the dem file details as dictionaries, in mosaic order
+        """
+        return [entry['details'] for entry in self.entries]
+
+    def reader(self, filename):
+        """
+        Returns the reader for the cells of the dem file, opening it the
+        first time
+        """
+        with lock:
+            key = (self.directory, filename)
+            if key not in readers:
+                entry = next((e for e in self.entries if e['details']['filename'] == filename), None)
+                if entry is None:
+                    raise Exception("dem file " + filename + " is not in the dem corridor extract " + self.directory)
+                readers[key] = CorridorReader(self.directory, entry)
+            return readers[key]
+
+
+class CorridorReader:
+    """
+    Reads cell values from the extract of one dem file; indexed the same
+    way as dem_reader.DemReader. Cells that are not in the extract are read
+    from the dem file if it is still available.
+    """
+
+    def __init__(self, directory, entry):
+        self.filename = entry['details']['filename']
+        self.cells = numpy.load(os.path.join(directory, entry['cells']), mmap_mode = 'r')
+        self.data = numpy.load(os.path.join(directory, entry['values']), mmap_mode = 'r')
+        self.dtype = self.data.dtype
+        self.shape = (entry['details']['ycnt'], entry['details']['xcnt'])
+
+    def values(self, rows, cols):
+        keys = numpy.asarray(rows, dtype = numpy.int64) * self.shape[1] + numpy.asarray(cols, dtype = numpy.int64)
+        values = numpy.empty(len(keys), dtype = self.dtype)
+        if (len(keys) == 0):
+            return values
+
+        found = numpy.zeros(len(keys), dtype = bool)
+        if (len(self.cells) > 0):
+            index = numpy.minimum(numpy.searchsorted(self.cells, keys), len(self.cells) - 1)
+            found = self.cells[index] == keys
+            values[found] = self.data[index[found]]
+
+        if not found.all():
+            if not os.path.exists(self.filename):
+                raise Exception("cells of " + self.filename + " are not in the dem corridor extract and the dem file is not available."
+                    + " Run build_dem_corridor again with the dem directory available.")
+            missing = ~found
+            values[missing] = dem_reader.getReader(self.filename).values(keys[missing] // self.shape[1], keys[missing] % self.shape[1])
+        return values
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if (numpy.ndim(rows) == 0):
+            return self.values([rows], [cols])[0]
+        return self.values(rows, cols)
+
+
+def load():
+    """
+    Returns the corridor extract of the watershed or None if it is not
+    used or has not been built
+    """
+    if not useCorridor or not os.path.exists(corridorFile):
+        return None
+    with open(corridorFile) as file:
+        data = json.load(file)
+    return Corridor(corridorDirectory, data['version'], data['files'])
+
+
+def save(version, extracts):
+    """
+    Saves the corridor extract, replacing the existing one
+    :param extracts: list of (dem file, cells, values) in mosaic order
+    """
+    os.makedirs(corridorDirectory, exist_ok = True)
+    closeReaders()
+
+    entries = []
+    for i, (demfile, cells, values) in enumerate(extracts):
+        entry = {'details': vars(demfile), 'cells': f"cells_{i}.npy", 'values': f"values_{i}.npy"}
+        numpy.save(os.path.join(corridorDirectory, entry['cells']), cells)
+        numpy.save(os.path.join(corridorDirectory, entry['values']), values)
+        entries.append(entry)
+
+    # the extract is only used once corridor.json is written
+    tempFile = corridorFile + "." + str(os.getpid())
+    with open(tempFile, "w") as file:
+        json.dump({'version': version, 'files': entries}, file, indent = 2)
+    os.replace(tempFile, corridorFile)
+
+
+def remove():
+    """
+    Removes the corridor extract so it is not used with other dem files
+    """
+    closeReaders()
+    if os.path.exists(corridorFile):
+        os.remove(corridorFile)
+
+
+def closeReaders():
+    with lock:
+        readers.clear()
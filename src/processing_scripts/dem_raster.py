@@ -0,0 +1,221 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script assigns elevations to the stream vertices in the database
+# (elevation_engine = postgis in the [ELEVATION_PROCESSING] section) instead
+# of sampling the dem files in python. Requires the postgis_raster extension.
+#
+# The dem files are loaded with raster2pgsql into the dem_raster_table in the
+# data schema, shared by all watersheds, and reloaded when the dem files
+# change (the dem version is saved as the table comment). With dem_raster_outdb
+# (default True) only the file names are stored in the database, so the
+# database server must be able to read the dem files at the same path and
+# allow out-db rasters (postgis.enable_outdb_rasters and
+# postgis.gdal_enabled_drivers).
+#
+# The elevations are computed with a single update using the same mosaic and
+# bilinear interpolation as assign_raw_z: each vertex is sampled with the
+# first dem file (in file name order) containing it and the four cells around
+# it are read with ST_Value from that file, or from the first file containing
+# the cell center for cells outside of it. The values are computed in double
+# precision so can differ from the python engine in the last digits for
+# float32 dem files.
+#
+import appconfig
+import os
+import subprocess
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+dbTargetTable = appconfig.config['PROCESSING']['stream_table']
+dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
+
+rasterTable = appconfig.dataSchema + "." + appconfig.config['ELEVATION_PROCESSING'].get('dem_raster_table', fallback = 'dem_raster')
+outdb = appconfig.config['ELEVATION_PROCESSING'].getboolean('dem_raster_outdb', fallback = True)
+tileSize = appconfig.config['ELEVATION_PROCESSING'].get('dem_raster_tile_size', fallback = '256x256')
+raster2pgsql = appconfig.config['OGR'].get('raster2pgsql', fallback = 'raster2pgsql')
+
+
+def loadRasters(connection, demfiles, version):
+    """
+    Loads the dem files into the raster table unless it already has
+    this version of the dem
+    """
+    with connection.cursor() as cursor:
+        # watersheds processed at the same time take turns loading the table
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (rasterTable,))
+        cursor.execute("SELECT obj_description(to_regclass(%s), 'pg_class')", (rasterTable,))
+        if (cursor.fetchone()[0] == version):
+            connection.commit()
+            return
+
+        print("    loading dem files into " + rasterTable)
+        cursor.execute(f"""DROP TABLE IF EXISTS {rasterTable}""")
+        for i, demfile in enumerate(demfiles):
+            print("    loading: " + demfile.filename)
+            command = [raster2pgsql, "-c" if i == 0 else "-a", "-s", str(demfile.srid), "-t", tileSize, "-F", "-e"]
+            if outdb:
+                command.append("-R")
+            command += [os.path.abspath(demfile.filename), rasterTable]
+            loadStatements(cursor, command)
+
+        cursor.execute(f"""
+            CREATE INDEX ON {rasterTable} USING gist (st_convexhull(rast));
+            CREATE INDEX ON {rasterTable} (filename);
+            COMMENT ON TABLE {rasterTable} IS %s;
+            ANALYZE {rasterTable};
+        """, (version,))
+    connection.commit()
+
+
+def loadStatements(cursor, command):
+    """
+    Runs the statements written by raster2pgsql one at a time so the
+    whole file is never held in memory
+    """
+    process = subprocess.Popen(command, stdout = subprocess.PIPE, text = True)
+    statement = ""
+    for line in process.stdout:
+        statement += line
+        if not statement.rstrip().endswith(";"):
+            continue
+        # the load is part of the transaction holding the table lock
+        if statement.strip().upper() not in ("BEGIN;", "END;", "COMMIT;"):
+            cursor.execute(statement)
+        statement = ""
+    if process.wait() != 0:
+        raise Exception("raster2pgsql failed loading " + command[-2])
+
+
+def assignElevations(connection, demfiles, watershed_id):
+    """
+    Computes the elevations of the stream vertices from the raster table
+    """
+    # the file details are query parameters so values such as a nan nodata
+    # (common for float dems) are passed as numbers; raster2pgsql saves the
+    # file name without the directory
+    files = ",".join(["(%s::integer, %s::varchar" + ", %s::double precision" * 6
+        + ", %s::bigint, %s::bigint, %s::double precision)"] * len(demfiles))
+    values = []
+    for i, f in enumerate(demfiles):
+        values += [i, os.path.basename(f.filename), f.xmin, f.ymin, f.xmax, f.ymax, f.xcellsize, abs(f.ycellsize),
+            f.xcnt, f.ycnt, f.nodata]
+    srid = demfiles[0].srid
+
+    # value of a cell (by its center) from the file containing it: the home
+    # file if the cell is in it or else the first file containing the center.
+    # postgres treats NaN as equal to NaN so the nodata comparisons here and
+    # below also match a nan nodata value
+    def cornerValue(corner, col, row, cx, cy):
+        return f"""
+        LEFT JOIN LATERAL (
+            SELECT CASE WHEN o.ord = c.ord THEN v.value
+                WHEN v.value = o.nodata OR v.value IS NULL THEN {appconfig.NODATA}
+                ELSE v.value END as value
+            FROM (
+                SELECT c.ord, c.filename, c.nodata
+                WHERE {col} >= 0 AND {col} < c.xcnt AND {row} >= 0 AND {row} < c.ycnt
+                UNION ALL
+                (SELECT f.ord, f.filename, f.nodata
+                FROM files f
+                WHERE NOT ({col} >= 0 AND {col} < c.xcnt AND {row} >= 0 AND {row} < c.ycnt)
+                AND {cx} BETWEEN f.xmin AND f.xmax AND {cy} BETWEEN f.ymin AND f.ymax
+                AND floor(({cx} - f.xmin) / f.xsize) < f.xcnt
+                AND floor(({cy} - f.ymin) / f.ysize) < f.ycnt
+                ORDER BY f.ord LIMIT 1)
+            ) o
+            CROSS JOIN LATERAL (
+                SELECT st_value(r.rast, 1, st_setsrid(st_point({cx}, {cy}), {srid}), false) as value
+                FROM {rasterTable} r
+                WHERE r.filename = o.filename AND st_intersects(r.rast, st_setsrid(st_point({cx}, {cy}), {srid}))
+                LIMIT 1
+            ) v
+        ) {corner} ON true"""
+
+    query = f"""
+        WITH files (ord, filename, xmin, ymin, xmax, ymax, xsize, ysize, xcnt, ycnt, nodata) AS (
+            VALUES {files}
+        ),
+        vertices AS (
+            SELECT t.{appconfig.dbIdField} as id, (dp).path[1] as vertex, (dp).geom as pnt,
+                st_transform((dp).geom, {srid}) as dempnt
+            FROM (
+                SELECT t.{appconfig.dbIdField}, st_dumppoints(t.{dbTargetGeom}) as dp
+                FROM {dbTargetSchema}.{dbTargetTable} t
+                WHERE t.{appconfig.dbWatershedIdField} IN {watershed_id}
+            ) t
+        ),
+        home AS (
+            SELECT v.id, v.vertex, v.pnt, st_x(v.dempnt) as x, st_y(v.dempnt) as y, f.*,
+                floor((st_x(v.dempnt) - f.xmin) / f.xsize)::bigint as xindex,
+                f.ycnt - floor((st_y(v.dempnt) - f.ymin) / f.ysize)::bigint - 1 as yindex
+            FROM vertices v
+            CROSS JOIN LATERAL (
+                SELECT * FROM files f
+                WHERE st_x(v.dempnt) BETWEEN f.xmin AND f.xmax AND st_y(v.dempnt) BETWEEN f.ymin AND f.ymax
+                ORDER BY f.ord LIMIT 1
+            ) f
+        ),
+        cells AS (
+            SELECT h.*,
+                CASE WHEN h.x < h.xindex * h.xsize + h.xmin + 0.5 * h.xsize THEN h.xindex - 1 ELSE h.xindex + 1 END as xindex2,
+                CASE WHEN h.y < (h.ycnt - h.yindex - 1) * h.ysize + h.ymin + 0.5 * h.ysize THEN h.yindex + 1 ELSE h.yindex - 1 END as yindex2
+            FROM home h
+        ),
+        centers AS (
+            SELECT c.*,
+                c.xindex * c.xsize + c.xmin + 0.5 * c.xsize as x1,
+                c.xindex2 * c.xsize + c.xmin + 0.5 * c.xsize as x2,
+                (c.ycnt - c.yindex - 1) * c.ysize + c.ymin + 0.5 * c.ysize as y1,
+                (c.ycnt - c.yindex2 - 1) * c.ysize + c.ymin + 0.5 * c.ysize as y2
+            FROM cells c
+        ),
+        corners AS (
+            SELECT c.id, c.vertex, c.pnt, c.x, c.y, c.x1, c.x2, c.y1, c.y2, c.nodata,
+                coalesce(z11.value, {appconfig.NODATA}) as zx1y1, coalesce(z21.value, {appconfig.NODATA}) as zx2y1,
+                coalesce(z22.value, {appconfig.NODATA}) as zx2y2, coalesce(z12.value, {appconfig.NODATA}) as zx1y2
+            FROM centers c
+            {cornerValue("z11", "c.xindex", "c.yindex", "c.x1", "c.y1")}
+            {cornerValue("z21", "c.xindex2", "c.yindex", "c.x2", "c.y1")}
+            {cornerValue("z22", "c.xindex2", "c.yindex2", "c.x2", "c.y2")}
+            {cornerValue("z12", "c.xindex", "c.yindex2", "c.x1", "c.y2")}
+        ),
+        elevations AS (
+            SELECT c.id, c.vertex,
+                CASE WHEN {appconfig.NODATA} IN (c.zx1y1, c.zx2y1, c.zx2y2, c.zx1y2) THEN NULL
+                WHEN c.nodata IN (c.zx1y1, c.zx2y1, c.zx2y2, c.zx1y2) THEN {appconfig.NODATA}
+                ELSE ((c.y2 - c.y) / (c.y2 - c.y1)) * (((c.x2 - c.x) / (c.x2 - c.x1)) * c.zx1y1 + ((c.x - c.x1) / (c.x2 - c.x1)) * c.zx2y1)
+                    + ((c.y - c.y1) / (c.y2 - c.y1)) * (((c.x2 - c.x) / (c.x2 - c.x1)) * c.zx1y2 + ((c.x - c.x1) / (c.x2 - c.x1)) * c.zx2y2)
+                END as z
+            FROM corners c
+        ),
+        lines AS (
+            SELECT v.id, st_makeline(st_makepoint(st_x(v.pnt), st_y(v.pnt), coalesce(e.z, st_z(v.pnt))) ORDER BY v.vertex) as geometry
+            FROM vertices v LEFT JOIN elevations e ON e.id = v.id AND e.vertex = v.vertex
+            GROUP BY v.id
+            HAVING count(e.z) > 0
+        )
+        UPDATE {dbTargetSchema}.{dbTargetTable} t
+        SET {dbTargetGeom} = st_setsrid(l.geometry, {appconfig.dataSrid})
+        FROM lines l
+        WHERE t.{appconfig.dbIdField} = l.id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, values)
+    connection.commit()
@@ -0,0 +1,190 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script reads dem cell values from tif files without loading the
+# whole file into memory. Tif files are stored in blocks (tiles or strips);
+# only the blocks containing the requested cells are read and decoded.
+# Uncompressed files that can be memory mapped are read through a memory map
+# instead (the operating system reads the pages that are used).
+#
+# Decoded blocks are kept in a least recently used cache shared by all the
+# files, limited to dem_cache_size MB ([ELEVATION_PROCESSING] section,
+# default 512). The cache hit statistics are printed by assign_raw_z once
+# it is done.
+#
+import appconfig
+import collections
+import numpy
+import threading
+import tifffile as tif
+
+cacheSize = appconfig.config['ELEVATION_PROCESSING'].getint('dem_cache_size', fallback = 512) * 1024 * 1024
+
+readers = dict()
+lock = threading.Lock()
+
+class BlockCache:
+    """
+    Least recently used cache of decoded dem blocks
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.blocks = collections.OrderedDict()
+        self.size = 0
+        self.peakSize = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytesRead = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """
+        Returns the block for the key, calling load() to read it if it
+        is not in the cache
+        """
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+
+        block = load()
+
+        with self.lock:
+            self.misses += 1
+            self.bytesRead += block.nbytes
+            if key not in self.blocks:
+                self.blocks[key] = block
+                self.size += block.nbytes
+            # always keep the newest block even if it is bigger than the cache
+            while self.size > self.maxBytes and len(self.blocks) > 1:
+                oldkey, oldblock = self.blocks.popitem(last = False)
+                self.size -= oldblock.nbytes
+            self.peakSize = max(self.peakSize, self.size)
+        return block
+
+    def counters(self):
+        with self.lock:
+            return [self.hits, self.misses, self.bytesRead]
+
+    def add(self, counters):
+        """
+        Adds the statistics of a cache in another process
+        """
+        with self.lock:
+            self.hits += counters[0]
+            self.misses += counters[1]
+            self.bytesRead += counters[2]
+
+    def report(self):
+        requests = self.hits + self.misses
+        hitrate = 100 * self.hits / requests if requests > 0 else 0
+        return (f"""dem block cache: {self.hits} hits, {self.misses} misses ({hitrate:.1f}% hit rate), """
+            f"""{self.bytesRead / 1048576:.1f} MB decoded, peak size {self.peakSize / 1048576:.1f} MB""")
+
+cache = BlockCache(cacheSize)
+
+
+class DemReader:
+    """
+    Reads cell values from a single band tif file. Index with arrays of
+    rows and columns (reader[rows, cols]) or a single row and column.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tiff = tif.TiffFile(filename)
+        self.page = self.tiff.pages[0]
+        self.dtype = self.page.dtype
+        self.shape = (self.page.imagelength, self.page.imagewidth)
+        self.blockHeight = self.page.chunks[0]
+        self.blockWidth = self.page.chunks[1]
+        self.blocksAcross = self.page.chunked[1]
+        self.lock = threading.Lock()
+
+        self.memmap = None
+        if (self.page.is_memmappable):
+            self.memmap = self.page.asarray(out = 'memmap')
+
+    def readBlock(self, index):
+        offset = self.page.dataoffsets[index]
+        count = self.page.databytecounts[index]
+        if (count == 0):
+            return numpy.full((self.blockHeight, self.blockWidth), self.page.nodata, dtype = self.dtype)
+
+        with self.lock:
+            self.tiff.filehandle.seek(offset)
+            data = self.tiff.filehandle.read(count)
+
+        segment, indices, shape = self.page.decode(data, index, jpegtables = self.page.jpegtables)
+        return segment.reshape(shape[-3], shape[-2])
+
+    def values(self, rows, cols):
+        """
+        Returns the values of the cells, reading each block once
+        """
+        rows = numpy.asarray(rows, dtype = numpy.int64)
+        cols = numpy.asarray(cols, dtype = numpy.int64)
+        if (self.memmap is not None):
+            return self.memmap[rows, cols]
+
+        values = numpy.empty(len(rows), dtype = self.dtype)
+
+        blocks = (rows // self.blockHeight) * self.blocksAcross + cols // self.blockWidth
+        order = numpy.argsort(blocks, kind = 'stable')
+        sortedBlocks = blocks[order]
+        starts = numpy.flatnonzero(numpy.diff(sortedBlocks)) + 1
+        for group in numpy.split(order, starts):
+            if (len(group) == 0):
+                continue
+            index = int(blocks[group[0]])
+            block = cache.get((self.filename, index), lambda: self.readBlock(index))
+            row0 = (index // self.blocksAcross) * self.blockHeight
+            col0 = (index % self.blocksAcross) * self.blockWidth
+            values[group] = block[rows[group] - row0, cols[group] - col0]
+        return values
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if (numpy.ndim(rows) == 0):
+            return self.values([rows], [cols])[0]
+        return self.values(rows, cols)
+
+    def close(self):
+        self.memmap = None
+        self.tiff.close()
+
+
+def getReader(filename):
+    """
+    Returns the reader for the file, opening it the first time
+    """
+    with lock:
+        if filename not in readers:
+            readers[filename] = DemReader(filename)
+        return readers[filename]
+
+
+def closeReaders():
+    with lock:
+        for reader in readers.values():
+            reader.close()
+        readers.clear()
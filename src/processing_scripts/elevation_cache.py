@@ -0,0 +1,160 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script keeps the elevations sampled from the dem for stream vertices
+# in a file so assign_raw_z only samples vertices it has not seen before
+# (for example the vertices added when the streams are broken at barriers).
+#
+# Vertices are keyed on the dem srid and their x and y coordinates snapped to
+# elevation_cache_snap dem units ([ELEVATION_PROCESSING] section, default
+# 0.001). The cache is saved with a version computed from the dem files
+# (names, sizes, modification times and details) and is emptied when the dem
+# files change.
+#
+import appconfig
+import os
+import hashlib
+import json
+import numpy
+
+runDirectory = appconfig.config['PROCESSING'].get('run_directory', fallback = 'runs')
+cacheFile = appconfig.config['ELEVATION_PROCESSING'].get('elevation_cache_file', fallback = os.path.join(runDirectory, 'elevation_cache.npz'))
+snap = appconfig.config['ELEVATION_PROCESSING'].getfloat('elevation_cache_snap', fallback = 0.001)
+
+keyType = numpy.dtype([('srid', numpy.int32), ('x', numpy.int64), ('y', numpy.int64)])
+
+
+def demVersion(entries):
+    """
+    Returns the version of the dem for the dem index entries
+    :param entries: list of the dem index entries in mosaic order
+    """
+    text = json.dumps([entries, snap], sort_keys = True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class ElevationCache:
+    """
+    Sampled vertex elevations for one version of the dem. A value of nan
+    means the vertex could not be sampled (it is left as is).
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.keys = numpy.empty(0, dtype = keyType)
+        self.values = numpy.empty(0, dtype = numpy.float64)
+        self.newKeys = []
+        self.newValues = []
+        self.hits = 0
+        self.misses = 0
+
+    def makeKeys(self, srid, x, y):
+        keys = numpy.empty(len(x), dtype = keyType)
+        keys['srid'] = int(srid)
+        keys['x'] = numpy.round(numpy.asarray(x) / snap)
+        keys['y'] = numpy.round(numpy.asarray(y) / snap)
+        return keys
+
+    def load(self):
+        if not os.path.exists(cacheFile):
+            return
+        try:
+            with numpy.load(cacheFile) as data:
+                if (str(data['version']) != self.version):
+                    print("    dem files changed, elevation cache " + cacheFile + " not used")
+                    return
+                self.keys = data['keys']
+                self.values = data['values']
+        except (ValueError, KeyError, OSError):
+            print("    elevation cache " + cacheFile + " could not be read, not used")
+
+    def lookup(self, srid, x, y):
+        """
+        Finds the vertices in the cache
+        :returns: mask of the vertices found and their values
+        """
+        keys = self.makeKeys(srid, x, y)
+        found = numpy.zeros(len(keys), dtype = bool)
+        values = numpy.full(len(keys), numpy.nan)
+        if (len(self.keys) > 0 and len(keys) > 0):
+            index = numpy.minimum(numpy.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = self.keys[index] == keys
+            values[found] = self.values[index[found]]
+        self.hits += int(found.sum())
+        self.misses += len(keys) - int(found.sum())
+        return found, values
+
+    def add(self, srid, x, y, values):
+        """
+        Adds sampled vertices, use nan for vertices that could not be sampled
+        """
+        if (len(x) == 0):
+            return
+        self.newKeys.append(self.makeKeys(srid, x, y))
+        self.newValues.append(numpy.asarray(values, dtype = numpy.float64))
+
+    def merge(self, keys, values):
+        """
+        Merges new entries into the cache; existing entries are kept
+        """
+        keys = numpy.concatenate([self.keys, keys])
+        values = numpy.concatenate([self.values, values])
+        keys, first = numpy.unique(keys, return_index = True)
+        self.keys = keys
+        self.values = values[first]
+
+    def save(self):
+        """
+        Adds the new entries to the cache file. Entries saved by another
+        process since the cache was loaded are kept; processes take turns
+        updating the file by holding a database advisory lock on it.
+        """
+        if not self.newKeys:
+            return
+        keys = numpy.concatenate(self.newKeys)
+        values = numpy.concatenate(self.newValues)
+        self.newKeys = []
+        self.newValues = []
+
+        conn = appconfig.connectdb()
+        try:
+            # the lock is released when the connection is closed
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (os.path.abspath(cacheFile),))
+
+            saved = ElevationCache(self.version)
+            saved.load()
+            saved.merge(self.keys, self.values)
+            saved.merge(keys, values)
+            self.keys = saved.keys
+            self.values = saved.values
+
+            directory = os.path.dirname(cacheFile)
+            if directory:
+                os.makedirs(directory, exist_ok = True)
+            # write to a temporary file and replace the cache in one step
+            tempFile = cacheFile + "." + str(os.getpid())
+            with open(tempFile, "wb") as file:
+                numpy.savez(file, version = numpy.array(self.version), keys = self.keys, values = self.values)
+            os.replace(tempFile, cacheFile)
+        finally:
+            conn.close()
+
+    def report(self):
+        return f"""elevation cache: {self.hits} vertices found, {self.misses} not found, {len(self.keys)} vertices saved"""
@@ -75,13 +75,11 @@ def main():
                 FROM {datatable} ais
                 CROSS JOIN LATERAL
                 (
-                    WITH RECURSIVE upstream(id, geometry) AS (
-                        SELECT id, geometry FROM {iniSection}.{streamTable} WHERE id = ais.stream_id
-                        UNION ALL
-                        SELECT n.id, n.geometry
-                        FROM {iniSection}.{streamTable} n, upstream w
-                        WHERE ST_DWithin(ST_StartPoint(w.geometry),ST_EndPoint(n.geometry),0.01)
-                        AND n.id IS NOT NULL
+                    WITH upstream AS (
+                        SELECT n.id
+                        FROM {iniSection}.{streamTable} n, {iniSection}.{streamTable} s
+                        WHERE s.id = ais.stream_id
+                        AND n.network_pre BETWEEN s.network_pre AND s.network_post
                     )
                     SELECT u.id as stream_id, b.id as barrier_id, b.barrier_cnt_downstr_as
                     FROM upstream u
@@ -112,13 +110,11 @@ def main():
                 FROM {datatable} ais
                 CROSS JOIN LATERAL
                 (
-                    WITH RECURSIVE downstream(id, geometry) AS (
-                        SELECT id, geometry FROM {iniSection}.{streamTable} WHERE id = ais.stream_id
-                        UNION ALL
-                        SELECT n.id, n.geometry
-                        FROM {iniSection}.{streamTable} n, downstream w
-                        WHERE ST_DWithin(ST_EndPoint(w.geometry),ST_StartPoint(n.geometry),0.01)
-                        AND n.id IS NOT NULL
+                    WITH downstream AS (
+                        SELECT n.id
+                        FROM {iniSection}.{streamTable} n, {iniSection}.{streamTable} s
+                        WHERE s.id = ais.stream_id
+                        AND s.network_pre BETWEEN n.network_pre AND n.network_post
                     )
                     SELECT d.id as stream_id, b.id as barrier_id, b.barrier_cnt_upstr_as
                     FROM downstream d
@@ -22,6 +22,11 @@
 import appconfig
 import ast
 
+try:
+    from processing_scripts import stream_network
+except ImportError:
+    import stream_network
+
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
 
@@ -144,6 +149,11 @@ def main():
             with conn.cursor() as cursor:
                 cursor.execute(query)
             conn.commit()
+
+        stream_network.updateNodes(conn)
+        stream_network.updateNestedSets(conn)
+
+    stream_network.invalidate()
         
     print(f"""Initializing processing for watershed {workingWatershedId} complete.""")
 
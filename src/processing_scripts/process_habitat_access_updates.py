@@ -78,31 +78,20 @@ def getUpstreamDownstream(conn):
         AS $$
         BEGIN
 
-        IF limit_id IS NOT NULL THEN
-            RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
-                UNION ALL
-                SELECT n.id, n.geometry
-                FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_EndPoint(w.geometry),ST_StartPoint(n.geometry),0.01)
-                and n.id != $2
-            )
-            SELECT id FROM walk_network;
-
-        ELSE
-            RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
-                UNION ALL
-                SELECT n.id, n.geometry
-                FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_EndPoint(w.geometry),ST_StartPoint(n.geometry),0.01)
-                and n.id IS NOT NULL
-            )
-            SELECT id FROM walk_network;
-
-        END IF;
+        -- the streams whose upstream range contains the stream, stopping
+        -- before limit_id if it is downstream of the stream
+        RETURN QUERY
+        SELECT n.id
+        FROM {dbTargetSchema}.{dbTargetStreamTable} n, {dbTargetSchema}.{dbTargetStreamTable} s
+        WHERE s.id = $1
+        AND s.network_pre BETWEEN n.network_pre AND n.network_post
+        AND NOT EXISTS (
+            SELECT 1 FROM {dbTargetSchema}.{dbTargetStreamTable} l
+            WHERE l.id = $2
+            AND s.network_pre BETWEEN l.network_pre AND l.network_post
+            AND l.network_pre BETWEEN n.network_pre AND n.network_post
+        );
+
         END; $$
         IMMUTABLE;
 
@@ -113,31 +102,19 @@ def getUpstreamDownstream(conn):
         AS $$
         BEGIN
 
-        IF limit_id IS NOT NULL THEN
-            RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
-                UNION ALL
-                SELECT n.id, n.geometry
-                FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_StartPoint(w.geometry),ST_EndPoint(n.geometry),0.01)
-                and n.id != $2
-            )
-            SELECT id FROM walk_network;
-
-        ELSE
-            RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
-                UNION ALL
-                SELECT n.id, n.geometry
-                FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_StartPoint(w.geometry),ST_EndPoint(n.geometry),0.01)
-                and n.id IS NOT NULL
-            )
-            SELECT id FROM walk_network;
-
-        END IF;
+        -- the streams in the upstream range of the stream, excluding
+        -- limit_id and the streams upstream of it
+        RETURN QUERY
+        SELECT n.id
+        FROM {dbTargetSchema}.{dbTargetStreamTable} n, {dbTargetSchema}.{dbTargetStreamTable} s
+        WHERE s.id = $1
+        AND n.network_pre BETWEEN s.network_pre AND s.network_post
+        AND NOT EXISTS (
+            SELECT 1 FROM {dbTargetSchema}.{dbTargetStreamTable} l
+            WHERE l.id = $2
+            AND n.network_pre BETWEEN l.network_pre AND l.network_post
+        );
+
         END; $$
         IMMUTABLE;
     """
@@ -25,6 +25,11 @@ import networkx as nx
 import shapely.wkb
 from tqdm import tqdm
 
+try:
+    from processing_scripts import stream_network
+except ImportError:
+    import stream_network
+
 import sys
 
 iniSection = appconfig.args.args[0]
@@ -191,6 +196,8 @@ def main():
         print("  deleting isolated flowpaths")
         deleteIsolated(conn)
 
+    stream_network.invalidate()
+
     print("done")
 
 
@@ -19,11 +19,39 @@
 #
 # Smooths raw elevation values to ensure hydro network flows downhill
 #
+# Two methods can be chosen with smoothing_method in the [ELEVATION_PROCESSING]
+# section:
+#   envelope (default) - the node elevations are the average of the maximum
+#     elevation downstream and minimum elevation upstream of the node, and the
+#     vertices of each edge the average of the running minimum and maximum
+#     between its end nodes
+#   isotonic - the closest (least squares) non-increasing profile is fitted
+#     to the vertices of each edge with the pool adjacent violators algorithm,
+#     visiting the edges from the sources down. An edge's profile starts no
+#     higher than its upstream node, and a node is given the lowest of the
+#     fitted ends of the edges flowing into it. Vertices without data are
+#     given the elevation of the vertex before them.
+#
+# The smoothed geometries are updated in place: the inputs each edge was
+# smoothed from (the method, its raw geometry and the elevations of its end
+# nodes) are saved as a hash in the <smoothedgeometry_field>_state column and
+# only the edges whose inputs changed since the last run are written. The
+# node elevations are always computed for the whole network (so edges that
+# are split or removed upstream or downstream are accounted for); with the
+# envelope method only the changed edges are smoothed, the isotonic profiles
+# are fitted for the whole network as a node depends on the fitted ends of
+# all the edges flowing into it.
+#
 import appconfig
-import shapely.wkb
-import shapely.geometry
+import hashlib
+import numpy
+import shapely
 import psycopg2.extras
-from collections import deque
+
+try:
+    from processing_scripts import stream_network
+except ImportError:
+    import stream_network
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -31,220 +59,325 @@ dbTargetTable = appconfig.config['PROCESSING']['stream_table']
 
 dbSourceGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
-    
-edges = []
-nodes = dict()
+dbStateField = dbTargetGeom + "_state"
 
-class Node:
+METHODS = ['envelope', 'isotonic']
+smoothingMethod = appconfig.config['ELEVATION_PROCESSING'].get('smoothing_method', fallback = 'envelope')
     
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.z = appconfig.NODATA
-        self.minvalue = self.z
-        self.maxvalue = self.z
-        
+network = None
+geometries = None
+nodez = None
 
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-        self.addZ(edge.ls.coords[len(edge.ls.coords) - 1][2])
+# the vertices of all the edges: the vertices of edge i are
+# offsets[i] to offsets[i + 1] - 1
+coords = None
+offsets = None
+newz = None
 
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-        self.addZ(edge.ls.coords[0][2])
-    
-    def addZ(self, z):
-        if (self.z == appconfig.NODATA or self.z == z):
-            self.z = z
-        else:
-            print("DIFFERENT Z VALUES AT SAME POSITION: POINT(" + str(self.x) + " " + str(self.y) + "): " +str(self.x) + " " +str(z))
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.newz = [appconfig.NODATA for i in range(len(ls.coords))]
+# md5 of each edge's raw geometry, the state saved with its smoothed geometry
+# and the upstream bound of its isotonic profile
+rawHash = None
+savedState = None
+bounds = None
+
+def addZ(node, z):
+    if (nodez[node] == appconfig.NODATA or nodez[node] == z):
+        nodez[node] = z
+    else:
+        x = network.nodeX[node]
+        y = network.nodeY[node]
+        print("DIFFERENT Z VALUES AT SAME POSITION: POINT(" + str(x) + " " + str(y) + "): " +str(x) + " " +str(z))
         
 def createNetwork(connection):
+    global network, geometries, nodez, coords, offsets, newz, rawHash, savedState
+
+    network = stream_network.getNetwork(connection)
+    geometries = numpy.empty(network.edgeCount, dtype = object)
+    nodez = network.nodeArray(fill = appconfig.NODATA)
+    rawHash = numpy.empty(network.edgeCount, dtype = object)
+    savedState = numpy.empty(network.edgeCount, dtype = object)
+
+    # the saved states are missing until the step has run (for example
+    # when run by benchmark_smoothing.py), every edge is then smoothed
+    query = """
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s AND column_name = %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, (dbTargetSchema, dbTargetTable, dbStateField))
+        state = dbStateField if cursor.fetchone() is not None else "NULL::varchar"
+
+    # the raw elevation geometries are the attributes for this step, the
+    # topology comes from the shared network
     query = f"""
-        SELECT {appconfig.dbIdField}, {dbSourceGeom}
+        SELECT {appconfig.dbIdField}, {dbSourceGeom}, md5(st_asbinary({dbSourceGeom})), {state}
         FROM {dbTargetSchema}.{dbTargetTable}
     """
    
-    #load geometries and create a network
+    #load geometries onto the network edges
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
-        
-        
-        for feature in features:
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            fid = feature[0]
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
+
+    edges = [network.edgeIndex[feature[0]] for feature in features]
+    geometries[edges] = shapely.from_wkb([feature[1] for feature in features])
+    rawHash[edges] = [feature[2] for feature in features]
+    savedState[edges] = [feature[3] for feature in features]
+
+    offsets = numpy.concatenate([[0], numpy.cumsum(shapely.get_num_coordinates(geometries))])
+    coords = shapely.get_coordinates(geometries, include_z = True)
+    newz = numpy.full(len(coords), appconfig.NODATA, dtype = numpy.float64)
+
+    for edge in edges:
+        addZ(network.fromNode[edge], coords[offsets[edge], 2])
+        addZ(network.toNode[edge], coords[offsets[edge + 1] - 1, 2])
 
 def processNodes():
     
+    fromNode = network.fromNode
+    toNode = network.toNode
+    
     #walk up network
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-            node.maxvalue = node.z
+    maxvalue = network.nodeArray(fill = appconfig.NODATA)
+    outlets = network.outDegree() == 0
+    maxvalue[outlets] = nodez[outlets]
     
-    while (toprocess):
-        node = toprocess.popleft()
+    for node in network.upstreamSweep():
         
-        allvisited = True
-        for outedge in node.outedges:
-            if not outedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for inedge in node.inedges:
-                inedge.fromNode.maxvalue = max(node.maxvalue, inedge.fromNode.z)
-                inedge.visited = True
-                toprocess.append(inedge.fromNode)
+        #visit this node
+        for inedge in network.inEdges(node):
+            upnode = fromNode[inedge]
+            maxvalue[upnode] = max(maxvalue[node], nodez[upnode])
     
     #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        node.minvalue = node.z
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
+    minvalue = nodez.copy()
      
-    while (toprocess):
-        node = toprocess.popleft()
+    for node in network.downstreamSweep():
         
-        allvisited = True
-        for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for outedge in node.outedges:
-                if (node.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = outedge.toNode.minvalue 
-                elif (outedge.toNode.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = node.minvalue
-                else: 
-                    outedge.toNode.minvalue = min(node.minvalue, outedge.toNode.minvalue)
-                                   
-                outedge.visited = True
-                
-                if (outedge.toNode in toprocess):
-                    toprocess.remove(outedge.toNode)
-                toprocess.append(outedge.toNode)     
+        #visit this node
+        for outedge in network.outEdges(node):
+            downnode = toNode[outedge]
+            if (minvalue[node] == appconfig.NODATA):
+                minvalue[downnode] = minvalue[downnode] 
+            elif (minvalue[downnode] == appconfig.NODATA):
+                minvalue[downnode] = minvalue[node]
+            else: 
+                minvalue[downnode] = min(minvalue[node], minvalue[downnode])
     
     #update z values 
-    for node in nodes.values():
-        if (node.maxvalue == appconfig.NODATA or node.minvalue == appconfig.NODATA):
-            node.z = appconfig.NODATA
-        else:
-            node.z = (node.maxvalue + node.minvalue) / 2.0
+    nodata = (maxvalue == appconfig.NODATA) | (minvalue == appconfig.NODATA)
+    nodez[:] = numpy.where(nodata, appconfig.NODATA, (maxvalue + minvalue) / 2.0)
         
-    for edge in edges:
-        edge.newz[0] = edge.fromNode.z
-        edge.newz[len(edge.ls.coords)-1] = edge.toNode.z
+    newz[offsets[:-1]] = nodez[fromNode]
+    newz[offsets[1:] - 1] = nodez[toNode]
 
 
-def processEdges():   
-    
-    for edge in edges:             
-        ls = edge.ls
-        
-        size = len(ls.coords)
-        
-        minvalues = [appconfig.NODATA] * size
-        maxvalues = [appconfig.NODATA] * size
-        
-        absmax = edge.newz[0]
-        absmin = edge.newz[size - 1]
-        
-        minvalues [0] = edge.newz[0]
-        maxvalues [size - 1] = edge.newz[size - 1]
-        
-        
-        for i in range(1, size):
-            temp = ls.coords[i][2]
-            if (temp < absmin):
-                temp = absmin
-            minv = min(temp, minvalues[i-1])
-            minvalues[i] = minv
-            
-            temp = ls.coords[size - 1 - i][2]
-            if (temp > absmax):
-                temp = absmax
-            maxv = max(temp, maxvalues[size - i])
-            maxvalues [size - 1 - i ] = maxv
-        
-        for i in range(0, size):
-            if minvalues[i] == appconfig.NODATA or maxvalues[i] == appconfig.NODATA:
-                edge.newz[i] = appconfig.NODATA
+def edgeGroups(edges):
+    """
+    Groups the edges by their number of vertices (up to the next power of
+    two) so each group can be processed as a padded 2d array
+    :returns: list of the arrays of edges in each group
+    """
+    sizes = offsets[edges + 1] - offsets[edges]
+    buckets = numpy.ceil(numpy.log2(sizes)).astype(numpy.int64)
+    order = numpy.argsort(buckets, kind = 'stable')
+    starts = numpy.flatnonzero(numpy.diff(buckets[order])) + 1
+    return [group for group in numpy.split(edges[order], starts) if len(group) > 0]
+
+
+def smoothEdges(edges):
+    """
+    Smooths the vertices between the end nodes of the edges, all edges
+    with a similar number of vertices at once. The running minimum from
+    the upstream end (limited below by the downstream end) and running
+    maximum from the downstream end (limited above by the upstream end) are
+    averaged; vertices where either is NODATA get NODATA.
+    """
+    sizes = offsets[edges + 1] - offsets[edges]
+    width = sizes.max()
+    steps = numpy.arange(width)
+    valid = steps[None, :] < sizes[:, None]
+
+    # vertex positions in each row, from upstream and from downstream
+    forward = numpy.where(valid, offsets[edges][:, None] + steps[None, :], 0)
+    backward = numpy.where(valid, offsets[edges + 1][:, None] - 1 - steps[None, :], 0)
+
+    absmax = newz[offsets[edges]][:, None]
+    absmin = newz[offsets[edges + 1] - 1][:, None]
+
+    minvalues = numpy.maximum(coords[forward, 2], absmin)
+    minvalues[:, 0] = absmax[:, 0]
+    minvalues = numpy.minimum.accumulate(minvalues, axis = 1)
+
+    maxvalues = numpy.minimum(coords[backward, 2], absmax)
+    maxvalues[:, 0] = absmin[:, 0]
+    maxvalues = numpy.maximum.accumulate(maxvalues, axis = 1)
+
+    # put the running maximum back in upstream order
+    maxvalues = numpy.take_along_axis(maxvalues, numpy.where(valid, sizes[:, None] - 1 - steps[None, :], 0), axis = 1)
+
+    z = numpy.where((minvalues == appconfig.NODATA) | (maxvalues == appconfig.NODATA),
+        appconfig.NODATA, (minvalues + maxvalues) / 2.0)
+    newz[forward[valid]] = z[valid]
+
+
+def processEdges(edges):
+
+    for group in edgeGroups(edges):
+        smoothEdges(group)
+
+
+def fitProfile(values, bound):
+    """
+    Fits a non-increasing profile to the values with the pool adjacent
+    violators algorithm, no higher than bound (unless bound is NODATA).
+    NODATA values are not used in the fit and are given the fitted value
+    before them (or after them at the start).
+    :returns: list of the fitted values
+    """
+    # blocks of pooled values: sum, count and the number of values (including NODATA) in the block
+    sums = []
+    counts = []
+    sizes = []
+    leading = 0
+    for value in values:
+        if (value == appconfig.NODATA):
+            if sizes:
+                sizes[-1] += 1
             else:
-                edge.newz[i] = ((minvalues[i] + maxvalues[i]) / 2.0)
-        
-        
-def writeResults(connection):
+                leading += 1
+            continue
+        sums.append(value)
+        counts.append(1)
+        sizes.append(1)
+        while (len(sums) > 1 and sums[-2] * counts[-1] < sums[-1] * counts[-2]):
+            total = sums.pop()
+            count = counts.pop()
+            size = sizes.pop()
+            sums[-1] += total
+            counts[-1] += count
+            sizes[-1] += size
+
+    if not sums:
+        return [bound] * len(values)
+
+    fitted = []
+    for total, count, size in zip(sums, counts, sizes):
+        value = total / count
+        if (bound != appconfig.NODATA and value > bound):
+            value = bound
+        fitted.extend([value] * size)
+    return [fitted[0] if bound == appconfig.NODATA else bound] * leading + fitted
+
+
+def processIsotonic():
+    """
+    Fits non-increasing profiles to the edges, from the sources down
+    """
+    global bounds
+
+    endz = network.edgeArray(fill = appconfig.NODATA)
+    bounds = network.edgeArray(fill = appconfig.NODATA)
+
+    for node in network.downstreamSweep():
+        inedges = network.inEdges(node)
+        outedges = network.outEdges(node)
+
+        ends = [endz[edge] for edge in inedges if endz[edge] != appconfig.NODATA]
+        bound = min(ends) if ends else appconfig.NODATA
+
+        starts = []
+        for edge in outedges:
+            bounds[edge] = bound
+            first = offsets[edge]
+            last = offsets[edge + 1] - 1
+            if (bound == appconfig.NODATA):
+                # nothing upstream, the start of the edge is fitted too
+                fitted = fitProfile(coords[first:last + 1, 2].tolist(), bound)
+            else:
+                fitted = [bound] + fitProfile(coords[first + 1:last + 1, 2].tolist(), bound)
+            newz[first:last + 1] = fitted
+            endz[edge] = fitted[-1]
+            if (fitted[0] != appconfig.NODATA):
+                starts.append(fitted[0])
+
+        # the node is at or below the ends flowing into it and at or above
+        # the starts flowing out of it
+        z = bound
+        if (z == appconfig.NODATA and starts):
+            z = max(starts)
+        nodez[node] = z
+        for edge in inedges:
+            newz[offsets[edge + 1] - 1] = z
+        for edge in outedges:
+            newz[offsets[edge]] = z
+
+
+def edgeStates(method):
+    """
+    Hashes the inputs each edge is smoothed from: the method, the raw
+    geometry and the elevations of its end nodes (and the upstream bound
+    of its isotonic profile)
+    :returns: array of the state of each edge
+    """
+    fromz = nodez[network.fromNode].tolist()
+    toz = nodez[network.toNode].tolist()
+    edgebounds = bounds.tolist() if method == 'isotonic' else [appconfig.NODATA] * network.edgeCount
+
+    states = numpy.empty(network.edgeCount, dtype = object)
+    states[:] = [hashlib.md5(f"{method};{raw};{z1!r};{z2!r};{bound!r}".encode()).hexdigest()
+        for raw, z1, z2, bound in zip(rawHash, fromz, toz, edgebounds)]
+    return states
+
+
+def smoothNetwork(method, incremental = True):
+    """
+    Smooths the elevations of the loaded network with the method
+    :param method: envelope or isotonic (see METHODS)
+    :param incremental: only smooth the edges whose inputs are different
+        from the saved state (the envelope method), otherwise all edges
+    :returns: the edges to write and the state of each edge
+    """
+    if method not in METHODS:
+        raise Exception("Unknown smoothing_method " + method + ". Methods are: " + ", ".join(METHODS))
+
+    if (method == 'isotonic'):
+        print("  fitting isotonic profiles")
+        processIsotonic()
+        states = edgeStates(method)
+    else:
+        print("  processing nodes")
+        processNodes()
+        states = edgeStates(method)
+
+    edges = numpy.arange(network.edgeCount)
+    if incremental:
+        edges = numpy.flatnonzero(states != savedState)
+
+    if (method == 'envelope'):
+        print(f"""  processing {len(edges)} of {network.edgeCount} edges""")
+        processEdges(edges)
+
+    return edges, states
+
+
+def writeResults(connection, edges, states):
     
     updatequery = f"""
         UPDATE {dbTargetSchema}.{dbTargetTable} 
-        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{appconfig.dataSrid})
+        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{appconfig.dataSrid}),
+            {dbStateField} = %s
         WHERE  {appconfig.dbIdField} = %s
     """
     
-    newdata = []
-    
-    for edge in edges:
-        newpnts = [];
-        for i in range(0, len(edge.ls.coords)):
-            x = edge.ls.coords[i][0]
-            y = edge.ls.coords[i][1]
-            z = edge.newz[i]
-            newpnts.append((x,y,z))
-        ls = shapely.geometry.LineString(newpnts)
-        newdata.append( (shapely.wkb.dumps(ls), edge.fid))
+    if (len(edges) == 0):
+        return
+
+    counts = offsets[edges + 1] - offsets[edges]
+    vertices = numpy.concatenate([numpy.arange(offsets[edge], offsets[edge + 1]) for edge in edges])
+    lines = shapely.linestrings(numpy.column_stack([coords[vertices, 0], coords[vertices, 1], newz[vertices]]),
+        indices = numpy.repeat(numpy.arange(len(edges)), counts))
+    newdata = list(zip(shapely.to_wkb(lines), states[edges], [network.fids[edge] for edge in edges]))
     
     with connection.cursor() as cursor:    
         psycopg2.extras.execute_batch(cursor, updatequery, newdata);
@@ -255,19 +388,16 @@ def writeResults(connection):
 #--- main program ---    
 def main():
     
-    edges.clear()
-    nodes.clear()
-
     with appconfig.connectdb() as conn:
         
         conn.autocommit = False
         
         print("Smoothing Elevation Values")
         print("  creating output column")
-        #add a new geometry column for output removing existing one
+        #keep the existing smoothed geometries, only changed edges are updated
         query = f"""
-            ALTER TABLE {dbTargetSchema}.{dbTargetTable} drop column if exists {dbTargetGeom};        
-            ALTER TABLE {dbTargetSchema}.{dbTargetTable} add column {dbTargetGeom} geometry(linestringz, {appconfig.dataSrid});
+            ALTER TABLE {dbTargetSchema}.{dbTargetTable} add column if not exists {dbTargetGeom} geometry(linestringz, {appconfig.dataSrid});
+            ALTER TABLE {dbTargetSchema}.{dbTargetTable} add column if not exists {dbStateField} varchar;
         """
         with conn.cursor() as cursor:
             cursor.execute(query)
@@ -275,23 +405,29 @@ def main():
         print("  creating network")
         createNetwork(conn)
         
-        print("  processing nodes")
-        processNodes()
-        
-        print("  processing edges")
-        processEdges()
+        edges, states = smoothNetwork(smoothingMethod)
         
-        print("  writing results")
-        writeResults(conn)
-        # replace index on geometry field
-        query = f"""
-            DROP INDEX IF EXISTS {dbTargetSchema}.{dbTargetSchema}_{dbTargetTable}_geometry_idx;
-            CREATE INDEX IF NOT EXISTS {dbTargetSchema}_{dbTargetTable}_geometry_idx
-                ON {dbTargetSchema}.{dbTargetTable} USING gist
-                ({dbTargetGeom});
+        print(f"""  writing results: {len(edges)} of {network.edgeCount} edges changed""")
+        writeResults(conn, edges, states)
+
+        # index the geometry field unless it already is
+        query = """
+            SELECT indexdef FROM pg_indexes
+            WHERE schemaname = %s AND indexname = %s
         """
+        indexName = f"""{dbTargetSchema}_{dbTargetTable}_geometry_idx"""
         with conn.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, (dbTargetSchema, indexName))
+            row = cursor.fetchone()
+        if row is None or f"""({dbTargetGeom})""" not in row[0]:
+            query = f"""
+                DROP INDEX IF EXISTS {dbTargetSchema}.{indexName};
+                CREATE INDEX {indexName}
+                    ON {dbTargetSchema}.{dbTargetTable} USING gist
+                    ({dbTargetGeom});
+            """
+            with conn.cursor() as cursor:
+                cursor.execute(query)
         conn.commit()
         
     print("done")
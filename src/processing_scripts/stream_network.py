@@ -0,0 +1,461 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script loads the stream network topology once per run and shares it
+# between the processing steps that walk the network (compute_mainstems,
+# smooth_z, compute_updown_barriers_fish and compute_barriers_upstream_values).
+#
+# The topology is also stored in the database: updateNodes creates a node
+# table (stream table name + _node) with one row for each stream end point,
+# matched on the coordinates rounded to a grid (node_grid_size in the
+# [PROCESSING] section), and sets the from_node and to_node columns of the
+# stream table. Queries that need to follow the network join on these columns
+# instead of comparing geometries. preprocess_watershed and
+# break_streams_at_barriers call updateNodes after creating or splitting the
+# streams.
+#
+# updateNestedSets (called after updateNodes) numbers the streams walking up
+# the network from each outlet and stores the numbers in the network_pre and
+# network_post columns: the streams upstream of stream s (including s) are
+# the streams with network_pre between s.network_pre and s.network_post, and
+# stream a is downstream of stream b if b.network_pre is between a.network_pre
+# and a.network_post. The numbering requires the network to be a tree.
+#
+# Only the stream ids, node ids and lengths are loaded; the rows are fetched
+# in batches with a server side cursor.
+#
+# The network is stored in numpy arrays. Edges (streams) and nodes are
+# numbered from 0; edge i goes from node fromNode[i] to node toNode[i] and
+# the edges into and out of each node are stored in compressed sparse row
+# (CSR) form. Nodes are numbered in the order they are first seen reading
+# the stream table (nodeDbIds holds the node table id of each node). Edges
+# into and out of a node are in edge order.
+#
+# Steps keep the values they compute in their own arrays indexed by edge or
+# node id (use edgeArray and nodeArray), so the stream table is only queried
+# and the geometries only parsed when the topology changes.
+#
+# Steps walk the network with downstreamSweep (each node after all the nodes
+# upstream of it) and upstreamSweep (each node after all the nodes downstream
+# of it). The order is computed once per network with Kahn's algorithm
+# (removing nodes with no remaining in edges); if the network has a cycle an
+# error listing the nodes on it is raised before any node is visited.
+#
+# Steps that change the stream geometries (preprocess_watershed,
+# remove_isolated_flowpaths and break_streams_at_barriers) must call
+# invalidate() once they are done.
+#
+import appconfig
+import numpy
+import psycopg2.extras
+import threading
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
+nodeTable = dbTargetStreamTable + "_node"
+
+gridSize = appconfig.config['PROCESSING'].getfloat('node_grid_size', fallback = 0.000001)
+
+# number of rows fetched from the database at a time
+fetchSize = 10000
+
+networks = dict()
+lock = threading.Lock()
+
+class StreamNetwork:
+    """
+    The topology of the stream network
+    """
+
+    def __init__(self, fids, fromIds, toIds, lengths):
+        """
+        :param fids: the stream ids in the order they were read
+        :param fromIds: array of the node table ids of the stream start points
+        :param toIds: array of the node table ids of the stream end points
+        :param lengths: array of stream lengths
+        """
+        self.fids = list(fids)
+        self.edgeCount = len(self.fids)
+        self.length = numpy.asarray(lengths, dtype = numpy.float64)
+        self.edgeIndex = dict()
+        for i, fid in enumerate(self.fids):
+            self.edgeIndex.setdefault(fid, i)
+
+        # start and end nodes alternate so nodes are numbered in the order
+        # they are first seen
+        ids = numpy.empty(2 * self.edgeCount, dtype = numpy.int64)
+        ids[0::2] = fromIds
+        ids[1::2] = toIds
+
+        unique, first, inverse = numpy.unique(ids, return_index = True, return_inverse = True)
+        order = numpy.argsort(first, kind = 'stable')
+        rank = numpy.empty(len(order), dtype = numpy.int64)
+        rank[order] = numpy.arange(len(order))
+        nodeIds = rank[inverse.reshape(-1)]
+
+        self.nodeCount = len(order)
+        self.nodeDbIds = unique[order]
+        self.sortedDbIds = unique
+        self.sortedRank = rank
+        self.nodeX = numpy.full(self.nodeCount, numpy.nan)
+        self.nodeY = numpy.full(self.nodeCount, numpy.nan)
+
+        self.fromNode = nodeIds[0::2]
+        self.toNode = nodeIds[1::2]
+
+        self.outOffsets, self.outEdgeIds = self.adjacency(self.fromNode)
+        self.inOffsets, self.inEdgeIds = self.adjacency(self.toNode)
+
+        self.order = None
+
+    def adjacency(self, nodes):
+        """
+        Builds the CSR arrays listing the edges of each node
+        """
+        counts = numpy.bincount(nodes, minlength = self.nodeCount)
+        offsets = numpy.zeros(self.nodeCount + 1, dtype = numpy.int64)
+        numpy.cumsum(counts, out = offsets[1:])
+        return offsets, numpy.argsort(nodes, kind = 'stable')
+
+    def localNodes(self, dbIds):
+        """
+        Converts node table ids to network node ids
+        :returns: array of node ids, -1 for nodes not in the network
+        """
+        dbIds = numpy.asarray(dbIds, dtype = numpy.int64)
+        if (self.nodeCount == 0):
+            return numpy.full(len(dbIds), -1, dtype = numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(self.sortedDbIds, dbIds), self.nodeCount - 1)
+        return numpy.where(self.sortedDbIds[positions] == dbIds, self.sortedRank[positions], -1)
+
+    def setNodeLocations(self, dbIds, x, y):
+        """
+        Sets the node coordinates (used in messages) from the node table
+        """
+        nodes = self.localNodes(dbIds)
+        found = nodes >= 0
+        self.nodeX[nodes[found]] = numpy.asarray(x, dtype = numpy.float64)[found]
+        self.nodeY[nodes[found]] = numpy.asarray(y, dtype = numpy.float64)[found]
+
+    def outEdges(self, node):
+        """
+        The ids of the edges leaving the node
+        """
+        return self.outEdgeIds[self.outOffsets[node]:self.outOffsets[node + 1]]
+
+    def inEdges(self, node):
+        """
+        The ids of the edges entering the node
+        """
+        return self.inEdgeIds[self.inOffsets[node]:self.inOffsets[node + 1]]
+
+    def outDegree(self):
+        return numpy.diff(self.outOffsets)
+
+    def inDegree(self):
+        return numpy.diff(self.inOffsets)
+
+    def nodeLocations(self, nodes, limit = 10):
+        """
+        Formats the location of (up to limit) nodes for error messages
+        """
+        points = ["POINT(" + str(self.nodeX[node]) + " " + str(self.nodeY[node]) + ")" for node in nodes[:limit]]
+        if (len(nodes) > limit):
+            points.append("...")
+        return ", ".join(points)
+
+    def topologicalOrder(self):
+        """
+        Orders the nodes so each node comes after all the nodes upstream of it.
+        Nodes are removed a level at a time: first the nodes with no in edges,
+        then the nodes whose in edges all come from removed nodes and so on.
+        """
+        if (self.order is not None):
+            return self.order
+
+        remaining = self.inDegree().copy()
+        levels = []
+        level = (remaining == 0).nonzero()[0]
+        while (len(level) > 0):
+            levels.append(level)
+
+            # the edges leaving the nodes in this level
+            starts = self.outOffsets[level]
+            counts = self.outOffsets[level + 1] - starts
+            positions = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+            downnodes = self.toNode[self.outEdgeIds[positions]]
+
+            numpy.subtract.at(remaining, downnodes, 1)
+            downnodes = numpy.unique(downnodes)
+            level = downnodes[remaining[downnodes] == 0]
+
+        order = numpy.concatenate(levels) if levels else numpy.zeros(0, dtype = numpy.int64)
+        if (len(order) < self.nodeCount):
+            cycle = (remaining > 0).nonzero()[0]
+            raise Exception("The stream network contains a cycle, " + str(len(cycle)) + " nodes could not be ordered: " + self.nodeLocations(cycle))
+
+        self.order = order.tolist()
+        return self.order
+
+    def checkSingleOutlets(self):
+        """
+        Raises an error if any node has more than one out edge (the network
+        is not a tree)
+        """
+        nodes = (self.outDegree() > 1).nonzero()[0]
+        if (len(nodes) > 0):
+            raise Exception("The stream network is not a tree, " + str(len(nodes)) + " nodes have more than one outlet: " + self.nodeLocations(nodes))
+
+    def downstreamSweep(self):
+        """
+        Iterates over the nodes visiting each node once, after all the nodes
+        upstream of it
+        """
+        return iter(self.topologicalOrder())
+
+    def upstreamSweep(self):
+        """
+        Iterates over the nodes visiting each node once, after all the nodes
+        downstream of it
+        """
+        return reversed(self.topologicalOrder())
+
+    def nestedSets(self):
+        """
+        Numbers the edges in depth first (pre) order walking up the network
+        from each outlet, so the edges upstream of an edge (and the edge
+        itself) are numbered pre[edge] to post[edge]. Numbers start at 1.
+        The network must be a tree.
+        :returns: the pre and post arrays, indexed by edge
+        """
+        self.checkSingleOutlets()
+
+        # number of edges upstream of each edge (including the edge)
+        size = self.edgeArray(dtype = numpy.int64)
+        for node in self.downstreamSweep():
+            upsize = 1 + size[self.inEdges(node)].sum()
+            size[self.outEdges(node)] = upsize
+
+        pre = self.edgeArray(dtype = numpy.int64)
+        outdegree = self.outDegree()
+        outletPre = 1
+        for node in self.upstreamSweep():
+            inedges = self.inEdges(node)
+            if (len(inedges) == 0):
+                continue
+            if (outdegree[node] > 0):
+                # edges into a node follow the edge out of it
+                start = pre[self.outEdges(node)[0]] + 1
+            else:
+                # each outlet starts after the previous outlet's edges
+                start = outletPre
+                outletPre += size[inedges].sum()
+            pre[inedges] = start + numpy.cumsum(size[inedges]) - size[inedges]
+
+        return pre, pre + size - 1
+
+    def edgeArray(self, dtype = numpy.float64, species = None, fill = 0):
+        """
+        Creates an array to store a value for each edge, or a
+        (species x edges) array if the number of species is given
+        """
+        shape = self.edgeCount if species is None else (species, self.edgeCount)
+        return numpy.full(shape, fill, dtype = dtype)
+
+    def nodeArray(self, dtype = numpy.float64, fill = 0):
+        """
+        Creates an array to store a value for each node
+        """
+        return numpy.full(self.nodeCount, fill, dtype = dtype)
+
+
+def fetchRows(connection, query):
+    """
+    Runs the query with a server side cursor and returns the rows in
+    batches of fetchSize, so the full result is never held in memory
+    """
+    with connection.cursor(name = "stream_network_fetch") as cursor:
+        cursor.itersize = fetchSize
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(fetchSize)
+            if not rows:
+                break
+            yield rows
+
+
+def updateNodes(connection):
+    """
+    Recreates the node table and sets the from_node and to_node columns of
+    the stream table. Must be called after streams are added or split.
+    """
+    streamTable = dbTargetSchema + "." + dbTargetStreamTable
+    table = dbTargetSchema + "." + nodeTable
+
+    def key(point, axis):
+        return f"""round(st_{axis}({point}) / {gridSize})::bigint"""
+
+    start = f"""st_startpoint({streamTable}.{appconfig.dbGeomField})"""
+    end = f"""st_endpoint({streamTable}.{appconfig.dbGeomField})"""
+
+    query = f"""
+        DROP TABLE IF EXISTS {table};
+
+        CREATE TABLE {table} (
+            id serial primary key,
+            x_key bigint not null,
+            y_key bigint not null,
+            geometry geometry(Point, {appconfig.dataSrid})
+        );
+
+        INSERT INTO {table} (x_key, y_key, geometry)
+        SELECT x_key, y_key, st_setsrid(st_makepoint(x_key * {gridSize}, y_key * {gridSize}), {appconfig.dataSrid})
+        FROM (
+            SELECT {key(start, 'x')} as x_key, {key(start, 'y')} as y_key FROM {streamTable}
+            UNION
+            SELECT {key(end, 'x')}, {key(end, 'y')} FROM {streamTable}
+        ) ends;
+
+        CREATE UNIQUE INDEX {dbTargetSchema}_{nodeTable}_key_idx ON {table} (x_key, y_key);
+        CREATE INDEX {dbTargetSchema}_{nodeTable}_geometry_idx ON {table} USING gist(geometry);
+        ALTER TABLE {table} OWNER TO cwf_analyst;
+
+        ALTER TABLE {streamTable} ADD COLUMN IF NOT EXISTS from_node integer;
+        ALTER TABLE {streamTable} ADD COLUMN IF NOT EXISTS to_node integer;
+
+        UPDATE {streamTable} SET from_node = n.id
+        FROM {table} n
+        WHERE n.x_key = {key(start, 'x')} AND n.y_key = {key(start, 'y')};
+
+        UPDATE {streamTable} SET to_node = n.id
+        FROM {table} n
+        WHERE n.x_key = {key(end, 'x')} AND n.y_key = {key(end, 'y')};
+
+        CREATE INDEX IF NOT EXISTS {dbTargetSchema}_{dbTargetStreamTable}_from_node_idx ON {streamTable} (from_node);
+        CREATE INDEX IF NOT EXISTS {dbTargetSchema}_{dbTargetStreamTable}_to_node_idx ON {streamTable} (to_node);
+
+        ANALYZE {table};
+        ANALYZE {streamTable};
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    connection.commit()
+
+
+def updateNestedSets(connection):
+    """
+    Sets the network_pre and network_post columns of the stream table (see
+    StreamNetwork.nestedSets) so the streams upstream of stream s are the
+    streams with network_pre between s.network_pre and s.network_post.
+    Must be called after updateNodes.
+    """
+    streamTable = dbTargetSchema + "." + dbTargetStreamTable
+
+    print("    numbering streams for upstream queries")
+    network = loadNetwork(connection, streamTable)
+    pre, post = network.nestedSets()
+
+    query = f"""
+        ALTER TABLE {streamTable} ADD COLUMN IF NOT EXISTS network_pre integer;
+        ALTER TABLE {streamTable} ADD COLUMN IF NOT EXISTS network_post integer;
+        UPDATE {streamTable} SET network_pre = null, network_post = null;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+
+    updatequery = f"""
+        UPDATE {streamTable}
+        SET network_pre = %s, network_post = %s
+        WHERE {appconfig.dbIdField} = %s;
+    """
+    newdata = [(int(pre[edge]), int(post[edge]), network.fids[edge]) for edge in range(network.edgeCount)]
+    with connection.cursor() as cursor:
+        psycopg2.extras.execute_batch(cursor, updatequery, newdata)
+
+    query = f"""
+        CREATE INDEX IF NOT EXISTS {dbTargetSchema}_{dbTargetStreamTable}_network_pre_idx ON {streamTable} (network_pre);
+        ANALYZE {streamTable};
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    connection.commit()
+
+
+def loadNetwork(connection, table):
+
+    # only the node ids and length of each stream are needed so the
+    # geometries are not transferred
+    query = f"""
+        SELECT {appconfig.dbIdField}, from_node, to_node, st_length({appconfig.dbGeomField})
+        FROM {table}
+    """
+
+    fids = []
+    fromIds = []
+    toIds = []
+    lengths = []
+    for rows in fetchRows(connection, query):
+        for row in rows:
+            fids.append(row[0])
+            fromIds.append(row[1])
+            toIds.append(row[2])
+            lengths.append(row[3])
+
+    network = StreamNetwork(fids, numpy.array(fromIds, dtype = numpy.int64),
+        numpy.array(toIds, dtype = numpy.int64), numpy.array(lengths, dtype = numpy.float64))
+
+    query = f"""
+        SELECT id, st_x(geometry), st_y(geometry)
+        FROM {dbTargetSchema}.{nodeTable}
+    """
+    dbIds = []
+    x = []
+    y = []
+    for rows in fetchRows(connection, query):
+        for row in rows:
+            dbIds.append(row[0])
+            x.append(row[1])
+            y.append(row[2])
+    network.setNodeLocations(dbIds, x, y)
+
+    return network
+
+
+def getNetwork(connection):
+    """
+    Returns the stream network topology for the watershed, loading it
+    if it hasn't been loaded since the last time it was invalidated
+    """
+    table = dbTargetSchema + "." + dbTargetStreamTable
+
+    with lock:
+        if table not in networks:
+            print("  loading stream network topology")
+            networks[table] = loadNetwork(connection, table)
+        return networks[table]
+
+
+def invalidate():
+    """
+    Discards the loaded network topology so it is reloaded the next time it
+    is used. Must be called after the stream geometries are changed.
+    """
+    with lock:
+        networks.pop(dbTargetSchema + "." + dbTargetStreamTable, None)
@@ -0,0 +1,293 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script stores and reads the vertex gradients (see
+# compute_vertex_gradient.py). With vertex_gradient_storage in the
+# [GRADIENT_PROCESSING] section set to:
+#   table (default) - the vertex gradient table has a row for every vertex
+#   profile - the vertex gradient profile table has a row for every
+#     mainstem with the vertex values as arrays in measure order
+#     (downstream_route_measure, elevation_a, elevation_b, gradient and
+#     grade_class) and the vertex and upstream points as multipoints. The
+#     vertex gradient table is a view expanding the profiles to a row for
+#     every vertex (for QGIS).
+#
+# The accessor functions read either storage so the processing scripts do
+# not depend on which is used.
+#
+import appconfig
+import io
+import numpy
+
+iniSection = appconfig.args.args[0]
+
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
+dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
+dbVertexTable = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
+
+STORAGES = ['table', 'profile']
+storage = appconfig.config['GRADIENT_PROCESSING'].get('vertex_gradient_storage', fallback = 'table')
+profileTable = appconfig.config['GRADIENT_PROCESSING'].get('vertex_gradient_profile_table', fallback = dbVertexTable + "_profile")
+
+if storage not in STORAGES:
+    raise Exception("Unknown vertex_gradient_storage " + storage + ". Storages are: " + ", ".join(STORAGES))
+
+
+def dropVertexTables(connection):
+    """
+    Drops the vertex gradient table (or view) and the profile table
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (dbTargetSchema + "." + dbVertexTable,))
+        row = cursor.fetchone()
+        if row is not None:
+            kind = "VIEW" if row[0] == 'v' else "TABLE"
+            cursor.execute(f"""DROP {kind} {dbTargetSchema}.{dbVertexTable}""")
+        cursor.execute(f"""DROP TABLE IF EXISTS {dbTargetSchema}.{profileTable}""")
+
+
+def arrayText(values):
+    return "{" + ",".join([repr(v) for v in values]) + "}"
+
+
+def saveProfiles(connection, results):
+    """
+    Loads the vertex gradients (see compute_vertex_gradient.vertexGradients)
+    into the profile table, a row for each mainstem, and creates the vertex
+    gradient view
+    """
+    mainstems = results['mainstem']
+    order = numpy.lexsort((results['measure'], mainstems.astype(str)))
+    mainstems = mainstems[order]
+    first = numpy.ones(len(order), dtype = bool)
+    first[1:] = mainstems[1:] != mainstems[:-1]
+    starts = numpy.flatnonzero(first)
+    ends = numpy.append(starts[1:], len(order))
+
+    columns = [results[field][order] for field in ('measure', 'elevation_a', 'elevation_b', 'gradient', 'grade_class')]
+    columns += [results['vertex'][order, i] for i in (0, 1, 3)]
+    columns += [results['upstream'][order, i] for i in (0, 1, 3)]
+
+    rows = io.StringIO()
+    for start, end in zip(starts, ends):
+        rows.write("\t".join([str(mainstems[start])] + [arrayText(column[start:end].tolist()) for column in columns]) + "\n")
+    rows.seek(0)
+
+    query = f"""
+        DROP TABLE IF EXISTS vertex_profile_load;
+
+        CREATE TEMPORARY TABLE vertex_profile_load AS
+        SELECT {dbMainstemField},
+            '{{}}'::double precision[] as downstream_route_measure,
+            '{{}}'::double precision[] as elevation_a,
+            '{{}}'::double precision[] as elevation_b,
+            '{{}}'::double precision[] as gradient,
+            '{{}}'::smallint[] as grade_class,
+            '{{}}'::double precision[] as x, '{{}}'::double precision[] as y, '{{}}'::double precision[] as m,
+            '{{}}'::double precision[] as upx, '{{}}'::double precision[] as upy, '{{}}'::double precision[] as upm
+        FROM {dbTargetSchema}.{dbTargetStreamTable}
+        LIMIT 0;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        cursor.copy_expert("COPY vertex_profile_load FROM STDIN", rows)
+
+    query = f"""
+        CREATE TABLE {dbTargetSchema}.{profileTable} AS
+        SELECT
+            l.{dbMainstemField},
+            l.downstream_route_measure,
+            l.elevation_a,
+            l.elevation_b,
+            l.gradient,
+            l.grade_class,
+            (SELECT st_setsrid(st_collect(st_makepoint(u.x, u.y, u.z, u.m) ORDER BY u.i), {appconfig.dataSrid})
+                FROM unnest(l.x, l.y, l.elevation_a, l.m) WITH ORDINALITY AS u(x, y, z, m, i)) as vertices,
+            (SELECT st_setsrid(st_collect(st_makepoint(u.x, u.y, u.z, u.m) ORDER BY u.i), {appconfig.dataSrid})
+                FROM unnest(l.upx, l.upy, l.elevation_b, l.upm) WITH ORDINALITY AS u(x, y, z, m, i)) as upstream
+        FROM vertex_profile_load l;
+
+        DROP TABLE vertex_profile_load;
+
+        CREATE INDEX ON {dbTargetSchema}.{profileTable} ({dbMainstemField});
+        CREATE INDEX ON {dbTargetSchema}.{profileTable} USING gist (vertices);
+
+        CREATE VIEW {dbTargetSchema}.{dbVertexTable} AS
+        SELECT
+            p.{dbMainstemField},
+            v.downstream_route_measure,
+            v.elevation_a,
+            v.elevation_b,
+            v.gradient,
+            v.vertex_pnt,
+            st_multi(v.upstream_pnt) as upstream_pnt,
+            v.grade_class
+        FROM {dbTargetSchema}.{profileTable} p
+        CROSS JOIN LATERAL ROWS FROM (
+            unnest(p.downstream_route_measure), unnest(p.elevation_a), unnest(p.elevation_b),
+            unnest(p.gradient), st_dump(p.vertices), st_dump(p.upstream), unnest(p.grade_class)
+        ) AS v(downstream_route_measure, elevation_a, elevation_b, gradient, vertex_path, vertex_pnt,
+            upstream_path, upstream_pnt, grade_class);
+
+        ALTER TABLE  {dbTargetSchema}.{profileTable} OWNER TO cwf_analyst;
+        ALTER VIEW  {dbTargetSchema}.{dbVertexTable} OWNER TO cwf_analyst;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+
+
+def loadProfiles(connection, fields = ('downstream_route_measure', 'gradient')):
+    """
+    Loads the vertex values of each mainstem
+    :param fields: the vertex fields to load
+    :returns: list of (mainstem id, dictionary of field to numpy array of
+        the vertex values in measure order), ordered by mainstem id
+    """
+    if (storage == 'profile'):
+        query = f"""
+            SELECT {dbMainstemField}, {", ".join(fields)}
+            FROM {dbTargetSchema}.{profileTable}
+            ORDER BY {dbMainstemField}
+        """
+    else:
+        query = f"""
+            SELECT {dbMainstemField}, {", ".join([f"array_agg({field} ORDER BY downstream_route_measure)" for field in fields])}
+            FROM {dbTargetSchema}.{dbVertexTable}
+            GROUP BY {dbMainstemField}
+            ORDER BY {dbMainstemField}
+        """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+
+    return [(feature[0], {field: numpy.array(values) for field, values in zip(fields, feature[1:])}) for feature in features]
+
+
+def downstreamGradients(connection):
+    """
+    Returns the gradients at the downstream end of each mainstem, the same
+    ones break_streams_at_barriers checks (see downstreamGradientsQuery)
+    :returns: dictionary of mainstem id to list of gradients
+    """
+    table = profileTable if storage == 'profile' else dbVertexTable
+    query = f"""
+        WITH firsts AS (
+            SELECT DISTINCT {dbMainstemField} as mainstem, 0 as vertex_index
+            FROM {dbTargetSchema}.{table}
+        ),
+        points AS (
+            {vertexPointsQuery("firsts")}
+        )
+        SELECT p.mainstem, d.gradient
+        FROM points p
+        CROSS JOIN LATERAL ({downstreamGradientsQuery("p.mainstem", "p.point")}) d
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+
+    results = dict()
+    for feature in features:
+        results.setdefault(feature[0], []).append(feature[1])
+    return results
+
+
+def vertexPointsQuery(table):
+    """
+    Returns a query for the rows of a table with mainstem and vertex_index
+    (the position of the vertex in measure order, from 0) columns and the
+    (2d) vertex point as point
+    """
+    if (storage == 'profile'):
+        return f"""
+            SELECT t.*, st_force2d(st_geometryn(p.vertices, t.vertex_index + 1)) as point
+            FROM {table} t
+            JOIN {dbTargetSchema}.{profileTable} p ON p.{dbMainstemField} = t.mainstem
+        """
+    return f"""
+        SELECT t.*, v.point
+        FROM {table} t
+        JOIN (
+            SELECT {dbMainstemField} as mainstem, st_force2d(vertex_pnt) as point,
+                row_number() OVER (PARTITION BY {dbMainstemField} ORDER BY downstream_route_measure) - 1 as vertex_index
+            FROM {dbTargetSchema}.{dbVertexTable}
+            WHERE {dbMainstemField} IN (SELECT mainstem FROM {table})
+        ) v ON v.mainstem = t.mainstem AND v.vertex_index = t.vertex_index
+    """
+
+
+def vertexRowsQuery():
+    """
+    Returns a query for the vertices of all the mainstems without their
+    points: mainstem, vertex_index (the position of the vertex in measure
+    order, from 0), downstream_route_measure and gradient
+    """
+    if (storage == 'profile'):
+        return f"""
+            SELECT p.{dbMainstemField} as mainstem, (v.i - 1)::integer as vertex_index, v.downstream_route_measure, v.gradient
+            FROM {dbTargetSchema}.{profileTable} p
+            CROSS JOIN LATERAL unnest(p.downstream_route_measure, p.gradient) WITH ORDINALITY AS v(downstream_route_measure, gradient, i)
+        """
+    return f"""
+        SELECT {dbMainstemField} as mainstem,
+            (row_number() OVER (PARTITION BY {dbMainstemField} ORDER BY downstream_route_measure) - 1)::integer as vertex_index,
+            downstream_route_measure, gradient
+        FROM {dbTargetSchema}.{dbVertexTable}
+    """
+
+
+def gradientsAtQuery(mainstem, point):
+    """
+    Returns a query for the gradients of the vertices of a mainstem at a
+    point
+    :param mainstem: sql expression for the mainstem id
+    :param point: sql expression for the point
+    """
+    if (storage == 'profile'):
+        return f"""
+            SELECT v.gradient
+            FROM {dbTargetSchema}.{profileTable} p
+            CROSS JOIN LATERAL ROWS FROM (unnest(p.gradient), st_dump(p.vertices)) AS v(gradient, path, geom)
+            WHERE p.{dbMainstemField} = {mainstem} AND v.geom && {point}
+        """
+    return f"""
+        SELECT v.gradient
+        FROM {dbTargetSchema}.{dbVertexTable} v
+        WHERE v.{dbMainstemField} = {mainstem} AND v.vertex_pnt && {point}
+    """
+
+
+def downstreamGradientsQuery(mainstem, point):
+    """
+    Returns a query for the gradients at the downstream end of a mainstem:
+    the gradients of the vertices at the start of each stream the mainstem
+    flows into, on that stream's own mainstem
+    :param mainstem: sql expression for the mainstem id
+    :param point: sql expression for the (2d) point of the first (most
+        downstream) vertex of the mainstem
+    """
+    return f"""
+        SELECT d.gradient
+        FROM {dbTargetSchema}.{dbTargetStreamTable} a
+        JOIN {dbTargetSchema}.{dbTargetStreamTable} b ON b.from_node = a.to_node
+        CROSS JOIN LATERAL ({gradientsAtQuery("b." + dbMainstemField, "st_startpoint(b.geometry)")}) d
+        WHERE a.{dbMainstemField} = {mainstem}
+        AND a.geometry && {point} AND st_equals(st_endpoint(a.geometry), {point})
+    """
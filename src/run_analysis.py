@@ -30,6 +30,7 @@ from processing_scripts import load_and_snap_fishobservation
 from processing_scripts import compute_modelled_crossings
 from processing_scripts import load_barrier_updates
 from processing_scripts import compute_mainstems
+from processing_scripts import build_dem_corridor
 from processing_scripts import assign_raw_z
 from processing_scripts import smooth_z
 from processing_scripts import compute_vertex_gradient
@@ -44,27 +45,35 @@ iniSection = appconfig.args.args[0]
 
 workingWatershedId = appconfig.config[iniSection]['watershed_id']
 
-print ("Processing: " + workingWatershedId)
 
-# re-load unbroken stream table
-preprocess_watershed.main()
-# load_and_snap_barriers_cabd.main()
-# load_and_snap_fishobservation.main()
-# compute_modelled_crossings.main()
-# load_barrier_updates.main()
-compute_mainstems.main()
-assign_raw_z.main()
-smooth_z.main()
-compute_vertex_gradient.main()
-break_streams_at_barriers.main()
-print ("Recalculating elevations on broken streams: " + workingWatershedId)
-# re-assign elevations to broken streams
-assign_raw_z.main()
-smooth_z.main()
-compute_segment_gradient.main()
-compute_updown_barriers_fish.main()
-compute_accessibility.main()
-assign_habitat.main()
-compute_barriers_upstream_values.main()
+def main():
+    print ("Processing: " + workingWatershedId)
 
-print ("Processing Complete: " + workingWatershedId)
\ No newline at end of file
+    # re-load unbroken stream table
+    preprocess_watershed.main()
+    # load_and_snap_barriers_cabd.main()
+    # load_and_snap_fishobservation.main()
+    # compute_modelled_crossings.main()
+    # load_barrier_updates.main()
+    compute_mainstems.main()
+    build_dem_corridor.main()
+    assign_raw_z.main()
+    smooth_z.main()
+    compute_vertex_gradient.main()
+    break_streams_at_barriers.main()
+    print ("Recalculating elevations on broken streams: " + workingWatershedId)
+    # re-assign elevations to broken streams
+    assign_raw_z.main()
+    smooth_z.main()
+    compute_segment_gradient.main()
+    compute_updown_barriers_fish.main()
+    compute_accessibility.main()
+    assign_habitat.main()
+    compute_barriers_upstream_values.main()
+
+    print ("Processing Complete: " + workingWatershedId)
+
+
+# the elevation steps can start worker processes which import this script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script measures the work done by each processing step and writes a
+# run report (json and csv) to the run directory. For each step it records:
+#  * wall time and python cpu time (of the thread running the step, plus the
+#    worker processes it reports through appconfig.workerCpu, such as the
+#    dem_workers processes of assign_raw_z)
+#  * number of sql statements executed (execute_batch pages count once)
+#  * rows read (returned by queries or copied out) and rows written
+#    (inserted, updated, deleted or copied in)
+#  * bytes sent (query text and copied data) and received (size of the
+#    values fetched and copied data)
+#
+# Database work is measured with a cursor class installed for all connections
+# made through appconfig.connectdb(); it is attributed to the step running on
+# the current thread. Work done by external programs (ogr2ogr) is not included.
+#
+import csv
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import psycopg2.extensions
+
+import appconfig
+
+iniSection = appconfig.args.args[0]
+
+runDirectory = appconfig.config['PROCESSING'].get('run_directory', fallback = 'runs')
+
+FIELDS = ["step", "status", "start", "wall_seconds", "cpu_seconds", "sql_statements",
+          "rows_read", "rows_written", "bytes_sent", "bytes_received"]
+
+current = threading.local()
+
+
+class StepStats:
+
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.start = None
+        self.wall = 0
+        self.cpu = 0
+        self.workerCpu = 0
+        self.statements = 0
+        self.rowsRead = 0
+        self.rowsWritten = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def toDict(self):
+        return {
+            "step": self.name,
+            "status": self.status,
+            "start": self.start,
+            "wall_seconds": round(self.wall, 3),
+            "cpu_seconds": round(self.cpu, 3),
+            "sql_statements": self.statements,
+            "rows_read": self.rowsRead,
+            "rows_written": self.rowsWritten,
+            "bytes_sent": self.bytesSent,
+            "bytes_received": self.bytesReceived
+        }
+
+
+def valueSize(value):
+    if isinstance(value, (str, bytes, memoryview)):
+        return len(value)
+    if value is None:
+        return 0
+    return 8
+
+def rowSize(row):
+    if row is None:
+        return 0
+    return sum(valueSize(value) for value in row)
+
+
+def addWorkerCpu(seconds):
+    """
+    Adds cpu time used by worker processes to the step running on the
+    current thread
+    """
+    stats = getattr(current, "stats", None)
+    if stats is not None:
+        stats.workerCpu += seconds
+
+
+class CountedFile:
+    """
+    File wrapper counting the data copied through it
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        self.size += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.file.readline(*args)
+        self.size += len(data)
+        return data
+
+    def write(self, data):
+        self.size += len(data)
+        return self.file.write(data)
+
+
+class StatsCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that adds the work it does to the step running on the current thread
+    """
+
+    def stats(self):
+        return getattr(current, "stats", None)
+
+    def execute(self, query, vars = None):
+        result = super().execute(query, vars)
+        stats = self.stats()
+        if stats is not None:
+            stats.statements += 1
+            stats.bytesSent += len(self.query) if self.query is not None else 0
+            if self.description is not None:
+                if self.name is None and self.rowcount > 0:
+                    stats.rowsRead += self.rowcount
+            elif self.rowcount > 0:
+                stats.rowsWritten += self.rowcount
+        return result
+
+    def executemany(self, query, vars_list):
+        result = super().executemany(query, vars_list)
+        stats = self.stats()
+        if stats is not None:
+            stats.statements += 1
+            if self.rowcount > 0:
+                stats.rowsWritten += self.rowcount
+        return result
+
+    def copied(self, sql, file, load):
+        stats = self.stats()
+        if stats is not None:
+            stats.statements += 1
+            stats.bytesSent += len(str(sql))
+            rows = max(self.rowcount, 0)
+            if load:
+                stats.bytesSent += file.size
+                stats.rowsWritten += rows
+            else:
+                stats.bytesReceived += file.size
+                stats.rowsRead += rows
+
+    def copy_expert(self, sql, file, size = 8192):
+        counted = CountedFile(file)
+        result = super().copy_expert(sql, counted, size)
+        self.copied(sql, counted, "STDIN" in str(sql).upper())
+        return result
+
+    def copy_from(self, file, table, sep = '\t', null = '\\N', size = 8192, columns = None):
+        counted = CountedFile(file)
+        result = super().copy_from(counted, table, sep, null, size, columns)
+        self.copied("COPY " + table + " FROM STDIN", counted, True)
+        return result
+
+    def copy_to(self, file, table, sep = '\t', null = '\\N', columns = None):
+        counted = CountedFile(file)
+        result = super().copy_to(counted, table, sep, null, columns)
+        self.copied("COPY " + table + " TO STDOUT", counted, False)
+        return result
+
+    def received(self, rows):
+        stats = self.stats()
+        if stats is not None:
+            stats.bytesReceived += sum(rowSize(row) for row in rows)
+            # rows from server side (named) cursors are counted as they are fetched
+            if self.name is not None:
+                stats.rowsRead += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.received([row])
+        return row
+
+    def fetchmany(self, size = None):
+        if size is None:
+            return self.received(super().fetchmany())
+        return self.received(super().fetchmany(size))
+
+    def fetchall(self):
+        return self.received(super().fetchall())
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize if self.name is not None else 1000)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+class RunReport:
+    """
+    Collects the statistics for each step of a run and writes the report
+    """
+
+    def __init__(self):
+        self.start = datetime.now()
+        self.steps = []
+        self.lock = threading.Lock()
+        appconfig.cursorFactory = StatsCursor
+        appconfig.workerCpu = addWorkerCpu
+
+    def runStep(self, step):
+        """
+        Runs the step measuring the work it does
+        """
+        stats = StepStats(step.name)
+        stats.start = datetime.now().isoformat()
+        current.stats = stats
+
+        wallStart = time.perf_counter()
+        cpuStart = time.thread_time()
+        try:
+            step.run()
+            stats.status = "complete"
+        except Exception:
+            stats.status = "failed"
+            raise
+        finally:
+            stats.wall = time.perf_counter() - wallStart
+            stats.cpu = time.thread_time() - cpuStart + stats.workerCpu
+            current.stats = None
+            with self.lock:
+                self.steps.append(stats)
+
+    def write(self):
+        """
+        Writes the run report as json and csv to the reports folder in the run
+        directory and returns the path of the json file
+        """
+        directory = os.path.join(runDirectory, iniSection, "reports")
+        os.makedirs(directory, exist_ok = True)
+        name = self.start.strftime("%Y%m%d-%H%M%S")
+
+        rows = [stats.toDict() for stats in self.steps]
+
+        jsonFile = os.path.join(directory, name + ".json")
+        with open(jsonFile, "w") as file:
+            json.dump({
+                "watershed": iniSection,
+                "start": self.start.isoformat(),
+                "runtime_seconds": round((datetime.now() - self.start).total_seconds(), 3),
+                "workers": appconfig.workers,
+                "steps": rows
+            }, file, indent = 2)
+
+        with open(os.path.join(directory, name + ".csv"), "w", newline = '') as file:
+            writer = csv.DictWriter(file, fieldnames = FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+        return jsonFile
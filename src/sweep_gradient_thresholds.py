@@ -0,0 +1,228 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# This script places the gradient barriers for many gradient thresholds at
+# once, for testing the sensitivity of the model to the accessibility
+# gradient without rerunning the processing for each threshold.
+#
+# Usage: sweep_gradient_thresholds.py -c config.ini watershedid [threshold ...]
+#
+# The thresholds are the arguments after the watershed id, or else
+# gradient_sweep_thresholds (comma separated) in the [GRADIENT_PROCESSING]
+# section, or else the grade class breaks. The vertex gradients
+# (compute_vertex_gradient) must have been computed.
+#
+# The gradient barriers are placed the same way as break_streams_at_barriers
+# places them for the species accessibility gradient: at the start of each run
+# of vertices on a mainstem with a gradient above the threshold (and at the
+# first vertex of a mainstem if the vertex of the mainstem it flows into is
+# not above the threshold there; both scripts use
+# vertex_profiles.downstreamGradientsQuery). All thresholds are checked in
+# one pass over the vertex gradients of each mainstem.
+#
+# The barriers are written to the gradient_sweep_table (default
+# <gradient_barrier_table>_sweep) with their threshold, and for each threshold
+# the length of stream not above a gradient barrier (accessible or potentially
+# accessible, the other barriers are not considered) is reported.
+#
+import appconfig
+import io
+import numpy
+
+from processing_scripts import compute_vertex_gradient
+from processing_scripts import stream_network
+from processing_scripts import vertex_profiles
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
+dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
+dbGradientBarrierTable = appconfig.config['BARRIER_PROCESSING']['gradient_barrier_table']
+dbSweepTable = appconfig.config['GRADIENT_PROCESSING'].get('gradient_sweep_table', fallback = dbGradientBarrierTable + "_sweep")
+
+# thresholds are tracked as the bits of an integer for each stream
+MAX_THRESHOLDS = 64
+
+
+def getThresholds():
+    values = appconfig.args.args[1:]
+    if not values:
+        setting = appconfig.config['GRADIENT_PROCESSING'].get('gradient_sweep_thresholds', fallback = '')
+        values = [value for value in setting.split(",") if value.strip() != '']
+    thresholds = sorted(set([float(value) for value in values])) if values else compute_vertex_gradient.GRADE_BREAKS
+
+    if len(thresholds) > MAX_THRESHOLDS:
+        raise Exception(f"""At most {MAX_THRESHOLDS} gradient thresholds can be swept at once""")
+    return numpy.array(thresholds, dtype = numpy.float64)
+
+
+def placeBarriers(profiles, downstream, thresholds):
+    """
+    Finds the gradient barriers for all the thresholds in one pass over the
+    vertex gradients of each mainstem
+    :param profiles: the vertex gradients of the mainstems (see
+        vertex_profiles.loadProfiles)
+    :param downstream: the gradients at the downstream end of each mainstem
+        (see vertex_profiles.downstreamGradients)
+    :returns: list of (threshold index, mainstem id, vertex index)
+    """
+    barriers = []
+    for mainstem, profile in profiles:
+        gradient = profile['gradient']
+        if len(gradient) == 0:
+            continue
+        above = gradient[:, None] > thresholds[None, :]
+
+        # the start of each run above the threshold, the first vertex only
+        # if the mainstem flows into a vertex not above it
+        starts = above.copy()
+        starts[1:] &= ~above[:-1]
+        below = numpy.array(downstream.get(mainstem, []), dtype = numpy.float64)
+        starts[0] &= (below[:, None] <= thresholds[None, :]).any(axis = 0)
+
+        for index, threshold in zip(*numpy.nonzero(starts)):
+            barriers.append((int(threshold), mainstem, int(index)))
+    return barriers
+
+
+def saveBarriers(connection, barriers, thresholds):
+    """
+    Writes the barriers to the sweep table with the stream they are on and
+    the length of that stream downstream of them
+    :returns: list of (threshold index, stream id, downstream length)
+    """
+    rows = io.StringIO()
+    for threshold, mainstem, index in barriers:
+        rows.write(f"""{threshold}\t{thresholds[threshold]!r}\t{mainstem}\t{index}\n""")
+    rows.seek(0)
+
+    query = f"""
+        DROP TABLE IF EXISTS gradient_sweep_load;
+        CREATE TEMPORARY TABLE gradient_sweep_load AS
+        SELECT 0::integer as threshold_index,
+            0::double precision as threshold,
+            {dbMainstemField} as mainstem,
+            0::integer as vertex_index
+        FROM {dbTargetSchema}.{dbTargetStreamTable}
+        LIMIT 0;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        cursor.copy_expert("COPY gradient_sweep_load FROM STDIN", rows)
+
+    query = f"""
+        DROP TABLE IF EXISTS {dbTargetSchema}.{dbSweepTable};
+
+        CREATE TABLE {dbTargetSchema}.{dbSweepTable} AS
+        SELECT t.threshold_index, t.threshold, t.mainstem, t.vertex_index,
+            s.{appconfig.dbIdField} as stream_id,
+            (1 - st_linelocatepoint(s.geometry, t.point)) * st_length(s.geometry) as downstream_length,
+            st_setsrid(t.point, {appconfig.dataSrid})::geometry(POINT, {appconfig.dataSrid}) as point
+        FROM ({vertex_profiles.vertexPointsQuery("gradient_sweep_load")}) t
+        LEFT JOIN LATERAL (
+            SELECT a.{appconfig.dbIdField}, a.geometry
+            FROM {dbTargetSchema}.{dbTargetStreamTable} a
+            WHERE st_dwithin(a.geometry, t.point, 0.01)
+            AND NOT st_dwithin(st_endpoint(a.geometry), t.point, 0.01)
+            LIMIT 1
+        ) s ON true;
+
+        DROP TABLE gradient_sweep_load;
+
+        ALTER TABLE  {dbTargetSchema}.{dbSweepTable} OWNER TO cwf_analyst;
+
+        SELECT threshold_index, stream_id::varchar, downstream_length
+        FROM {dbTargetSchema}.{dbSweepTable}
+        WHERE stream_id IS NOT NULL;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+    connection.commit()
+    return features
+
+
+def accessibleLengths(network, placed, count):
+    """
+    Computes the length of stream not above a gradient barrier for each
+    threshold. The thresholds with a barrier on each stream are the bits
+    of an integer, or-ed up the network from the outlets.
+    :param placed: list of (threshold index, stream id, downstream length)
+    :returns: array of the length for each threshold
+    """
+    own = network.edgeArray(dtype = numpy.uint64)
+    # length of a stream below its most downstream barrier, by threshold
+    partial = dict()
+    for threshold, fid, length in placed:
+        edge = network.edgeIndex.get(fid)
+        if edge is None:
+            continue
+        own[edge] |= numpy.uint64(1 << threshold)
+        partial[(edge, threshold)] = min(length, partial.get((edge, threshold), length))
+
+    # thresholds with a barrier downstream of each stream
+    below = network.edgeArray(dtype = numpy.uint64)
+    nodeBelow = network.nodeArray(dtype = numpy.uint64)
+    for node in network.upstreamSweep():
+        for edge in network.inEdges(node):
+            below[edge] = nodeBelow[node]
+            nodeBelow[network.fromNode[edge]] |= below[edge] | own[edge]
+
+    lengths = numpy.zeros(count)
+    for threshold in range(count):
+        bit = numpy.uint64(1 << threshold)
+        free = (below & bit) == 0
+        lengths[threshold] = network.length[free & ((own & bit) == 0)].sum()
+        for edge in numpy.flatnonzero(free & ((own & bit) != 0)):
+            lengths[threshold] += partial[(edge, threshold)]
+    return lengths
+
+
+def main():
+    thresholds = getThresholds()
+
+    with appconfig.connectdb() as conn:
+        print("Sweeping gradient thresholds: " + ", ".join([f"{t:g}" for t in thresholds]))
+
+        print("  placing gradient barriers")
+        profiles = vertex_profiles.loadProfiles(conn, ('gradient',))
+        downstream = vertex_profiles.downstreamGradients(conn)
+        barriers = placeBarriers(profiles, downstream, thresholds)
+
+        print("  writing gradient barriers to " + dbTargetSchema + "." + dbSweepTable)
+        placed = saveBarriers(conn, barriers, thresholds)
+
+        print("  computing accessible lengths")
+        network = stream_network.getNetwork(conn)
+
+    lengths = accessibleLengths(network, placed, len(thresholds))
+    counts = numpy.bincount([barrier[0] for barrier in barriers], minlength = len(thresholds))
+    total = network.length.sum()
+
+    print("  threshold, gradient barriers, length not above a gradient barrier (km), % of streams, change from previous threshold (km)")
+    for i, threshold in enumerate(thresholds):
+        change = "" if i == 0 else f"""{(lengths[i] - lengths[i - 1]) / 1000.0:+.3f}"""
+        percent = 100.0 * lengths[i] / total if total > 0 else 0
+        print(f"""  {threshold:g}, {counts[i]}, {lengths[i] / 1000.0:.3f}, {percent:.1f}, {change}""")
+
+    print("done")
+
+
+if __name__ == "__main__":
+    main()